@@ -0,0 +1,288 @@
+"""Measure the overhead of the profiler backends and the cost of their statistics.
+
+Two benchmarks are run and written as one JSON document:
+
+* load: a synthetic Tornado app runs in a child process with the routes of
+  one backend, the profiler is started through its REST API, and a local
+  client sends `--requests` requests with `--concurrency` in flight. The
+  throughput and latency percentiles are compared with profiling off.
+* stats: yappi profiles `--sizes` distinct generated functions, then the
+  first (cold) and repeated (warm) `GET /profiler/stats` are timed, along
+  with the memory they allocate.
+
+Usage::
+
+    python benchmarks/bench_profiler.py --output results.json
+    python benchmarks/bench_profiler.py --backends off,yappi --sizes 1000 --requests 500
+
+Compare the JSON of two releases to track regressions; `overhead` is the
+fraction of the unprofiled throughput lost to each backend.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import signal
+import socket
+import sys
+import time
+
+import tornado
+import tornado.gen
+import tornado.httpclient
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+import yappi
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tornado_profile  # noqa: E402
+from tornado_profile import RingBuffer, TornadoProfiler  # noqa: E402
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+
+# name -> (TornadoProfiler backend, query of POST /profiler, None leaves it off)
+BACKENDS = [
+    ("off", "yappi", None),
+    ("yappi", "yappi", ""),
+    ("yappi-wall", "yappi", "clock=wall"),
+    ("yappi-threads", "yappi", "threads=true"),
+    ("cprofile", "cprofile", ""),
+    ("sampling", "sampling", ""),
+    ("tracemalloc", "tracemalloc", ""),
+]
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+def fib(n):
+    return n if n < 2 else fib(n - 1) + fib(n - 2)
+
+
+class WorkHandler(tornado.web.RequestHandler):
+    """Mix of Python calls, allocations and a yield to the IOLoop."""
+
+    @tornado.gen.coroutine
+    def get(self):
+        rows = [{"id": i, "value": fib(i % 12)} for i in range(50)]
+        yield tornado.gen.moment
+        self.write({"rows": rows, "total": sum(row["value"] for row in rows)})
+
+
+def fresh_ioloop():
+    """Return a new current IOLoop, so a forked child doesn't share its parent's."""
+    loop = tornado.ioloop.IOLoop()
+    loop.make_current()
+    return loop
+
+
+def serve(sock, backend):
+    """Run the synthetic app on `sock` until SIGTERM."""
+    loop = fresh_ioloop()
+    routes = [(r"/work", WorkHandler)] + TornadoProfiler(backend=backend).get_routes()
+    server = tornado.httpserver.HTTPServer(tornado.web.Application(routes))
+    server.add_sockets([sock])
+    signal.signal(signal.SIGTERM, lambda *args: loop.add_callback_from_signal(loop.stop))
+    loop.start()
+
+
+@tornado.gen.coroutine
+def run_load(url, requests, concurrency):
+    """Send `requests` GETs to `url`, `concurrency` at a time; return (elapsed, latencies)."""
+    client = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+    latencies = RingBuffer(requests)
+    pending = [requests]
+
+    @tornado.gen.coroutine
+    def worker():
+        while pending[0] > 0:
+            pending[0] -= 1
+            started = time.time()
+            yield client.fetch(url)
+            latencies.append(time.time() - started)
+
+    started = time.time()
+    yield [worker() for _ in range(concurrency)]
+    raise tornado.gen.Return((time.time() - started, latencies))
+
+
+@tornado.gen.coroutine
+def wait_until_up(url, timeout=10):
+    client = tornado.httpclient.AsyncHTTPClient()
+    deadline = time.time() + timeout
+    while True:
+        try:
+            yield client.fetch(url)
+            return
+        except (socket.error, tornado.httpclient.HTTPError):
+            if time.time() > deadline:
+                raise
+            yield tornado.gen.sleep(0.05)
+
+
+def bench_load(name, backend, query, requests, concurrency, warmup):
+    """Return the throughput and latency of the synthetic app under `backend`."""
+    sock, = tornado.netutil.bind_sockets(0, "127.0.0.1", family=socket.AF_INET)
+    base = "http://127.0.0.1:%d" % sock.getsockname()[1]
+    server = multiprocessing.Process(target=serve, args=(sock, backend))
+    server.start()
+    sock.close()
+    loop = tornado.ioloop.IOLoop.current()
+    try:
+        loop.run_sync(lambda: wait_until_up(base + "/work"))
+        if query is not None:
+            loop.run_sync(lambda: tornado.httpclient.AsyncHTTPClient().fetch(
+                base + "/profiler?" + query, method="POST", body=""))
+        loop.run_sync(lambda: run_load(base + "/work", warmup, concurrency))
+        elapsed, latencies = loop.run_sync(
+            lambda: run_load(base + "/work", requests, concurrency))
+    finally:
+        server.terminate()
+        server.join()
+    values = latencies.values()
+    return {
+        "backend": name,
+        "requests": requests,
+        "concurrency": concurrency,
+        "elapsed": elapsed,
+        "throughput": requests / elapsed,
+        "latency": dict(zip(("p50", "p95", "p99"), latencies.percentiles(*QUANTILES)),
+                        mean=sum(values) / len(values), max=max(values)),
+    }
+
+
+def make_functions(count):
+    """Return `count` distinct functions compiled from one generated module."""
+    namespace = {}
+    source = "".join("def func_%d():\n    return %d\n" % (i, i) for i in range(count))
+    exec(compile(source, "<generated_%d>" % count, "exec"), namespace)
+    return [namespace["func_%d" % i] for i in range(count)]
+
+
+@tornado.gen.coroutine
+def fetch_stats(url, repeat):
+    client = tornado.httpclient.AsyncHTTPClient()
+    durations = []
+    for _ in range(repeat):
+        started = time.time()
+        response = yield client.fetch(url)
+        durations.append(time.time() - started)
+    raise tornado.gen.Return((durations, response))
+
+
+def bench_stats(size, repeat):
+    """Return the latency and memory of /profiler/stats over `size` profiled functions.
+
+    Runs in a child process so every size starts from a clean yappi and heap.
+    """
+    loop = fresh_ioloop()
+    functions = make_functions(size)
+    yappi.clear_stats()
+    tornado_profile.start_profiling()
+    for func in functions:
+        func()
+    tornado_profile.stop_profiling()
+
+    app = tornado.web.Application(TornadoProfiler().get_routes())
+    sock, = tornado.netutil.bind_sockets(0, "127.0.0.1", family=socket.AF_INET)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets([sock])
+    url = "http://127.0.0.1:%d/profiler/stats?count=20" % sock.getsockname()[1]
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if tracemalloc is not None:
+        tracemalloc.start()
+    (cold,), response = loop.run_sync(lambda: fetch_stats(url, 1))
+    peak_memory = tracemalloc.get_traced_memory()[1] if tracemalloc is not None else None
+    if tracemalloc is not None:
+        tracemalloc.stop()
+    warm, _ = loop.run_sync(lambda: fetch_stats(url, repeat))
+    server.stop()
+    assert len(json.loads(response.body)["statistics"]) == 20
+    return {
+        "functions": size,
+        "cold": cold,
+        "warm": sorted(warm)[len(warm) // 2],
+        "peak_memory": peak_memory,
+        # kilobytes on Linux, bytes on macOS
+        "max_rss_growth": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss,
+    }
+
+
+def _bench_stats_child(size, repeat, results):
+    results.put(bench_stats(size, repeat))
+
+
+def in_child(target, *args):
+    """Return the result of `target(*args)` run in a child process."""
+    results = multiprocessing.Queue()
+    child = multiprocessing.Process(target=target, args=args + (results,))
+    child.start()
+    result = results.get()
+    child.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--backends", default=",".join(name for name, _, _ in BACKENDS),
+                        help="comma separated backends to load test, 'off' is the baseline")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=200)
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="comma separated numbers of profiled functions for the stats benchmark")
+    parser.add_argument("--repeat", type=int, default=5, help="warm stats requests per size")
+    parser.add_argument("--output", help="write the JSON here instead of to stdout")
+    args = parser.parse_args(argv)
+
+    names = [name for name in args.backends.split(",") if name]
+    unknown = set(names) - set(name for name, _, _ in BACKENDS)
+    if unknown:
+        parser.error("unknown backends: %s" % ", ".join(sorted(unknown)))
+    if tracemalloc is None and "tracemalloc" in names:
+        names.remove("tracemalloc")
+
+    load = []
+    for name, backend, query in BACKENDS:
+        if name in names:
+            sys.stderr.write("load: %s\n" % name)
+            load.append(bench_load(name, backend, query, args.requests, args.concurrency,
+                                   args.warmup))
+    baseline = next((result for result in load if result["backend"] == "off"), None)
+    for result in load:
+        if baseline is not None:
+            result["overhead"] = 1 - result["throughput"] / baseline["throughput"]
+
+    stats = []
+    for size in [int(size) for size in args.sizes.split(",") if size]:
+        sys.stderr.write("stats: %d functions\n" % size)
+        stats.append(in_child(_bench_stats_child, size, args.repeat))
+
+    results = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "tornado": tornado.version,
+        "yappi": getattr(yappi, "__version__", None),
+        "load": load,
+        "stats": stats,
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -28,13 +28,15 @@ setup(
     url="https://github.com/makearl/tornado-profile",
     py_modules=["tornado_profile"],
     setup_requires=['pytest-runner'],
-    install_requires=["tornado", "yappi"],
-    tests_require=["pytest", "mock", "coverage"],
+    install_requires=["tornado>=5.0", 'futures; python_version < "3"'],
+    extras_require={'yappi': ['yappi']},
+    tests_require=["pytest", "mock", "coverage", "yappi"],
     description="Profile a Tornado application via REST",
     long_description=open("README.rst").read(),
     license="MIT",
     classifiers=[
         "Programming Language :: Python :: 2",
+        "Programming Language :: Python :: 3",
         "Intended Audience :: Developers",
         "License :: OSI Approved :: MIT License",
         "Topic :: Utilities",
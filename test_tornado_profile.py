@@ -1,8 +1,27 @@
+import gzip
+import io
 import json
+import marshal
 import mock
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tornado.gen
+import tornado.httpclient
 import tornado.web
+import tornado_profile
+import unittest
+import yappi
+from concurrent.futures import ThreadPoolExecutor
 from tornado.testing import AsyncHTTPTestCase
-from tornado_profile import TornadoProfiler
+from tornado_profile import (FuncStat, Histogram, NoStatsAvailableError, ProfilerCluster,
+                             RingBuffer, SamplingProfiler, StatsEngine, TornadoProfiler,
+                             WallClockProfiler, WindowStore, parse_window_selection)
 
 
 class TornadoProfilerTestCase(AsyncHTTPTestCase):
@@ -211,3 +230,1485 @@ class TornadoProfilerTestCase(AsyncHTTPTestCase):
     def test_delete_profiler_stats_clears_profiler_stats(self, mock_clear_stats):
         self.fetch("/profiler/stats", method="DELETE")
         assert mock_clear_stats.mock_calls == [mock.call()]
+
+    @mock.patch('tornado_profile.get_profiler_statistics', autospec=True)
+    def test_get_profiler_stats_builds_statistics_off_the_ioloop_thread(self, mock_get_statistics):
+        threads = []
+        mock_get_statistics.side_effect = lambda *args: threads.append(threading.current_thread()) or []
+        result = self.fetch("/profiler/stats", method="GET")
+        assert result.code == 200
+        assert threads and threads[0] is not threading.current_thread()
+
+
+class TornadoProfilerExecutorTestCase(AsyncHTTPTestCase):
+    def setUp(self):
+        self.executor = mock.Mock(wraps=ThreadPoolExecutor(max_workers=1))
+        super(TornadoProfilerExecutorTestCase, self).setUp()
+
+    def get_app(self):
+        routes = [] + TornadoProfiler(executor=self.executor).get_routes()
+        return tornado.web.Application(routes)
+
+    @mock.patch('tornado_profile.get_profiler_statistics', autospec=True)
+    def test_get_profiler_stats_uses_configured_executor(self, mock_get_statistics):
+        mock_get_statistics.return_value = []
+        result = self.fetch("/profiler/stats", method="GET")
+        assert json.loads(result.body) == {'statistics': []}
+        assert len(self.executor.submit.mock_calls) == 1
+
+
+class StatsEngineTestCase(unittest.TestCase):
+    def setUp(self):
+        self.stats = [FuncStat('/app/handlers.py', 10, 'get', 4, 4, 0.5, 2.0),
+                      FuncStat('/app/models.py', 20, 'load', 8, 8, 1.0, 1.5),
+                      FuncStat('/app/util.py', 30, 'fmt', 100, 100, 0.25, 0.25)]
+
+    def test_top_returns_largest_rows_in_order(self):
+        engine = StatsEngine()
+        engine.update(self.stats)
+        assert [row['func_name'] for row in engine.top('cum_time', 2)] == ['get', 'load']
+        assert [row['func_name'] for row in engine.top('num_calls', None)] == ['fmt', 'load', 'get']
+
+    def test_update_without_changes_keeps_version(self):
+        engine = StatsEngine()
+        version = engine.update(self.stats)
+        assert engine.update(list(self.stats)) == version
+
+    def test_update_only_rebuilds_changed_rows(self):
+        engine = StatsEngine()
+        version = engine.update(self.stats)
+        unchanged_row = engine.top('num_calls', 1)[0]
+        self.stats[0] = self.stats[0]._replace(ncall=5, nactualcall=5, ttot=3.0)
+        assert engine.update(self.stats) == version + 1
+        assert engine.top('cum_time', 1)[0]['cum_time'] == 3.0
+        assert engine.top('num_calls', 1)[0] is unchanged_row
+
+    def test_strip_dirs_merges_functions_from_different_directories(self):
+        engine = StatsEngine(strip_dirs=True)
+        engine.update([FuncStat('/a/util.py', 30, 'fmt', 1, 1, 0.25, 0.5),
+                       FuncStat('/b/util.py', 30, 'fmt', 2, 2, 0.5, 1.0)])
+        row = engine.top('cum_time', None)
+        assert len(row) == 1
+        assert (row[0]['path'], row[0]['num_calls'], row[0]['cum_time']) == ('util.py', 3, 1.5)
+
+    def test_removed_functions_are_dropped(self):
+        engine = StatsEngine()
+        engine.update(self.stats)
+        engine.update([])
+        self.assertRaises(NoStatsAvailableError, engine.top)
+
+
+class SamplingProfilerTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.profiler = TornadoProfiler(backend='sampling', sample_interval=0.001)
+        routes = [] + self.profiler.get_routes()
+        return tornado.web.Application(routes)
+
+    def tearDown(self):
+        self.profiler.sampling_profiler.stop()
+        super(SamplingProfilerTestCase, self).tearDown()
+
+    def test_post_profiler_starts_sampling_thread(self):
+        result = self.fetch("/profiler", method="POST", body="")
+        assert result.code == 201
+        result = self.fetch("/profiler", method="GET")
+        assert json.loads(result.body)['running'] is True
+
+    def test_delete_profiler_stops_sampling_thread(self):
+        self.fetch("/profiler", method="POST", body="")
+        result = self.fetch("/profiler", method="DELETE")
+        assert result.code == 204
+        assert self.profiler.sampling_profiler.is_running() is False
+
+    def test_get_profiler_stats_when_no_samples_returns_404_status_code(self):
+        result = self.fetch("/profiler/stats", method="GET")
+        assert result.code == 404
+
+    def test_get_profiler_stats_returns_sampled_functions(self):
+        sampler = self.profiler.sampling_profiler
+        sampler._target = threading.current_thread().ident
+        sampler._sample(0.25)
+        result = self.fetch("/profiler/stats?count=0", method="GET")
+        statistics = json.loads(result.body)['statistics']
+        row = [row for row in statistics
+               if row['func_name'] == 'test_get_profiler_stats_returns_sampled_functions'][0]
+        assert (row['num_calls'], row['cum_time'], row['total_time']) == (1, 0.25, 0)
+
+    def test_sampled_thread_is_charged_total_time(self):
+        sampler = SamplingProfiler(interval=0.001)
+        sampler._target = threading.current_thread().ident
+        sampler._sample(0.5)
+        top = sampler.get_statistics('total_time', 1)[0]
+        assert (top['func_name'], top['total_time']) == ('_sample', 0.5)
+        assert sampler.samples == 1
+
+
+class HelloHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write(hello())
+
+
+def hello():
+    return "Hello"
+
+
+class RouteProfilerTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        profiler = TornadoProfiler()
+        routes = [(r"/hello", HelloHandler)] + profiler.get_routes()
+        return profiler.instrument(tornado.web.Application(routes))
+
+    def tearDown(self):
+        yappi.stop()
+        yappi.clear_stats()
+        yappi.set_tag_callback(None)
+        super(RouteProfilerTestCase, self).tearDown()
+
+    def test_instrumented_handler_still_responds(self):
+        result = self.fetch("/hello")
+        assert (result.code, result.body) == (200, b"Hello")
+
+    def test_get_profiler_routes_returns_request_count_and_latency(self):
+        for _ in range(3):
+            self.fetch("/hello")
+        result = self.fetch("/profiler/routes")
+        routes = json.loads(result.body)['routes']
+        assert [(route['route'], route['method'], route['count']) for route in routes] == [('/hello', 'GET', 3)]
+        assert 0 < routes[0]['p50'] <= routes[0]['p95'] <= routes[0]['p99']
+
+    def test_get_profiler_routes_does_not_count_profiler_requests(self):
+        self.fetch("/profiler")
+        result = self.fetch("/profiler/routes")
+        assert json.loads(result.body) == {'routes': []}
+
+    def test_get_profiler_stats_with_route_only_returns_functions_of_that_route(self):
+        self.fetch("/profiler", method="POST", body="")
+        self.fetch("/hello")
+        self.fetch("/profiler", method="DELETE")
+        result = self.fetch("/profiler/stats?route=/hello&count=0")
+        func_names = set(row['func_name'] for row in json.loads(result.body)['statistics'])
+        assert 'hello' in func_names
+        assert 'post' not in func_names
+
+    def test_get_profiler_stats_with_unknown_route_returns_400_status_code(self):
+        result = self.fetch("/profiler/stats?route=/nope")
+        assert result.code == 400
+        assert json.loads(result.body) == {'error': "Unknown `route` '/nope'."}
+
+
+class WallClockProfilerTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        routes = [] + TornadoProfiler().get_routes()
+        return tornado.web.Application(routes)
+
+    def tearDown(self):
+        tornado_profile.stop_profiling()
+        tornado_profile.clear_stats()
+        tornado_profile._clock_type = 'cpu'
+        super(WallClockProfilerTestCase, self).tearDown()
+
+    @mock.patch('yappi.start', autospec=True)
+    def test_post_profiler_with_wall_clock_does_not_start_yappi(self, mock_start):
+        result = self.fetch("/profiler?clock=wall", method="POST", body="")
+        assert result.code == 201
+        assert mock_start.mock_calls == []
+        assert json.loads(self.fetch("/profiler").body) == {'running': True}
+
+    def test_post_profiler_with_invalid_clock_returns_400_status_code(self):
+        result = self.fetch("/profiler?clock=gpu", method="POST", body="")
+        assert result.code == 400
+        assert json.loads(result.body) == {'error': "Invalid `clock` 'gpu', must be in ('cpu', 'wall')."}
+
+    def test_get_profiler_stats_with_wall_clock_has_cpu_and_wait_time(self):
+        self.fetch("/profiler?clock=wall", method="POST", body="")
+        self.fetch("/profiler", method="DELETE")
+        result = self.fetch("/profiler/stats?sort=wait_time", method="GET")
+        statistics = json.loads(result.body)["statistics"]
+        assert {"cpu_time", "wait_time"} <= set(statistics[0].keys())
+
+    def test_export_with_wall_clock_returns_400_status_code(self):
+        self.fetch("/profiler?clock=wall", method="POST", body="")
+        self.fetch("/profiler", method="DELETE")
+        result = self.fetch("/profiler/stats/export")
+        assert result.code == 400
+        assert "'wall' clock doesn't record callers" in json.loads(result.body)["error"]
+
+    def test_callgraph_with_wall_clock_returns_400_status_code(self):
+        self.fetch("/profiler?clock=wall", method="POST", body="")
+        self.fetch("/profiler", method="DELETE")
+        result = self.fetch("/profiler/callgraph?func=get")
+        assert result.code == 400
+        assert "'wall' clock doesn't record callers" in json.loads(result.body)["error"]
+
+    def test_suspended_generator_is_stitched_into_one_call(self):
+        def generator():
+            yield
+            yield
+
+        profiler = WallClockProfiler()
+        profiler.start()
+        frames = generator()
+        next(frames)
+        time.sleep(0.05)
+        next(frames)
+        list(frames)
+        profiler.stop()
+
+        stats = [stat for stat in profiler.get_func_stats() if stat.name == 'generator'][0]
+        assert stats.ncall == 1
+        assert stats.ttot >= 0.05
+        assert stats.wait_time >= 0.04
+        assert stats.cpu_time < 0.01
+
+    def test_collect_stats_from_another_thread_loses_no_calls(self):
+        def work():
+            return sum(range(10))
+
+        profiler = WallClockProfiler()
+        collected = []
+        done = threading.Event()
+
+        def collect():
+            while not done.is_set():
+                collected.extend(profiler.collect_stats())
+
+        collector = threading.Thread(target=collect)
+        profiler.start()
+        collector.start()
+        for _ in range(2000):
+            work()
+        done.set()
+        collector.join()
+        profiler.stop()
+        collected.extend(profiler.collect_stats())
+        assert sum(stat.ncall for stat in collected if stat.name == 'work') == 2000
+
+
+class IOLoopMonitorTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.profiler = TornadoProfiler(lag_interval=0.01, slow_callback_threshold=0.05)
+        routes = [] + self.profiler.get_routes()
+        return tornado.web.Application(routes)
+
+    def tearDown(self):
+        self.profiler.ioloop_monitor.stop()
+        super(IOLoopMonitorTestCase, self).tearDown()
+
+    def test_post_profiler_ioloop_starts_monitor(self):
+        result = self.fetch("/profiler/ioloop", method="POST", body="")
+        assert result.code == 201
+        assert json.loads(self.fetch("/profiler/ioloop").body)["running"] is True
+
+    def test_delete_profiler_ioloop_stops_monitor(self):
+        self.fetch("/profiler/ioloop", method="POST", body="")
+        result = self.fetch("/profiler/ioloop", method="DELETE")
+        assert result.code == 204
+        assert json.loads(self.fetch("/profiler/ioloop").body)["running"] is False
+
+    def test_blocking_callback_is_measured_and_its_stack_captured(self):
+        def block():
+            time.sleep(0.15)
+
+        self.fetch("/profiler/ioloop", method="POST", body="")
+        self.io_loop.add_callback(block)
+        self.io_loop.call_later(0.1, self.stop)
+        self.wait()
+
+        ioloop = json.loads(self.fetch("/profiler/ioloop").body)
+        assert ioloop["lag"]["max"] >= 0.1
+        assert ioloop["callbacks"]["count"] > 0
+        assert len(ioloop["slow_callbacks"]) == 1
+        assert ioloop["slow_callbacks"][0]["duration"] >= 0.15
+        assert ioloop["slow_callbacks"][0]["stack"][-1].endswith(" in block")
+
+
+class RingBufferTestCase(unittest.TestCase):
+    def test_ring_keeps_most_recent_values(self):
+        ring = RingBuffer(3)
+        for value in range(5):
+            ring.append(float(value))
+        assert sorted(ring.values()) == [2.0, 3.0, 4.0]
+        assert (ring.count, ring.last()) == (5, 4.0)
+        assert ring.percentiles(0.5, 1.0) == [3.0, 4.0]
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram(smallest=0.001, buckets=2)
+        for duration in (0.0005, 0.0015, 0.5):
+            histogram.add(duration)
+        assert histogram.to_dict()["buckets"] == [[0.001, 1], [0.002, 2], ["+Inf", 3]]
+
+
+class StreamingStatsTestCase(AsyncHTTPTestCase):
+    rows = [{'func_name': 'a', 'cum_time': 3}, {'func_name': 'b', 'cum_time': 2},
+            {'func_name': 'c', 'cum_time': 1}]
+
+    def get_app(self):
+        routes = [] + TornadoProfiler().get_routes()
+        return tornado.web.Application(routes)
+
+    @mock.patch('tornado_profile.get_profiler_statistics', autospec=True)
+    def test_get_profiler_stats_streamed_as_json_matches_unstreamed_result(self, mock_get_statistics):
+        mock_get_statistics.return_value = self.rows
+        result = self.fetch("/profiler/stats?stream=json&chunk_size=2", method="GET")
+        assert result.code == 200
+        assert json.loads(result.body) == json.loads(self.fetch("/profiler/stats").body)
+
+    @mock.patch('tornado_profile.get_profiler_statistics', autospec=True)
+    def test_get_profiler_stats_streamed_as_ndjson_returns_one_row_per_line(self, mock_get_statistics):
+        mock_get_statistics.return_value = self.rows
+        result = self.fetch("/profiler/stats?stream=ndjson&chunk_size=2", method="GET")
+        assert result.headers['Content-Type'] == 'application/x-ndjson'
+        assert [json.loads(line) for line in result.body.decode().splitlines()] == self.rows
+
+    @mock.patch('tornado_profile.get_profiler_statistics', autospec=True)
+    def test_get_profiler_stats_streamed_with_no_rows_returns_empty_statistics(self, mock_get_statistics):
+        mock_get_statistics.return_value = []
+        result = self.fetch("/profiler/stats?stream=json", method="GET")
+        assert json.loads(result.body) == {'statistics': []}
+
+    def test_get_profiler_stats_with_invalid_stream_returns_400_status_code(self):
+        result = self.fetch("/profiler/stats?stream=xml", method="GET")
+        assert result.code == 400
+        assert json.loads(result.body) == {'error': "Invalid `stream` 'xml', must be in ('json', 'ndjson')."}
+
+    def test_get_profiler_stats_with_invalid_chunk_size_returns_400_status_code(self):
+        result = self.fetch("/profiler/stats?stream=json&chunk_size=0", method="GET")
+        assert result.code == 400
+
+
+class CProfileStreamingStatsTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        routes = [] + TornadoProfiler(backend='cprofile').get_routes()
+        return tornado.web.Application(routes)
+
+    def test_get_profiler_stats_streamed_as_ndjson_returns_rows(self):
+        self.fetch("/profiler", method="POST", body="")
+        self.fetch("/profiler", method="DELETE")
+        result = self.fetch("/profiler/stats?stream=ndjson&chunk_size=1", method="GET")
+        rows = [json.loads(line) for line in result.body.decode().splitlines()]
+        assert rows
+        assert set(rows[0].keys()) == {"path", "line", "func_name", "num_calls", "total_time",
+                                       "total_time_per_call", "cum_time", "cum_time_per_call"}
+
+
+def decode_varints(data):
+    """Return the varints packed in `data`."""
+    values = []
+    value = shift = 0
+    for byte in bytearray(data):
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def decode_protobuf(data):
+    """Return {field number: [values]} of a protobuf message, enough to check pprof output."""
+    fields = {}
+    data = bytearray(data)
+    i = 0
+    while i < len(data):
+        key = decode_varints(data[i:i + 10])[0]
+        i += len(_varint_prefix(data, i))
+        if key & 7 == 2:
+            length = decode_varints(data[i:i + 10])[0]
+            i += len(_varint_prefix(data, i))
+            fields.setdefault(key >> 3, []).append(bytes(data[i:i + length]))
+            i += length
+        else:
+            fields.setdefault(key >> 3, []).append(decode_varints(data[i:i + 10])[0])
+            i += len(_varint_prefix(data, i))
+    return fields
+
+
+def _varint_prefix(data, i):
+    end = i
+    while data[end] & 0x80:
+        end += 1
+    return data[i:end + 1]
+
+
+class ProfileExportTestCase(AsyncHTTPTestCase):
+    backend = 'yappi'
+
+    def get_app(self):
+        self.profiler = TornadoProfiler(backend=self.backend)
+        routes = [] + self.profiler.get_routes()
+        return tornado.web.Application(routes)
+
+    def profile(self):
+        self.fetch("/profiler", method="POST", body="")
+        self.fetch("/profiler/stats", method="GET")
+        self.fetch("/profiler", method="DELETE")
+
+    def export(self, export_format):
+        result = self.fetch("/profiler/stats/export?format=%s" % export_format)
+        assert result.code == 200
+        assert result.headers['Content-Type'] == 'application/gzip'
+        return gzip.GzipFile(fileobj=io.BytesIO(result.body)).read()
+
+    def test_export_pstats_returns_marshalled_pstats_dictionary(self):
+        self.profile()
+        stats = marshal.loads(self.export('pstats'))
+        path, line, func_name = list(stats.keys())[0]
+        assert len(stats[(path, line, func_name)]) == 5
+
+    def test_export_collapsed_returns_weighted_stacks(self):
+        self.profile()
+        lines = self.export('collapsed').decode('utf-8').splitlines()
+        assert lines
+        for line in lines:
+            stack, weight = line.rsplit(' ', 1)
+            assert stack and int(weight) > 0
+
+    def test_export_only_includes_functions_matching_the_collection_filter(self):
+        if self.backend != 'yappi':
+            self.skipTest("only yappi applies the filter of POST /profiler to exports")
+        self.fetch("/profiler?exclude=tornado", method="POST", body="")
+        self.fetch("/profiler/stats", method="GET")
+        self.fetch("/profiler", method="DELETE")
+        stats = marshal.loads(self.export('pstats'))
+        assert stats
+        assert not any("tornado" in path for path, line, func_name in stats)
+
+    def test_export_with_invalid_format_returns_400_status_code(self):
+        result = self.fetch("/profiler/stats/export?format=svg")
+        assert result.code == 400
+        assert json.loads(result.body) == {
+            'error': "Invalid `format` 'svg', must be in ('pstats', 'collapsed', 'pprof')."}
+
+
+class CProfileExportTestCase(ProfileExportTestCase):
+    backend = 'cprofile'
+
+
+class SamplingProfileExportTestCase(ProfileExportTestCase):
+    backend = 'sampling'
+
+    def profile(self):
+        sampler = self.profiler.sampling_profiler
+        sampler._target = threading.current_thread().ident
+        sampler._sample(0.25)
+
+    def test_export_when_no_samples_returns_404_status_code(self):
+        result = self.fetch("/profiler/stats/export?format=pprof")
+        assert result.code == 404
+
+    def test_export_pprof_returns_profile_with_sampled_functions(self):
+        self.profile()
+        profile = decode_protobuf(self.export('pprof'))
+        strings = [value.decode('utf-8') for value in profile[6]]
+        assert strings[0] == ''
+        sample_type = decode_protobuf(profile[1][0])
+        assert (strings[sample_type[1][0]], strings[sample_type[2][0]]) == ('samples', 'count')
+        sample = decode_protobuf(profile[2][0])
+        assert decode_varints(sample[2][0]) == [1, 250000000]
+        function_names = [strings[decode_protobuf(function)[2][0]] for function in profile[5]]
+        stack = [function_names[i - 1] for i in decode_varints(sample[1][0])]
+        assert stack[:2] == ['_sample', 'profile']
+
+
+class CallGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        main, parse, read = ("app.py", 1, "main"), ("app.py", 10, "parse"), ("io.py", 5, "read")
+        self.graph = tornado_profile.CallGraph({
+            main: (1, 1, 0.1, 1.0, {}),
+            parse: (2, 2, 0.3, 0.6, {main: (2, 2, 0.3, 0.6)}),
+            read: (3, 3, 0.3, 0.3, {parse: (2, 2, 0.2, 0.2), main: (1, 1, 0.1, 0.1)}),
+        })
+
+    def test_find_matches_function_name_and_location(self):
+        parse = self.graph.find("parse")
+        assert len(parse) == 1
+        assert self.graph.find("app.py:10") == parse
+        assert self.graph.find("app.py:10(parse)") == parse
+        assert self.graph.find("missing") == []
+
+    def test_subgraph_distributes_time_along_edges(self):
+        subgraph = self.graph.subgraph(self.graph.find("read"), depth=1)
+        names = dict((row["id"], row["func_name"]) for row in subgraph["functions"])
+        assert sorted(names.values()) == ["main", "parse", "read"]
+        edges = dict(((names[edge["caller"]], names[edge["callee"]]), edge["cum_time"])
+                     for edge in subgraph["edges"])
+        assert edges == {("parse", "read"): 0.2, ("main", "read"): 0.1}
+
+    def test_subgraph_depth_limits_walk(self):
+        subgraph = self.graph.subgraph(self.graph.find("parse"), depth=0)
+        assert [row["func_name"] for row in subgraph["functions"]] == ["parse"]
+        assert subgraph["edges"] == []
+
+
+class CallGraphHandlerTestCase(AsyncHTTPTestCase):
+    backend = 'yappi'
+    func = 'YappiProfileStatsHandler.get'
+
+    def get_app(self):
+        self.profiler = TornadoProfiler(backend=self.backend)
+        routes = [] + self.profiler.get_routes()
+        return tornado.web.Application(routes)
+
+    def tearDown(self):
+        tornado_profile.stop_profiling()
+        tornado_profile.clear_stats()
+        super(CallGraphHandlerTestCase, self).tearDown()
+
+    def profile(self):
+        self.fetch("/profiler", method="POST", body="")
+        self.fetch("/profiler/stats", method="GET")
+        self.fetch("/profiler", method="DELETE")
+
+    def test_callgraph_returns_callers_and_callees(self):
+        self.profile()
+        result = self.fetch("/profiler/callgraph?func=%s&depth=1" % self.func)
+        assert result.code == 200
+        graph = json.loads(result.body)
+        assert graph["matches"] and graph["edges"]
+        ids = set(row["id"] for row in graph["functions"])
+        assert set(graph["matches"]) <= ids
+        for edge in graph["edges"]:
+            assert edge["caller"] in ids and edge["callee"] in ids
+
+    def test_callgraph_without_func_returns_400_status_code(self):
+        result = self.fetch("/profiler/callgraph?depth=x")
+        assert result.code == 400
+        assert json.loads(result.body) == {'error': "Missing `func`.Can't cast `depth` 'x' to int."}
+
+    def test_callgraph_only_includes_functions_matching_the_collection_filter(self):
+        if self.backend != 'yappi':
+            self.skipTest("only yappi applies the filter of POST /profiler to call graphs")
+        self.fetch("/profiler?exclude=site-packages", method="POST", body="")
+        self.fetch("/profiler/stats", method="GET")
+        self.fetch("/profiler", method="DELETE")
+        result = self.fetch("/profiler/callgraph?func=%s&depth=2&strip_dirs=false" % self.func)
+        assert result.code == 200
+        paths = [row["path"] for row in json.loads(result.body)["functions"]]
+        assert not any("site-packages" in path for path in paths)
+
+    def test_callgraph_with_unknown_func_returns_404_status_code(self):
+        self.profile()
+        result = self.fetch("/profiler/callgraph?func=no_such_function")
+        assert result.code == 404
+
+
+class SamplingCallGraphHandlerTestCase(CallGraphHandlerTestCase):
+    backend = 'sampling'
+    func = 'profile'
+
+    def profile(self):
+        sampler = self.profiler.sampling_profiler
+        sampler._target = threading.current_thread().ident
+        sampler._sample(0.25)
+
+    def test_callgraph_is_rebuilt_after_new_samples(self):
+        self.profile()
+        sampler = self.profiler.sampling_profiler
+        graph = sampler.get_call_graph()
+        assert sampler.get_call_graph() is graph
+        self.profile()
+        assert sampler.get_call_graph() is not graph
+
+
+class SiblingCluster(ProfilerCluster):
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, "%d-0.sock" % os.getppid())
+
+
+class ProfilerClusterTestCase(AsyncHTTPTestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        super(ProfilerClusterTestCase, self).setUp()
+        self.sibling = SiblingCluster(self.directory)
+        self.sibling.listen()
+
+    def tearDown(self):
+        tornado_profile.stop_profiling()
+        tornado_profile.clear_stats()
+        self.sibling.close()
+        self.profiler.cluster.close()
+        super(ProfilerClusterTestCase, self).tearDown()
+        shutil.rmtree(self.directory)
+
+    def get_app(self):
+        self.profiler = TornadoProfiler(cluster_dir=self.directory)
+        routes = [] + self.profiler.get_routes()
+        return tornado.web.Application(routes)
+
+    def test_profiler_commands_reach_sibling_workers(self):
+        with mock.patch.object(self.sibling, 'handle', wraps=self.sibling.handle) as handle:
+            self.fetch("/profiler?clock=cpu", method="POST", body="")
+            result = self.fetch("/profiler")
+            self.fetch("/profiler", method="DELETE")
+            self.fetch("/profiler/stats", method="DELETE")
+        assert json.loads(result.body) == {"running": True, "workers": 2, "running_workers": 2}
+        assert handle.mock_calls == [mock.call('start', 'cpu', False), mock.call('running'),
+                                     mock.call('stop'), mock.call('clear')]
+
+    def test_get_stats_merges_sibling_statistics(self):
+        self.fetch("/profiler", method="POST", body="")
+        self.fetch("/profiler")
+        self.fetch("/profiler", method="DELETE")
+        local = dict(((row['path'], row['line'], row['func_name']), row['num_calls'])
+                     for row in tornado_profile.get_profiler_statistics('num_calls', None))
+        result = self.fetch("/profiler/stats?count=0")
+        assert result.code == 200
+        merged = json.loads(result.body)['statistics']
+        assert merged
+        for row in merged:
+            assert row['num_calls'] == 2 * local[(row['path'], row['line'], row['func_name'])]
+
+    def test_get_stats_resolves_route_tags_in_each_worker(self):
+        self.profiler.route_profiler.get("/a", "GET")
+        self.profiler.route_profiler.get("/b", "GET")
+        self.sibling.route_profiler = tornado_profile.RouteProfiler()
+        self.sibling.route_profiler.get("/b", "GET")
+        self.sibling.route_profiler.get("/a", "GET")
+        self.fetch("/profiler", method="POST", body="")
+        get_func_stats = tornado_profile._get_func_stats
+        with mock.patch.object(self.sibling, 'handle', wraps=self.sibling.handle) as handle, \
+                mock.patch('tornado_profile._get_func_stats', wraps=get_func_stats) as get:
+            self.fetch("/profiler/stats?route=/a")
+        assert handle.mock_calls == [mock.call('stats', '/a', None)]
+        assert mock.call((2,)) in get.mock_calls  # the sibling's tag of /a
+        assert mock.call((1,)) in get.mock_calls  # this worker's tag of /a
+
+    def test_broadcast_forgets_exited_workers(self):
+        path = os.path.join(self.directory, "%d-1.sock" % os.getppid())
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.close()
+        responses = self.io_loop.run_sync(lambda: self.profiler.cluster.broadcast('running'))
+        assert responses == [False]
+        assert not os.path.exists(path)
+
+    def test_cluster_requires_yappi_backend(self):
+        with self.assertRaises(ValueError):
+            TornadoProfiler(backend='sampling', cluster_dir=self.directory)
+
+
+CLUSTER_WORKER = """
+import sys
+import tornado.gen
+import tornado.httpserver
+import tornado.ioloop
+import tornado.netutil
+import tornado.web
+import tornado_profile
+
+
+def work():
+    return sum(range(100))
+
+
+@tornado.gen.coroutine
+def main(directory, calls):
+    profiler = tornado_profile.TornadoProfiler(cluster_dir=directory)
+    sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+    tornado.httpserver.HTTPServer(tornado.web.Application(profiler.get_routes())).add_sockets(sockets)
+    profiler.cluster.listen()
+    tornado_profile.start_profiling()
+    for _ in range(calls):
+        work()
+    tornado_profile.stop_profiling()
+    sys.stdout.write("%d\\n" % sockets[0].getsockname()[1])
+    sys.stdout.flush()
+    yield tornado.gen.sleep(60)
+
+
+tornado.ioloop.IOLoop().run_sync(lambda: main(sys.argv[1], int(sys.argv[2])), timeout=60)
+"""
+
+
+class ProfilerClusterProcessTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def start_worker(self, calls):
+        path = os.path.dirname(os.path.abspath(tornado_profile.__file__))
+        worker = subprocess.Popen([sys.executable, "-c", CLUSTER_WORKER, self.directory, str(calls)],
+                                  env=dict(os.environ, PYTHONPATH=path), stdout=subprocess.PIPE)
+        self.addCleanup(worker.wait)
+        self.addCleanup(worker.kill)
+        port = worker.stdout.readline()
+        worker.stdout.close()
+        assert port, "the cluster worker exited"
+        return int(port)
+
+    def test_get_stats_merges_the_statistics_of_every_worker(self):
+        ports = [self.start_worker(3), self.start_worker(5)]
+        client = tornado.httpclient.HTTPClient()
+        self.addCleanup(client.close)
+        for port in ports:
+            result = client.fetch("http://127.0.0.1:%d/profiler/stats?count=0" % port)
+            calls = [row["num_calls"] for row in json.loads(result.body)["statistics"]
+                     if row["func_name"] == "work"]
+            assert calls == [8]
+
+
+class ProfilingSessionTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.profiler = TornadoProfiler()
+        routes = [(r"/hello", HelloHandler)] + self.profiler.get_routes()
+        return self.profiler.instrument(tornado.web.Application(routes))
+
+    def tearDown(self):
+        self.profiler.triggers.remove()
+        self.profiler.ioloop_monitor.stop()
+        yappi.stop()
+        yappi.clear_stats()
+        yappi.set_tag_callback(None)
+        super(ProfilingSessionTestCase, self).tearDown()
+
+    def wait_for(self, condition, timeout=2.0):
+        deadline = time.time() + timeout
+        while not condition() and time.time() < deadline:
+            self.io_loop.run_sync(lambda: tornado.gen.sleep(0.01))
+        assert condition()
+
+    def test_post_profiler_with_duration_stops_profiler(self):
+        result = self.fetch("/profiler?duration=0.05", method="POST", body="")
+        assert result.code == 201
+        status = json.loads(self.fetch("/profiler").body)
+        assert status["running"] is True
+        assert status["session"]["duration"] == 0.05
+        self.wait_for(lambda: not yappi.is_running())
+        assert json.loads(self.fetch("/profiler").body) == {"running": False}
+
+    def test_post_profiler_with_requests_stops_profiler_after_requests(self):
+        self.fetch("/profiler?requests=2", method="POST", body="")
+        self.fetch("/hello")
+        assert json.loads(self.fetch("/profiler").body)["session"]["remaining_requests"] == 1
+        self.fetch("/hello")
+        assert not yappi.is_running()
+
+    def test_delete_profiler_cancels_limits(self):
+        self.fetch("/profiler?duration=60", method="POST", body="")
+        self.fetch("/profiler", method="DELETE")
+        assert not self.profiler.session.is_limited()
+
+    def test_post_profiler_with_invalid_limits_returns_400_status_code(self):
+        result = self.fetch("/profiler?duration=-1&requests=x", method="POST", body="")
+        assert result.code == 400
+        assert json.loads(result.body) == {'error': "`duration` must be positive."}
+        assert not yappi.is_running()
+
+    def test_trigger_captures_profile_when_threshold_is_exceeded(self):
+        self.profiler.triggers.interval = 0.01
+        result = self.fetch("/profiler/triggers?metric=p99&threshold=0&duration=0.05",
+                            method="POST", body="")
+        assert result.code == 201
+        assert json.loads(result.body)["state"] == "armed"
+        self.fetch("/hello")
+        self.wait_for(lambda: self.profiler.triggers.triggers[1].capture_count)
+        trigger = json.loads(self.fetch("/profiler/triggers").body)["triggers"][0]
+        assert trigger["state"] == "cooldown"
+        assert trigger["captures"][0]["top_functions"]
+        assert not yappi.is_running()
+
+    def test_trigger_with_invalid_arguments_returns_400_status_code(self):
+        result = self.fetch("/profiler/triggers?metric=cpu&for=x", method="POST", body="")
+        assert result.code == 400
+        assert json.loads(result.body) == {'error': "Missing `threshold`.Can't cast `for` 'x' to float."}
+        result = self.fetch("/profiler/triggers?metric=cpu&threshold=1", method="POST", body="")
+        assert json.loads(result.body) == {'error': "Invalid `metric` 'cpu', must be in ('p99', 'lag')."}
+
+    def test_delete_trigger(self):
+        self.fetch("/profiler/triggers?metric=lag&threshold=1", method="POST", body="")
+        assert self.fetch("/profiler/triggers/1", method="DELETE").code == 204
+        assert self.fetch("/profiler/triggers/1", method="DELETE").code == 404
+        assert json.loads(self.fetch("/profiler/triggers").body) == {"triggers": []}
+
+
+class CProfileTriggersTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.profiler = TornadoProfiler(backend='cprofile')
+        routes = [(r"/hello", HelloHandler)] + self.profiler.get_routes()
+        return self.profiler.instrument(tornado.web.Application(routes))
+
+    def tearDown(self):
+        self.profiler.triggers.remove()
+        self.profiler.stop()
+        super(CProfileTriggersTestCase, self).tearDown()
+
+    def test_trigger_captures_cprofile_session(self):
+        self.profiler.triggers.interval = 0.01
+        result = self.fetch("/profiler/triggers?metric=p99&threshold=0&duration=0.05",
+                            method="POST", body="")
+        assert result.code == 201
+        self.fetch("/hello")
+        deadline = time.time() + 2.0
+        while not self.profiler.triggers.triggers[1].capture_count and time.time() < deadline:
+            self.io_loop.run_sync(lambda: tornado.gen.sleep(0.01))
+        trigger = json.loads(self.fetch("/profiler/triggers").body)["triggers"][0]
+        assert trigger["state"] == "cooldown"
+        assert trigger["captures"][0]["top_functions"]
+        assert not self.profiler.is_running()
+
+
+class WindowStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.store = WindowStore(collect=list, size=2, max_rows=2)
+
+    def test_add_keeps_functions_with_most_cumulative_time(self):
+        window = self.store.add(0, 60, [FuncStat("a.py", 1, "a", 1, 1, 0.1, 0.1),
+                                        FuncStat("b.py", 1, "b", 1, 1, 0.1, 0.3),
+                                        FuncStat("c.py", 1, "c", 1, 1, 0.1, 0.2),
+                                        FuncStat("b.py", 1, "b", 2, 2, 0.1, 0.3)])
+        assert sorted(window.functions) == [("b.py", 1, "b"), ("c.py", 1, "c")]
+        assert window.to_dict() == {"id": 1, "start": 0, "end": 60, "rows": 2, "dropped_rows": 1}
+        assert dict(zip(window.functions, window.num_calls))[("b.py", 1, "b")] == 3
+
+    def test_add_evicts_oldest_window_and_its_functions(self):
+        self.store.add(0, 60, [FuncStat("a.py", 1, "a", 1, 1, 0.1, 0.1)])
+        self.store.add(60, 120, [FuncStat("b.py", 1, "b", 1, 1, 0.1, 0.1)])
+        self.store.add(120, 180, [FuncStat("b.py", 1, "b", 1, 1, 0.1, 0.1)])
+        assert [window.id for window in self.store.select()] == [2, 3]
+        assert list(self.store._functions) == [("b.py", 1, "b")]
+
+    def test_get_statistics_merges_selected_windows(self):
+        self.store.add(0, 60, [FuncStat("a.py", 1, "a", 1, 1, 0.1, 0.1)])
+        self.store.add(60, 120, [FuncStat("a.py", 1, "a", 2, 2, 0.2, 0.2)])
+        assert self.store.get_statistics((None, 1, 2))[0]["num_calls"] == 3
+        assert self.store.get_statistics((90, None, None))[0]["num_calls"] == 2
+        with self.assertRaises(NoStatsAvailableError):
+            self.store.get_statistics((None, 5, 5))
+
+    def test_diff_returns_functions_which_grew_the_most(self):
+        self.store.add(0, 60, [FuncStat("a.py", 1, "a", 1, 1, 0.1, 0.5),
+                               FuncStat("b.py", 1, "b", 1, 1, 0.1, 0.1)])
+        self.store.add(60, 120, [FuncStat("b.py", 1, "b", 1, 1, 0.1, 0.4)])
+        diff = self.store.diff((None, 1, 1), (None, 2, 2), count=None)
+        assert (diff["base"], diff["target"]) == ({"windows": [1, 1], "duration": 60},
+                                                  {"windows": [2, 2], "duration": 60})
+        assert [(row["func_name"], round(row["delta_cum_time"], 6)) for row in diff["statistics"]] == [
+            ("b", 0.3), ("a", -0.5)]
+
+    def test_parse_window_selection(self):
+        assert parse_window_selection() is None
+        assert parse_window_selection(window="3") == (None, 3, 3)
+        assert parse_window_selection(since="100", window="3-5") == (100.0, 3, 5)
+        assert time.time() - 60 <= parse_window_selection(since="-60")[0] <= time.time()
+        with self.assertRaises(ValueError):
+            parse_window_selection(window="last")
+
+
+class RollingProfilerTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.profiler = TornadoProfiler()
+        routes = [(r"/hello", HelloHandler)] + self.profiler.get_routes()
+        return tornado.web.Application(routes)
+
+    def tearDown(self):
+        self.profiler.windows.stop()
+        tornado_profile.stop_profiling()
+        tornado_profile.clear_stats()
+        tornado_profile._clock_type = 'cpu'
+        super(RollingProfilerTestCase, self).tearDown()
+
+    def wait_for_windows(self, count, timeout=2.0):
+        deadline = time.time() + timeout
+        while len(self.profiler.windows.select()) < count and time.time() < deadline:
+            self.fetch("/hello")
+        assert len(self.profiler.windows.select()) >= count
+
+    def test_rolling_profiler_rotates_windows(self):
+        result = self.fetch("/profiler?rolling=0.05", method="POST", body="")
+        assert result.code == 201
+        self.wait_for_windows(2)
+        windows = json.loads(self.fetch("/profiler/windows").body)
+        assert windows["rolling"] is True and windows["memory"] > 0
+        result = self.fetch("/profiler/stats?window=1-2&count=0")
+        assert result.code == 200
+        assert 'hello' in set(row['func_name'] for row in json.loads(result.body)['statistics'])
+        result = self.fetch("/profiler/stats/diff?base=1&target=2&sort=num_calls")
+        assert result.code == 200
+        assert 'delta_num_calls' in json.loads(result.body)['statistics'][0]
+        self.fetch("/profiler", method="DELETE")
+        assert json.loads(self.fetch("/profiler/windows").body)["rolling"] is False
+
+    def test_rolling_profiler_keeps_profiling_the_ioloop_thread(self):
+        result = self.fetch("/profiler?rolling=0.05", method="POST", body="")
+        assert result.code == 201
+        self.wait_for_windows(4)
+        for window in (2, 3):
+            result = self.fetch("/profiler/stats?window=%d&count=0" % window)
+            assert result.code == 200
+            names = set(row['func_name'] for row in json.loads(result.body)['statistics'])
+            assert 'hello' in names, window
+
+    def test_reading_stats_keeps_profiling_the_ioloop_thread(self):
+        def hello_calls():
+            result = self.fetch("/profiler/stats?count=0")
+            assert result.code == 200
+            return sum(row['num_calls'] for row in json.loads(result.body)['statistics']
+                       if row['func_name'] == 'HelloHandler.get')
+
+        assert self.fetch("/profiler", method="POST", body="").code == 201
+        self.fetch("/hello")
+        calls = hello_calls()
+        self.fetch("/hello")
+        assert hello_calls() == calls + 1
+
+    def test_rolling_wall_clock_profiler_keeps_tracing(self):
+        result = self.fetch("/profiler?clock=wall&rolling=0.02", method="POST", body="")
+        assert result.code == 201
+        self.wait_for_windows(3)
+        assert sys.getprofile() is not None
+        self.fetch("/profiler", method="DELETE")
+        names = set(stat.name for window in self.profiler.windows.select()
+                    for stat in window.func_stats())
+        assert 'get' in names
+
+    def test_get_stats_with_invalid_window_returns_400_status_code(self):
+        result = self.fetch("/profiler/stats?window=x")
+        assert result.code == 400
+        assert json.loads(result.body) == {
+            'error': "Invalid `window` 'x', must be an id or a `first-last` range of ids."}
+
+    def test_diff_without_windows_returns_400_status_code(self):
+        result = self.fetch("/profiler/stats/diff")
+        assert result.code == 400
+        assert json.loads(result.body) == {
+            'error': "Missing `base`, fewer than two windows are stored."
+                     "Missing `target`, fewer than two windows are stored."}
+
+    def test_diff_with_unknown_windows_returns_404_status_code(self):
+        result = self.fetch("/profiler/stats/diff?base=1&target=2")
+        assert result.code == 404
+
+
+@unittest.skipIf(tornado_profile.tracemalloc is None, "tracemalloc needs Python 3.4+")
+class TracemallocProfilerTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.profiler = TornadoProfiler(backend='tracemalloc')
+        routes = [] + self.profiler.get_routes()
+        return tornado.web.Application(routes)
+
+    def tearDown(self):
+        tornado_profile.tracemalloc.stop()
+        super(TracemallocProfilerTestCase, self).tearDown()
+
+    def allocate(self):
+        return [bytearray(1000) for _ in range(1000)]
+
+    def test_get_stats_returns_top_allocation_sites(self):
+        self.fetch("/profiler?depth=3", method="POST", body="")
+        allocations = self.allocate()
+        result = self.fetch("/profiler/stats?group_by=traceback&count=1")
+        assert result.code == 200
+        row = json.loads(result.body)['statistics'][0]
+        assert row['path'] == 'test_tornado_profile.py'
+        assert row['count'] >= 1000 and row['size'] >= 1000000
+        assert 1 < len(row['traceback']) <= 3
+        assert json.loads(self.fetch("/profiler").body)['traced_memory'] >= 1000000
+        del allocations
+
+    def test_get_stats_after_stop_uses_last_snapshot(self):
+        self.fetch("/profiler", method="POST", body="")
+        allocations = self.allocate()
+        self.fetch("/profiler", method="DELETE")
+        result = self.fetch("/profiler/stats?sort=count&count=1")
+        assert result.code == 200
+        assert json.loads(result.body)['statistics'][0]['count'] >= 1000
+        del allocations
+
+    def test_diff_returns_growth_since_snapshot(self):
+        self.fetch("/profiler", method="POST", body="")
+        result = self.fetch("/profiler/snapshots", method="POST", body="")
+        assert (result.code, json.loads(result.body)['id']) == (201, 1)
+        allocations = self.allocate()
+        result = self.fetch("/profiler/stats/diff?count=1")
+        assert result.code == 200
+        diff = json.loads(result.body)
+        assert (diff['base'], diff['target']) == (1, None)
+        assert diff['statistics'][0]['size_diff'] >= 1000000
+        del allocations
+
+    def test_snapshots_are_described_without_walking_their_traces(self):
+        self.fetch("/profiler", method="POST", body="")
+        size = json.loads(self.fetch("/profiler/snapshots", method="POST", body="").body)['size']
+        snapshot = self.profiler.tracemalloc_profiler._snapshots[0][2]
+        snapshot.traces = mock.MagicMock()
+        result = self.fetch("/profiler/snapshots")
+        assert not snapshot.traces.__iter__.called
+        assert [snapshot['size'] for snapshot in json.loads(result.body)['snapshots']] == [size]
+
+    def test_diff_without_snapshot_returns_400_status_code(self):
+        result = self.fetch("/profiler/stats/diff")
+        assert result.code == 400
+        assert json.loads(result.body) == {'error': "Missing `base`, no snapshot is stored."}
+
+    def test_get_stats_with_invalid_group_by_returns_400_status_code(self):
+        result = self.fetch("/profiler/stats?group_by=module")
+        assert result.code == 400
+        assert json.loads(result.body) == {
+            'error': "Invalid `group_by` 'module', must be in ('lineno', 'filename', 'traceback')."}
+
+    def test_get_stats_without_traces_returns_404_status_code(self):
+        assert self.fetch("/profiler/stats").code == 404
+
+
+@unittest.skipIf(tornado_profile.tracemalloc is not None, "tracemalloc is available")
+class TracemallocUnavailableTestCase(unittest.TestCase):
+    def test_tracemalloc_backend_needs_python_3(self):
+        with self.assertRaises(ValueError):
+            TornadoProfiler(backend='tracemalloc').get_routes()
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    while time.time() < end:
+        pass
+
+
+class ThreadProfilerTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        return tornado.web.Application(TornadoProfiler().get_routes())
+
+    def tearDown(self):
+        tornado_profile.stop_profiling()
+        tornado_profile.clear_stats()
+        yappi.set_context_name_callback(None)
+        super(ThreadProfilerTestCase, self).tearDown()
+
+    def test_threads_are_profiled_and_filterable(self):
+        result = self.fetch("/profiler?threads=true", method="POST", body="")
+        assert result.code == 201
+        pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="busy-pool")
+        pool.submit(busy, 0.05).result()
+        pool.shutdown()
+        self.fetch("/profiler", method="DELETE")
+
+        threads = json.loads(self.fetch("/profiler/threads").body)["threads"]
+        pool_threads = [thread for thread in threads if thread["name"].startswith("busy-pool")]
+        assert len(pool_threads) == 1
+        assert 0 < pool_threads[0]["utilization"] <= 1
+
+        result = self.fetch("/profiler/stats?count=0&thread=busy-pool")
+        names = {row["func_name"] for row in json.loads(result.body)["statistics"]}
+        assert "busy" in names
+        assert not any(name.startswith("YappiProfilerHandler") for name in names)
+
+        result = self.fetch("/profiler/stats?thread=nope")
+        assert result.code == 400
+        assert json.loads(result.body) == {"error": "Unknown `thread` 'nope'."}
+
+    def test_threads_need_cpu_clock(self):
+        result = self.fetch("/profiler?threads=true&clock=wall", method="POST", body="")
+        assert result.code == 400
+        assert not tornado_profile.is_profiler_running()
+
+
+@unittest.skipIf(tornado_profile._CPROFILE_PROFILES_ALL_THREADS,
+                 "cProfile sees every thread since Python 3.12")
+class CProfileThreadProfilerTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        return tornado.web.Application(TornadoProfiler(backend='cprofile').get_routes())
+
+    def test_threads_get_their_own_profiler(self):
+        self.fetch("/profiler?threads=true", method="POST", body="")
+        thread = threading.Thread(target=busy, args=(0.02,), name="busy-thread")
+        thread.start()
+        thread.join()
+        self.fetch("/profiler", method="DELETE")
+
+        threads = json.loads(self.fetch("/profiler/threads").body)["threads"]
+        assert {"MainThread", "busy-thread"} <= {thread["name"] for thread in threads}
+
+        result = self.fetch("/profiler/stats?thread=busy-thread&stream=json")
+        names = {row["func_name"] for row in json.loads(result.body)["statistics"]}
+        assert "busy" in names
+        assert "post" not in names
+
+
+    def test_profiles_the_same_pool_in_two_sessions(self):
+        def work():
+            return sum(range(100))
+
+        pool = ThreadPoolExecutor(max_workers=2)
+        self.addCleanup(pool.shutdown)
+        for _ in range(2):
+            self.fetch("/profiler?threads=true", method="POST", body="")
+            for future in [pool.submit(work) for _ in range(10)]:
+                future.result()
+            self.fetch("/profiler", method="DELETE")
+            result = self.fetch("/profiler/stats?count=0&stream=json")
+            calls = sum(row["num_calls"] for row in json.loads(result.body)["statistics"]
+                        if row["func_name"] == "work")
+            assert calls == 10
+
+
+class StatsFilterTestCase(unittest.TestCase):
+    def test_matches_include_exclude_and_module(self):
+        stats_filter = tornado_profile.parse_stats_filter(
+            include="handler", exclude="_private", module="tornado.web,app")
+        assert stats_filter.matches(("/lib/tornado/web.py", 10, "handler"))
+        assert stats_filter.matches(("/srv/app/views.py", 1, "handler"))
+        assert not stats_filter.matches(("/lib/tornado/web.py", 10, "_private_handler"))
+        assert not stats_filter.matches(("/lib/tornado/ioloop.py", 10, "handler"))
+        assert not stats_filter.matches(("/srv/webapp.py", 1, "handler"))
+
+    def test_filters_are_shared_and_empty_arguments_are_no_filter(self):
+        assert tornado_profile.parse_stats_filter("a", min_cum_time="0.5") is \
+            tornado_profile.parse_stats_filter("a", min_cum_time="0.5")
+        assert tornado_profile.parse_stats_filter("", None, "") is None
+
+    def test_invalid_arguments_raise_value_error(self):
+        with self.assertRaises(ValueError):
+            tornado_profile.parse_stats_filter(include="(")
+        with self.assertRaises(ValueError):
+            tornado_profile.parse_stats_filter(min_cum_time="soon")
+
+    def test_stats_engine_top_only_considers_matching_rows(self):
+        engine = StatsEngine(strip_dirs=True)
+        engine.update([FuncStat("/srv/app/views.py", 1, "fast", 1, 1, 0.1, 0.1),
+                       FuncStat("/srv/app/views.py", 5, "slow", 1, 1, 1.0, 1.0),
+                       FuncStat("/lib/tornado/web.py", 9, "execute", 1, 1, 0.5, 2.0)])
+        stats_filter = tornado_profile.parse_stats_filter(module="app", min_cum_time="0.5")
+        assert [row["func_name"] for row in engine.top("cum_time", 20, stats_filter)] == ["slow"]
+        assert len(engine.top("cum_time", 20)) == 3
+
+
+class StatsFilterHandlerTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.profiler = TornadoProfiler(backend='sampling', sample_interval=0.001)
+        return tornado.web.Application(self.profiler.get_routes())
+
+    def tearDown(self):
+        self.profiler.sampling_profiler.stop()
+        super(StatsFilterHandlerTestCase, self).tearDown()
+
+    def test_post_profiler_with_exclude_does_not_record_excluded_functions(self):
+        result = self.fetch("/profiler?exclude=tornado", method="POST", body="")
+        assert result.code == 201
+        self.io_loop.run_sync(lambda: tornado.gen.sleep(0.05))
+        self.fetch("/profiler", method="DELETE")
+        rows = self.profiler.sampling_profiler.get_func_stats()
+        assert rows
+        assert not any("tornado" in row.module for row in rows)
+
+    def test_get_profiler_stats_with_include_only_returns_matching_rows(self):
+        self.fetch("/profiler", method="POST", body="")
+        self.io_loop.run_sync(lambda: tornado.gen.sleep(0.05))
+        self.fetch("/profiler", method="DELETE")
+        result = self.fetch("/profiler/stats?count=0&include=ioloop&strip_dirs=false")
+        statistics = json.loads(result.body)["statistics"]
+        assert statistics
+        assert all("ioloop" in row["path"] or "ioloop" in row["func_name"] for row in statistics)
+
+    def test_invalid_filter_returns_400_status_code(self):
+        result = self.fetch("/profiler/stats?include=(")
+        assert result.code == 400
+        assert "Invalid `include` regular expression '('" in json.loads(result.body)["error"]
+        result = self.fetch("/profiler?module=app&exclude=)", method="POST", body="")
+        assert result.code == 400
+
+    def test_wall_clock_profiler_skips_excluded_functions(self):
+        profiler = WallClockProfiler()
+        profiler.start(tornado_profile.parse_stats_filter(exclude="busy"))
+        busy(0.01)
+        profiler.stop()
+        names = [stat.name for stat in profiler.get_func_stats()]
+        assert "busy" not in names
+
+
+class CProfileSessionsTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.profiler = TornadoProfiler(backend='cprofile')
+        return tornado.web.Application(self.profiler.get_routes())
+
+    def tearDown(self):
+        for session in self.profiler.cprofile_sessions.sessions():
+            self.profiler.cprofile_sessions.stop(session["id"])
+        super(CProfileSessionsTestCase, self).tearDown()
+
+    def test_get_profiler_reports_running_state(self):
+        assert json.loads(self.fetch("/profiler").body) == {"running": False}
+        self.fetch("/profiler", method="POST", body="")
+        assert json.loads(self.fetch("/profiler").body) == {"running": True}
+        self.fetch("/profiler", method="DELETE")
+        assert json.loads(self.fetch("/profiler").body) == {"running": False}
+
+    def test_post_profiler_with_duration_stops_session(self):
+        result = self.fetch("/profiler?duration=0.05", method="POST", body="")
+        assert result.code == 201
+        status = json.loads(self.fetch("/profiler").body)
+        assert status["running"] is True
+        assert status["session"]["duration"] == 0.05
+        self.fetch("/profiler/sessions/other?duration=60", method="POST", body="")
+        deadline = time.time() + 2.0
+        while self.profiler.cprofile_sessions.is_running() and time.time() < deadline:
+            self.io_loop.run_sync(lambda: tornado.gen.sleep(0.01))
+        assert json.loads(self.fetch("/profiler").body) == {"running": False}
+        other = json.loads(self.fetch("/profiler/sessions/other").body)
+        assert other["running"] is True
+        assert other["limits"]["duration"] == 60
+
+    def test_post_profiler_with_invalid_limits_returns_400_status_code(self):
+        result = self.fetch("/profiler?duration=abc", method="POST", body="")
+        assert result.code == 400
+        assert json.loads(result.body) == {'error': "Can't cast `duration` 'abc' to float."}
+        assert not self.profiler.cprofile_sessions.is_running()
+
+    def test_stats_of_a_session_not_started_return_404(self):
+        result = self.fetch("/profiler/sessions/mine/stats")
+        assert result.code == 404
+        assert json.loads(result.body) == {"error": "Session 'mine' has not been started."}
+        assert self.fetch("/profiler/stats").code == 404
+
+    def test_delete_stopped_session_removes_it(self):
+        self.fetch("/profiler/sessions/mine", method="POST", body="")
+        assert self.fetch("/profiler/sessions/mine", method="DELETE").code == 204
+        assert json.loads(self.fetch("/profiler/sessions/mine").body)["running"] is False
+        assert self.fetch("/profiler/sessions/mine", method="DELETE").code == 204
+        assert json.loads(self.fetch("/profiler/sessions").body) == {"sessions": []}
+        assert self.fetch("/profiler/sessions/mine/stats").code == 404
+        assert self.fetch("/profiler/sessions/mine", method="DELETE").code == 404
+
+    def test_start_stop_and_clear_build_no_statistics(self):
+        with mock.patch.object(tornado_profile, '_entries_pstats', side_effect=AssertionError):
+            self.fetch("/profiler", method="POST", body="")
+            busy(0.01)
+            self.fetch("/profiler/stats", method="DELETE")
+            busy(0.01)
+            self.fetch("/profiler", method="DELETE")
+        result = self.fetch("/profiler/stats?count=0")
+        assert [row["num_calls"] for row in json.loads(result.body)["statistics"]
+                if row["func_name"] == "busy"] == [1]
+
+    def test_concurrent_sessions_only_see_their_own_calls(self):
+        self.fetch("/profiler/sessions/first", method="POST", body="")
+        busy(0.01)
+        self.fetch("/profiler/sessions/second", method="POST", body="")
+        busy(0.01)
+        self.fetch("/profiler/sessions/first", method="DELETE")
+        busy(0.01)
+        self.fetch("/profiler/sessions/second", method="DELETE")
+
+        def busy_calls(session_id):
+            result = self.fetch("/profiler/sessions/%s/stats?count=0" % session_id)
+            return [row["num_calls"] for row in json.loads(result.body)["statistics"]
+                    if row["func_name"] == "busy"]
+
+        assert busy_calls("first") == [2]
+        assert busy_calls("second") == [2]
+        sessions = json.loads(self.fetch("/profiler/sessions").body)["sessions"]
+        assert [(session["id"], session["running"]) for session in sessions] == [
+            ("first", False), ("second", False)]
+
+    def test_get_profiler_stats_returns_sorted_json_rows(self):
+        self.fetch("/profiler", method="POST", body="")
+        busy(0.01)
+        self.fetch("/profiler", method="DELETE")
+        result = self.fetch("/profiler/stats?sort=num_calls&count=3")
+        assert result.code == 200
+        statistics = json.loads(result.body)["statistics"]
+        assert len(statistics) == 3
+        assert statistics == sorted(statistics, key=lambda row: row["num_calls"], reverse=True)
+        result = self.fetch("/profiler/stats?sort=bogus")
+        assert result.code == 400
+
+    def test_delete_stats_clears_the_session(self):
+        self.fetch("/profiler", method="POST", body="")
+        busy(0.01)
+        result = self.fetch("/profiler/stats", method="DELETE")
+        assert result.code == 204
+        busy(0.01)
+        self.fetch("/profiler", method="DELETE")
+        stats = self.profiler.cprofile_sessions.get_stats().stats
+        assert [value[1] for func, value in stats.items() if func[2] == "busy"] == [1]
+
+
+def other_work():
+    busy(0.005)
+
+
+class SlowHandler(tornado.web.RequestHandler):
+    @tornado.gen.coroutine
+    def get(self):
+        busy(0.01)
+        yield tornado.gen.sleep(0.02)
+        self.write("slow")
+
+
+class OtherHandler(tornado.web.RequestHandler):
+    def get(self):
+        other_work()
+        self.write("other")
+
+
+class RequestTracerTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.profiler = TornadoProfiler(trace_argument="profile", slow_request_threshold=0.02,
+                                        slow_requests=2)
+        routes = [(r"/slow", SlowHandler), (r"/other", OtherHandler),
+                  (r"/hello", HelloHandler)] + self.profiler.get_routes()
+        return self.profiler.instrument(tornado.web.Application(routes))
+
+    def tearDown(self):
+        yappi.set_tag_callback(None)
+        super(RequestTracerTestCase, self).tearDown()
+
+    def test_slow_traced_requests_are_kept_with_their_functions(self):
+        self.fetch("/slow?profile=1")
+        self.fetch("/slow")
+        self.fetch("/hello?profile=1")
+        slow = json.loads(self.fetch("/profiler/slow").body)
+        assert slow["traced"] == 2
+        assert [(request["uri"], request["handler"], request["status"])
+                for request in slow["requests"]] == [
+            ("/slow?profile=1", "test_tornado_profile.SlowHandler", 200)]
+        assert slow["requests"][0]["latency"] >= 0.02
+
+        result = self.fetch("/profiler/slow/%d?count=0" % slow["requests"][0]["id"])
+        statistics = json.loads(result.body)["statistics"]
+        busy_row = [row for row in statistics if row["func_name"] == "busy"][0]
+        assert busy_row["num_calls"] == 1
+        assert busy_row["cpu_time"] > 0
+        assert sys.getprofile() is None
+
+    def test_unknown_slow_request_returns_404(self):
+        assert self.fetch("/profiler/slow/42").code == 404
+
+    def test_least_recently_used_requests_are_dropped(self):
+        for _ in range(3):
+            self.fetch("/slow?profile=1")
+        ids = [request["id"] for request in json.loads(self.fetch("/profiler/slow").body)["requests"]]
+        assert ids == [3, 2]
+        self.fetch("/profiler/slow/2")
+        self.fetch("/slow?profile=1")
+        ids = [request["id"] for request in json.loads(self.fetch("/profiler/slow").body)["requests"]]
+        assert sorted(ids) == [2, 4]
+
+    @unittest.skipIf(tornado_profile.contextvars is None, "needs contextvars")
+    def test_concurrent_untraced_requests_are_not_charged_to_a_traced_one(self):
+        @tornado.gen.coroutine
+        def fetch_both():
+            client = tornado.httpclient.AsyncHTTPClient()
+            yield [client.fetch(self.get_url("/slow?profile=1")),
+                   client.fetch(self.get_url("/other"))]
+
+        self.io_loop.run_sync(fetch_both)
+        request, = self.profiler.tracer.requests()
+        names = set(stat.name for stat in self.profiler.tracer.get(request["id"])[1])
+        assert "busy" in names
+        assert "other_work" not in names
+
+
+class MetricsTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        self.profiler = TornadoProfiler(backend='sampling', sample_interval=0.001, metrics_ttl=60)
+        return tornado.web.Application(self.profiler.get_routes())
+
+    def tearDown(self):
+        self.profiler.sampling_profiler.stop()
+        super(MetricsTestCase, self).tearDown()
+
+    def test_get_profiler_metrics_returns_text_exposition_format(self):
+        self.fetch("/profiler", method="POST", body="")
+        self.io_loop.run_sync(lambda: tornado.gen.sleep(0.05))
+        result = self.fetch("/profiler/metrics?count=3")
+        assert result.code == 200
+        assert result.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        lines = result.body.decode().splitlines()
+        assert 'tornado_profile_running{backend="sampling"} 1.0' in lines
+        assert "# TYPE tornado_profile_function_calls_total counter" in lines
+        assert len([line for line in lines
+                    if line.startswith("tornado_profile_function_calls_total{")]) == 3
+        assert any(line.startswith("tornado_profile_overhead_ratio ") for line in lines)
+
+    def test_metrics_are_cached(self):
+        first = self.fetch("/profiler/metrics").body
+        self.fetch("/profiler", method="POST", body="")
+        assert self.fetch("/profiler/metrics").body == first
+
+    def test_invalid_sort_returns_400_status_code(self):
+        result = self.fetch("/profiler/metrics?sort=wait_time")
+        assert result.code == 400
+
+    def test_deterministic_backends_report_profiled_time_ratio(self):
+        profiler = TornadoProfiler(backend='cprofile')
+        profiler.start()
+        busy(0.02)
+        profiler.stop()
+        lines = tornado_profile.ProfilerMetrics(profiler).render().splitlines()
+        ratio = [float(line.split()[1]) for line in lines
+                 if line.startswith("tornado_profile_profiled_time_ratio ")]
+        assert len(ratio) == 1 and 0 < ratio[0] <= 1
+        assert any(line.startswith("tornado_profile_stats_build_seconds ") for line in lines)
+        assert not any(line.startswith("tornado_profile_overhead_ratio ") for line in lines)
+
+    def test_label_values_are_escaped(self):
+        assert tornado_profile._metric_label('a"b\\c\n') == 'a\\"b\\\\c\\n'
+
+
+class HelloBackendHandler(tornado.web.RequestHandler):
+    def get(self):
+        self.write({"backend": "hello"})
+
+
+class HelloBackend(tornado_profile.ProfilerBackend):
+    def get_routes(self):
+        return [(self.profiler.prefix + "/profiler", self.profiler._handler(HelloBackendHandler))]
+
+
+class BackendRegistryTestCase(AsyncHTTPTestCase):
+    def get_app(self):
+        tornado_profile.register_backend('hello', HelloBackend)
+        self.addCleanup(tornado_profile._backends.pop, 'hello')
+        self.profiler = TornadoProfiler(backend='hello')
+        return tornado.web.Application(self.profiler.get_routes())
+
+    def test_registered_backend_serves_its_routes(self):
+        result = self.fetch("/profiler")
+        assert result.code == 200
+        assert json.loads(result.body.decode()) == {"backend": "hello"}
+        assert self.fetch("/profiler/metrics").code == 200
+
+    def test_registered_backend_does_not_report_yappi(self):
+        tornado_profile.start_profiling()
+        self.addCleanup(tornado_profile.clear_stats)
+        self.addCleanup(tornado_profile.stop_profiling)
+        self.profiler.start()
+        assert not self.profiler.is_running()
+        metrics = self.fetch("/profiler/metrics").body.decode()
+        assert 'tornado_profile_running{backend="hello"} 0.0' in metrics
+        assert "profiled_time_ratio" not in metrics
+        assert "stats_build_seconds" not in metrics
+        assert "tornado_profile_function_calls_total{" not in metrics
+
+    def test_unknown_backend_raises_value_error(self):
+        with self.assertRaises(ValueError):
+            TornadoProfiler(backend='missing').get_routes()
+
+    def test_yappi_backend_without_yappi_raises_import_error(self):
+        code = ("import sys, tornado_profile; "
+                "sys.modules['yappi'] = None; "
+                "tornado_profile.TornadoProfiler(backend='sampling'); "
+                "tornado_profile.TornadoProfiler()")
+        path = os.path.dirname(os.path.abspath(tornado_profile.__file__))
+        env = dict(os.environ, PYTHONPATH=path)
+        process = subprocess.Popen([sys.executable, "-c", code], env=env, stderr=subprocess.PIPE)
+        _, stderr = process.communicate()
+        assert process.returncode != 0
+        assert b"ImportError: The yappi backend needs yappi" in stderr
+
+    def test_profilers_are_imported_when_used(self):
+        code = ("import sys, tornado_profile; "
+                "assert 'yappi' not in sys.modules and 'cProfile' not in sys.modules; "
+                "tornado_profile.register_backend('none', tornado_profile.ProfilerBackend); "
+                "tornado_profile.TornadoProfiler(backend='none').metrics.render(); "
+                "assert 'yappi' not in sys.modules; "
+                "tornado_profile.is_profiler_running(); "
+                "assert 'yappi' in sys.modules")
+        path = os.path.dirname(os.path.abspath(tornado_profile.__file__))
+        env = dict(os.environ, PYTHONPATH=path)
+        assert subprocess.call([sys.executable, "-c", code], env=env) == 0
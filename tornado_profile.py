@@ -1,96 +1,709 @@
 """Profile a Tornado application via REST."""
 
-import cProfile
+import bisect
+import dis
+import errno
+import functools
+import glob
+import gzip
+import heapq
+import importlib
+import io
 import logging
-import pstats
-import StringIO
+import marshal
+import math
+import os
+import random
+import re
+import socket
+import struct
+import sys
+import threading
+import time
+import traceback
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+import tornado.util
 import tornado.web
-import yappi
 
-from operator import itemgetter
+from array import array
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import timedelta
+from operator import attrgetter, itemgetter
+from tornado.escape import json_encode
+
+try:
+    import contextvars
+except ImportError:  # Python < 3.7
+    contextvars = None
+
+
+class _LazyModule(object):
+    """Stand-in for a module which is imported on first use.
+
+    Only the selected backend's profiler gets imported, so importing
+    tornado_profile stays cheap for services which never profile.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+    def _load(self):
+        """Import the module if it wasn't yet, and return it."""
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+
+cProfile = _LazyModule('cProfile')
+pstats = _LazyModule('pstats')
+yappi = _LazyModule('yappi')
+tracemalloc = _LazyModule('tracemalloc') if sys.version_info >= (3, 4) else None
 
 __author__ = "Megan Kearl Patten <megkearl@gmail.com>"
 
 
 logger = logging.getLogger(__name__)
 
+_executor = None
+_clock_type = "cpu"
+_profiled_since = None  # wall time the yappi profiler was started or cleared at
+_profiled_until = None  # wall time it was stopped at
+_collection_filter = None  # StatsFilter of the functions the yappi 'cpu' clock reports
+_profiled_thread = None  # the only thread yappi profiles, None when it profiles every thread
+_profiled_ioloop = None  # IOLoop of _profiled_thread
+_stats_filters = {}
+_stats_filters_lock = threading.Lock()
+_stats_engines = {}
+_stats_engines_lock = threading.Lock()
+_call_graphs = {}
+_call_graphs_lock = threading.Lock()
+
+
+def _default_executor():
+    """Return the executor used when TornadoProfiler was not given one."""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=1)
+    return _executor
 
-def start_profiling():
-    """Start profiler."""
+
+def start_profiling(clock_type="cpu", threads=False, stats_filter=None):
+    """Start profiler.
+
+    :param str clock_type: 'cpu' to profile with yappi, 'wall' to profile the
+        current thread with the coroutine aware :class:`WallClockProfiler`
+    :param bool threads: with the 'cpu' clock, profile every thread instead
+        of only the current one, see :func:`get_thread_statistics`
+    :param StatsFilter|None stats_filter: only record the functions it
+        matches. The 'wall' clock skips the others while tracing, yappi
+        can't, so they are dropped from its statistics.
+    """
     # POST /profiler
-    yappi.start(builtins=False, profile_threads=False)
+    global _clock_type, _profiled_since, _profiled_until, _collection_filter
+    global _profiled_thread, _profiled_ioloop
+    if clock_type == "wall":
+        _wall_clock_profiler.start(stats_filter)
+        _collection_filter = None
+    else:
+        if threads:
+            yappi.set_context_name_callback(_thread_name)
+        yappi.start(builtins=False, profile_threads=threads)
+        _collection_filter = stats_filter
+        _profiled_thread = None if threads else threading.current_thread()
+        _profiled_ioloop = None if threads else tornado.ioloop.IOLoop.current(instance=False)
+    _clock_type = clock_type
+    _profiled_since = time.time()
+    _profiled_until = None
 
 
 def is_profiler_running():
     """Return True if the profiler is running."""
     # GET /profiler
-    return yappi.is_running()
+    return yappi.is_running() or _wall_clock_profiler.is_running()
 
 
 def stop_profiling():
     """Stop the profiler."""
     # DELETE /profiler
+    global _profiled_until
+    if is_profiler_running():
+        _profiled_until = time.time()
     yappi.stop()
+    _wall_clock_profiler.stop()
 
 
 def clear_stats():
     """Clear profiler statistics."""
     # DELETE /profiler/stats
-    yappi.clear_stats()
+    global _profiled_since, _profiled_until
+    _on_profiled_thread(yappi.clear_stats)
+    _wall_clock_profiler.clear_stats()
+    _profiled_since = time.time() if is_profiler_running() else None
+    _profiled_until = None
+
 
+def get_profiler_pstats():
+    """Return the yappi statistics as a pstats dictionary, like `pstats.Stats.stats`.
 
-def get_profiler_statistics(sort="cum_time", count=20, strip_dirs=True):
+    Only the functions of the collection filter given to :func:`start_profiling`
+    are included.
+
+    :raises WallClockError: if the profiler was last started with the 'wall' clock
+    """
+    return _yappi_pstats(_get_caller_func_stats())
+
+
+def get_call_graph(strip_dirs=True):
+    """Return the :class:`CallGraph` of the yappi statistics.
+
+    The graph is only rebuilt when the statistics changed since the last call.
+
+    :raises WallClockError: if the profiler was last started with the 'wall' clock
+    """
+    func_stats = _get_caller_func_stats()
+    version = _get_stats_engine(strip_dirs).update(func_stats)
+    with _call_graphs_lock:
+        cached = _call_graphs.get(strip_dirs)
+        if cached is None or cached[0] != version:
+            stats = _yappi_pstats(func_stats)
+            if strip_dirs:
+                stats = _strip_pstats(stats)
+            cached = _call_graphs[strip_dirs] = (version, CallGraph(stats))
+        return cached[1]
+
+
+def get_profiler_statistics(sort="cum_time", count=20, strip_dirs=True, tags=None, threads=None,
+                            stats_filter=None):
     """Return profiler statistics.
 
     :param str sort: dictionary key to sort by
     :param int|None count: the number of results to return, None returns all results.
     :param bool strip_dirs: if True strip the directory, otherwise return the full path
+    :param tuple|None tags: only include time attributed to these yappi tags,
+        see :class:`RouteProfiler`
+    :param tuple|None threads: only include these yappi thread ids, see
+        :func:`get_thread_statistics`
+    :param StatsFilter|None stats_filter: only include the rows it matches
+
+    When the profiler was last started with the 'wall' clock the rows also
+    have `cpu_time` and `wait_time` columns, and `tags` and `threads` are ignored.
     """
-    json_stats = []
-    pstats = yappi.convert2pstats(yappi.get_func_stats())
-    if strip_dirs:
-        pstats.strip_dirs()
-
-    for func, func_stat in pstats.stats.iteritems():
-        path, line, func_name = func
-        cc, num_calls, total_time, cum_time, callers = func_stat
-        json_stats.append({
-            "path": path,
-            "line": line,
-            "func_name": func_name,
-            "num_calls": num_calls,
-            "total_time": total_time,
-            "total_time_per_call": total_time/num_calls if total_time else 0,
-            "cum_time": cum_time,
-            "cum_time_per_call": cum_time/num_calls if cum_time else 0
-        })
+    columns, func_stats = _get_func_stats(tags, threads)
+    if columns:
+        tags = threads = None
+    engine = _get_stats_engine(strip_dirs, tags, columns, threads)
+    engine.update(func_stats)
+    return engine.top(sort, count, stats_filter)
+
+
+def get_profiled_time():
+    """Return the seconds spent in the profiled functions, excluding callees, and the seconds profiled.
+
+    With the 'cpu' clock the first is the CPU time yappi measured, with the
+    'wall' clock the wall-clock time.
+    """
+    if _profiled_since is None:
+        return 0.0, 0.0
+    elapsed = (_profiled_until or time.time()) - _profiled_since
+    return sum(stat.tsub for stat in _get_func_stats()[1]), elapsed
+
+
+def get_thread_statistics():
+    """Return the yappi time of every profiled thread, most busy first.
+
+    `utilization` is the fraction of the profiled wall time the thread spent
+    running, so a pool whose threads are all close to 1 is saturated.
+    """
+    if _profiled_since is None:
+        elapsed = 0
+    else:
+        elapsed = (_profiled_until or time.time()) - _profiled_since
+    threads = [{"id": stat.id,
+                "tid": stat.tid,
+                "name": stat.name,
+                "total_time": stat.ttot,
+                "utilization": stat.ttot / elapsed if elapsed else 0,
+                "sched_count": stat.sched_count} for stat in yappi.get_thread_stats()]
+    return sorted(threads, key=itemgetter("total_time"), reverse=True)
+
+
+def match_threads(threads, thread):
+    """Return the ids of the `threads` rows with the id or name (prefix) `thread`.
+
+    :raises ValueError: if no thread matches
+    """
+    ids = tuple(row["id"] for row in threads
+                if str(row["id"]) == thread or str(row["name"]).startswith(thread))
+    if not ids:
+        raise ValueError("Unknown `thread` '%s'." % thread)
+    return ids
+
+
+def _yappi_running():
+    """Return True if yappi is profiling, without importing it."""
+    return 'yappi' in sys.modules and yappi.is_running()
+
+
+def _on_profiled_thread(func):
+    """Return `func()`, called on the thread yappi profiles.
+
+    yappi pauses while its statistics are read or cleared, and when it only
+    profiles one thread it resumes by profiling the calling thread instead.
+    Calls from another thread, such as the executor, are run on the IOLoop of
+    the profiled thread, which must not be blocked waiting for them.
+    """
+    ioloop = _profiled_ioloop
+    if ioloop is None or threading.current_thread() is _profiled_thread or not _yappi_running():
+        return func()
+    future = Future()
+
+    def call():
+        try:
+            future.set_result(func())
+        except Exception as e:
+            future.set_exception(e)
+
+    ioloop.add_callback(call)
+    return future.result()
+
+
+def _thread_name():
+    """Name yappi contexts after their thread instead of its class."""
+    return threading.current_thread().name
+
+
+def _check_callers_recorded():
+    """Raise :class:`WallClockError` if the current profile has no callers, as with the 'wall' clock."""
+    if _clock_type == "wall":
+        raise WallClockError("The 'wall' clock doesn't record callers. Start the profiler with "
+                             "the 'cpu' clock to export the profile or get its call graph.")
+
+
+def _get_caller_func_stats():
+    """Return the yappi function statistics for exports, which need the callers of every function."""
+    _check_callers_recorded()
+    return _get_func_stats()[1]
+
+
+def _yappi_pstats(func_stats):
+    """Return a pstats dictionary of yappi function statistics, like `yappi.convert2pstats`.
+
+    Unlike `yappi.convert2pstats`, `func_stats` can be any iterable, such as
+    a filtered list.
+    """
+    callers = {}
+    for stat in func_stats:
+        caller = (stat.module, stat.lineno, stat.name)
+        for child in stat.children:
+            callers.setdefault((child.module, child.lineno, child.name), {})[caller] = (
+                child.ncall, child.nactualcall, child.tsub, child.ttot)
+    return dict(((stat.module, stat.lineno, stat.name),
+                 (stat.ncall, stat.nactualcall, stat.tsub, stat.ttot,
+                  callers.get((stat.module, stat.lineno, stat.name), {})))
+                for stat in func_stats)
+
+
+def _get_func_stats(tags=None, threads=None):
+    """Return the extra columns and the function statistics of the last started clock."""
+    if _clock_type == "wall":
+        return WALL_CLOCK_COLUMNS, _wall_clock_profiler.get_func_stats()
+    if tags is None:
+        func_stats = _on_profiled_thread(yappi.get_func_stats)
+    else:
+        func_stats = _on_profiled_thread(
+            lambda: [stat for tag in tags for stat in yappi.get_func_stats(tag=tag)])
+    if threads is not None:
+        # get_func_stats(ctx_id=0) returns every thread, so filter here
+        func_stats = [stat for stat in func_stats if stat.ctx_id in threads]
+    if _collection_filter is not None:
+        matches = _collection_filter.matches
+        func_stats = [stat for stat in func_stats
+                      if matches((stat.module, stat.lineno, stat.name))]
+    return (), func_stats
+
+
+def _get_stats_engine(strip_dirs, tags=None, columns=(), threads=None):
+    """Return the shared StatsEngine for the given `strip_dirs`, `tags`, `columns` and `threads`."""
+    key = (strip_dirs, tags, columns, threads)
+    with _stats_engines_lock:
+        engine = _stats_engines.get(key)
+        if engine is None:
+            engine = StatsEngine(strip_dirs, columns)
+            _stats_engines[key] = engine
+        return engine
+
+
+def _func_strip_path(func):
+    """Return `func` without the directory of its path, like `pstats.func_strip_path`."""
+    path, line, func_name = func
+    return os.path.basename(path), line, func_name
 
-    return sorted(json_stats, key=itemgetter(sort), reverse=True)[:count]
 
+def _make_row(func, cc, num_calls, total_time, cum_time):
+    """Return the JSON row for a pstats style function entry."""
+    path, line, func_name = func
+    return {
+        "path": path,
+        "line": line,
+        "func_name": func_name,
+        "num_calls": num_calls,
+        "total_time": total_time,
+        "total_time_per_call": total_time/num_calls if num_calls else 0,
+        "cum_time": cum_time,
+        "cum_time_per_call": cum_time/num_calls if num_calls else 0
+    }
+
+
+class WallClockError(ValueError):
+    """Raised for statistics the 'wall' clock doesn't record."""
+
+
+class NoStatsAvailableError(TypeError):
+    """Raised when statistics are requested before any were collected."""
+
+
+class StatsFilter(object):
+    """Precompiled filter of the functions and rows of the statistics.
+
+    A function matches if `include` is found in its "path:line(func_name)",
+    `exclude` isn't, and its path is in one of the `modules`. A row also
+    needs a `cum_time` of at least `min_cum_time`. Matches are memoized per
+    function, so use :func:`parse_stats_filter` to share filters.
+    """
+
+    def __init__(self, include=None, exclude=None, modules=(), min_cum_time=None):
+        self.include = include and re.compile(include)
+        self.exclude = exclude and re.compile(exclude)
+        self.modules = modules and re.compile('|'.join(
+            r'(?:^|[/\\])%s(?:[/\\]|\.py)' % re.escape(module).replace(r'\.', r'[/\\]')
+            for module in modules))
+        self.min_cum_time = min_cum_time
+        self._matches = {}  # function or code object -> bool
+
+    def matches(self, func):
+        """Return True if the (path, line, func_name) `func` is included."""
+        matched = self._matches.get(func)
+        if matched is None:
+            path, line, func_name = func
+            name = "%s:%s(%s)" % func
+            matched = (not self.include or bool(self.include.search(name))) and \
+                (not self.exclude or not self.exclude.search(name)) and \
+                (not self.modules or bool(self.modules.search(path)))
+            self._matches[func] = matched
+        return matched
+
+    def matches_code(self, code):
+        """Return True if the function of the code object `code` is included."""
+        matched = self._matches.get(code)
+        if matched is None:
+            matched = self._matches[code] = self.matches(
+                (code.co_filename, code.co_firstlineno, code.co_name))
+        return matched
+
+    def filter_rows(self, rows, groups):
+        """Return the `rows` values matching, with the functions of each row in `groups`."""
+        min_cum_time = self.min_cum_time
+        return [row for key, row in rows.items()
+                if (min_cum_time is None or row["cum_time"] >= min_cum_time) and
+                any(self.matches(func) for func in groups.get(key, (key,)))]
+
+
+def parse_stats_filter(include=None, exclude=None, module=None, min_cum_time=None):
+    """Return the shared :class:`StatsFilter` for query arguments, None if all are empty.
+
+    :param str|None include: regular expression a function must match
+    :param str|None exclude: regular expression a function must not match
+    :param str|None module: comma separated dotted module or package names
+    :param str|None min_cum_time: minimum `cum_time` of a row in seconds
+    :raises ValueError: with an error message for invalid arguments
+    """
+    key = (include or None, exclude or None, module or None, min_cum_time or None)
+    if key == (None, None, None, None):
+        return None
+    with _stats_filters_lock:
+        stats_filter = _stats_filters.get(key)
+    if stats_filter is not None:
+        return stats_filter
+
+    for name, pattern in (('include', include), ('exclude', exclude)):
+        if pattern:
+            try:
+                re.compile(pattern)
+            except re.error as e:
+                raise ValueError("Invalid `%s` regular expression '%s': %s." % (name, pattern, e))
+    if min_cum_time:
+        try:
+            min_cum_time = float(min_cum_time)
+        except (ValueError, TypeError):
+            raise ValueError("Can't cast `min_cum_time` '%s' to float." % min_cum_time)
+    modules = tuple(module.strip() for module in (module or '').split(',') if module.strip())
+    stats_filter = StatsFilter(include, exclude, modules, min_cum_time or None)
+    with _stats_filters_lock:
+        if len(_stats_filters) >= 128:
+            _stats_filters.clear()
+        return _stats_filters.setdefault(key, stats_filter)
+
+
+class StatsEngine(object):
+    """Cached, version-stamped snapshot of yappi function statistics.
+
+    Each call to :meth:`update` compares the yappi counters against the previous
+    snapshot and only rebuilds the rows that changed. :meth:`top` selects the
+    `count` largest rows with a heap and caches the result until the next
+    change, so repeated polling of an idle profile is nearly free.
+
+    `columns` names extra, summable attributes of the function statistics
+    which are copied into the rows.
+    """
+
+    def __init__(self, strip_dirs=True, columns=()):
+        self.strip_dirs = strip_dirs
+        self.columns = columns
+        self.version = 0
+        self._lock = threading.Lock()
+        self._counters = {}  # yappi function -> (ncall, nactualcall, tsub, ttot)
+        self._groups = {}  # row key -> yappi functions folded into that row
+        self._rows = {}  # row key -> row dict
+        self._top = {}  # (sort, count) -> rows for the current version
+
+    def update(self, func_stats):
+        """Fold a yappi `YFuncStats` snapshot in and return the new version."""
+        with self._lock:
+            counters = self._counters
+            seen = {}
+            for stat in func_stats:
+                func = (stat.module, stat.lineno, stat.name)
+                value = (stat.ncall, stat.nactualcall, stat.tsub, stat.ttot)
+                if self.columns:
+                    value += tuple(getattr(stat, column) for column in self.columns)
+                if func in seen:
+                    # yappi reports a function once per thread and tag
+                    value = tuple(a + b for a, b in zip(seen[func], value))
+                seen[func] = value
+
+            changed = []
+            for func, value in seen.items():
+                if counters.get(func) != value:
+                    if func not in counters:
+                        self._groups.setdefault(self._row_key(func), set()).add(func)
+                    counters[func] = value
+                    changed.append(func)
+
+            if len(seen) != len(counters):
+                for func in [func for func in counters if func not in seen]:
+                    del counters[func]
+                    self._groups[self._row_key(func)].discard(func)
+                    changed.append(func)
+
+            if changed:
+                for key in set(self._row_key(func) for func in changed):
+                    self._rebuild_row(key)
+                self.version += 1
+                self._top = {}
+            return self.version
+
+    def top(self, sort="cum_time", count=20, stats_filter=None):
+        """Return the `count` rows with the largest `sort` value, all if None.
+
+        With a :class:`StatsFilter` only the rows it matches are considered.
+        The returned rows are shared between callers and must not be modified.
+        """
+        with self._lock:
+            if not self._rows:
+                raise NoStatsAvailableError("No profiler statistics available.")
+            rows = self._top.get((sort, count, stats_filter))
+            if rows is None:
+                if stats_filter is None:
+                    candidates = self._rows.values()
+                else:
+                    candidates = stats_filter.filter_rows(self._rows, self._groups)
+                if count is None:
+                    rows = sorted(candidates, key=itemgetter(sort), reverse=True)
+                else:
+                    rows = heapq.nlargest(count, candidates, key=itemgetter(sort))
+                self._top[(sort, count, stats_filter)] = rows
+            return list(rows)
+
+    def _row_key(self, func):
+        return _func_strip_path(func) if self.strip_dirs else func
+
+    def _rebuild_row(self, key):
+        funcs = self._groups.get(key)
+        if not funcs:
+            self._groups.pop(key, None)
+            self._rows.pop(key, None)
+            return
+        # Functions which only differ by directory are merged, like pstats.strip_dirs()
+        values = [sum(column) for column in zip(*(self._counters[func] for func in funcs))]
+        row = _make_row(key, *values[:4])
+        row.update(zip(self.columns, values[4:]))
+        self._rows[key] = row
+
+
+STREAM_CONTENT_TYPES = {'json': 'application/json', 'ndjson': 'application/x-ndjson'}
+
+
+def _encode_next_chunk(chunks, stream, first):
+    """Return the next chunk of rows from `chunks` encoded for `stream`, None when done."""
+    rows = next(chunks, None)
+    if rows is None:
+        return None
+    if stream == 'ndjson':
+        return ''.join(json_encode(row) + '\n' for row in rows)
+    encoded = ', '.join(json_encode(row) for row in rows)
+    return encoded if first else ', ' + encoded
+
+
+class JSONHandler(tornado.web.RequestHandler):
+    """Base handler of the profiler endpoints, which answer in JSON."""
 
-class YappiProfileStatsHandler(tornado.web.RequestHandler):
     def set_default_headers(self):
         self.set_header('Content-Type', 'application/json')
 
+    def get_bool_argument(self, name, default):
+        """Return the query argument `name` as a bool, 'false', 'no', 'none', 'null', '0' and '' are False."""
+        return str(self.get_argument(name, default)).lower() not in (
+            'false', 'no', 'none', 'null', '0', '')
+
+    def get_count_argument(self, default=20):
+        """Return the `count` query argument, None to return all rows when it isn't positive.
+
+        :raises ValueError: with an error message for an invalid count
+        """
+        count = self.get_argument('count', default)
+        try:
+            count = int(count)
+        except (ValueError, TypeError):
+            raise ValueError("Can't cast `count` '%s' to int." % count)
+        return count if count > 0 else None
+
+
+class StatsStreamMixin(object):
+    """Run work in the profiler executor and stream statistics in chunks."""
+
+    executor = None
+    chunk_size = 500
+
+    def run_in_executor(self, func, *args):
+        """Run `func` in the profiler executor and return a Future."""
+        executor = self.executor or _default_executor()
+        return tornado.ioloop.IOLoop.current().run_in_executor(executor, func, *args)
+
+    def get_stream_arguments(self):
+        """Return the `stream` format and `chunk_size` given in the query string.
+
+        :raises ValueError: with an error message for invalid arguments
+        """
+        stream = self.get_argument('stream', None)
+        if stream is not None and stream not in STREAM_CONTENT_TYPES:
+            raise ValueError("Invalid `stream` '%s', must be in %s." % (
+                stream, tuple(sorted(STREAM_CONTENT_TYPES))))
+        chunk_size = self.get_argument('chunk_size', self.chunk_size)
+        try:
+            chunk_size = int(chunk_size)
+        except (ValueError, TypeError):
+            raise ValueError("Can't cast `chunk_size` '%s' to int." % chunk_size)
+        if chunk_size <= 0:
+            raise ValueError("`chunk_size` must be positive.")
+        return stream, chunk_size
+
+    @tornado.gen.coroutine
+    def stream_statistics(self, chunks, stream):
+        """Write the row lists of the `chunks` iterator as a JSON or NDJSON document.
+
+        Each chunk is built and encoded in the executor and flushed before the
+        next one, so memory is bounded by the chunk size and the IOLoop serves
+        other requests in between.
+        """
+        self.set_header('Content-Type', STREAM_CONTENT_TYPES[stream])
+        if stream == 'json':
+            self.write('{"statistics": [')
+        first = True
+        while True:
+            data = yield self.run_in_executor(_encode_next_chunk, chunks, stream, first)
+            if data is None:
+                break
+            first = False
+            self.write(data)
+            yield self.flush()
+        if stream == 'json':
+            self.write(']}')
+        self.finish()
+
+
+class ProfileStatsHandler(StatsStreamMixin, JSONHandler):
+    """Base handler for the statistics of a profiler backend.
+
+    Subclasses implement :meth:`get_statistics`, which runs in `executor`, and
+    :meth:`clear_statistics`.
+    """
+
+    sorts = ('num_calls', 'cum_time', 'total_time',
+             'cum_time_per_call', 'total_time_per_call')
+    default_sort = 'cum_time'
+    windows = None
+
+    def get_filters(self):
+        """Return the backend specific filters given in the query string.
+
+        The base filters are a :class:`StatsFilter` and the selected windows
+        of the :class:`WindowStore`, if any.
+
+        :raises ValueError: with an error message for invalid filters
+        """
+        filters = {}
+        stats_filter = parse_stats_filter(
+            self.get_argument('include', None), self.get_argument('exclude', None),
+            self.get_argument('module', None), self.get_argument('min_cum_time', None))
+        if stats_filter is not None:
+            filters['stats_filter'] = stats_filter
+        if self.windows is not None:
+            selection = parse_window_selection(self.get_argument('since', None),
+                                               self.get_argument('window', None))
+            if selection is not None:
+                filters['windows'] = selection
+        return filters
+
+    def get_statistics(self, sort, count, strip_dirs, **filters):
+        """Return the statistics rows, see :func:`get_profiler_statistics`."""
+        raise NotImplementedError()
+
+    def encode_statistics(self, sort, count, strip_dirs, **filters):
+        """Return the statistics as a JSON document."""
+        return json_encode({'statistics': self.get_statistics(sort, count, strip_dirs, **filters)})
+
+    def clear_statistics(self):
+        """Clear the collected statistics."""
+        raise NotImplementedError()
+
+    @tornado.gen.coroutine
     def get(self):
         """Return current profiler statistics."""
 
-        sort = self.get_argument('sort', 'cum_time')
-        count = self.get_argument('count', 20)
-        strip_dirs = self.get_argument('strip_dirs', True)
+        sort = self.get_argument('sort', self.default_sort)
+        strip_dirs = self.get_bool_argument('strip_dirs', True)
         error = ''
-        sorts = ('num_calls', 'cum_time', 'total_time',
-                 'cum_time_per_call', 'total_time_per_call')
+        sorts = self.sorts
         if sort not in sorts:
             error += "Invalid `sort` '%s', must be in %s." % (sort, sorts)
         try:
-            count = int(count)
-        except (ValueError, TypeError):
-            error += "Can't cast `count` '%s' to int." % count
-        if count <= 0:
-            count = None
-        strip_dirs = str(strip_dirs).lower() not in ('false', 'no', 'none',
-                                                     'null', '0', '')
+            count = self.get_count_argument()
+        except ValueError as e:
+            error += str(e)
+        try:
+            filters = self.get_filters()
+            stream, chunk_size = self.get_stream_arguments()
+        except ValueError as e:
+            error += str(e)
         if error:
             self.write({'error': error})
             self.set_status(400)
@@ -98,176 +711,3667 @@ class YappiProfileStatsHandler(tornado.web.RequestHandler):
             return
 
         try:
-            statistics = get_profiler_statistics(sort, count, strip_dirs)
-            self.write({'statistics': statistics})
-            self.set_status(200)
+            if stream is None:
+                statistics = yield self.run_in_executor(
+                    functools.partial(self.encode_statistics, sort, count, strip_dirs, **filters))
+            else:
+                statistics = yield self.run_in_executor(
+                    functools.partial(self.get_statistics, sort, count, strip_dirs, **filters))
         except TypeError:
             logger.exception('Error while retrieving profiler statistics')
             self.write({'error': 'No stats available. Start and stop the profiler before trying to retrieve stats.'})
             self.set_status(404)
+            self.finish()
+            return
 
-        self.finish()
+        self.set_status(200)
+        if stream is None:
+            self.write(statistics)
+            self.finish()
+        else:
+            chunks = (statistics[i:i + chunk_size] for i in range(0, len(statistics), chunk_size))
+            yield self.stream_statistics(chunks, stream)
 
     def delete(self):
         """Clear profiler statistics."""
-        clear_stats()
+        self.clear_statistics()
         self.set_status(204)
         self.finish()
 
 
-class YappiProfilerHandler(tornado.web.RequestHandler):
-    def set_default_headers(self):
-        self.set_header('Content-Type', 'application/json')
+class YappiProfileStatsHandler(ProfileStatsHandler):
+
+    route_profiler = None
+    cluster = None
+    peer_stats = None
+
+    @property
+    def sorts(self):
+        if _clock_type == "wall":
+            return ProfileStatsHandler.sorts + WALL_CLOCK_COLUMNS
+        return ProfileStatsHandler.sorts
+
+    def get_filters(self):
+        filters = super(YappiProfileStatsHandler, self).get_filters()
+        route = self.get_argument('route', None)
+        thread = self.get_argument('thread', None)
+        if route is None and thread is None:
+            return filters
+        if 'windows' in filters:
+            raise ValueError("`route` and `thread` can't be combined with `since` or `window`.")
+        if route is not None:
+            tags = self.route_profiler.get_tags(route, self.get_argument('method', None))
+            if not tags:
+                raise ValueError("Unknown `route` '%s'." % route)
+            filters['tags'] = tags
+        if thread is not None:
+            filters['threads'] = match_threads(get_thread_statistics(), thread)
+        return filters
+
+    @tornado.gen.coroutine
+    def get(self):
+        if self.cluster is not None:
+            # Tags are numbered by each worker, so siblings resolve the route themselves
+            route = self.get_argument('route', None)
+            args = () if route is None else (route, self.get_argument('method', None))
+            self.peer_stats = yield self.cluster.broadcast('stats', *args)
+        yield super(YappiProfileStatsHandler, self).get()
+
+    def get_statistics(self, sort, count, strip_dirs, **filters):
+        if 'windows' in filters:
+            return self.windows.get_statistics(filters['windows'], sort, count, strip_dirs,
+                                               filters.get('stats_filter'))
+        if self.peer_stats is not None and 'threads' not in filters:
+            return self.cluster.get_statistics(self.peer_stats, sort, count, strip_dirs, **filters)
+        return get_profiler_statistics(sort, count, strip_dirs, **filters)
+
+    @tornado.gen.coroutine
+    def delete(self):
+        if self.cluster is not None:
+            yield self.cluster.broadcast('clear')
+        super(YappiProfileStatsHandler, self).delete()
+
+    def clear_statistics(self):
+        clear_stats()
+
+
+class ProfilingSessionMixin(object):
+    """Parse and apply the `duration`, `requests`, `rolling` and filter options of `POST /profiler`."""
+
+    session = None
+    windows = None
+
+    def get_session_limits(self):
+        """Return the `duration` and `requests` given in the query string.
 
+        :raises ValueError: with an error message for invalid limits
+        """
+        duration = self.get_argument('duration', None)
+        requests = self.get_argument('requests', None)
+        if duration is not None:
+            try:
+                duration = float(duration)
+            except (ValueError, TypeError):
+                raise ValueError("Can't cast `duration` '%s' to float." % duration)
+            if duration <= 0:
+                raise ValueError("`duration` must be positive.")
+        if requests is not None:
+            try:
+                requests = int(requests)
+            except (ValueError, TypeError):
+                raise ValueError("Can't cast `requests` '%s' to int." % requests)
+            if requests <= 0:
+                raise ValueError("`requests` must be positive.")
+            if not self.session.counting_requests:
+                raise ValueError("`requests` needs an application instrumented with "
+                                 "TornadoProfiler.instrument().")
+        return duration, requests
+
+    def get_collection_filter(self):
+        """Return the :class:`StatsFilter` of the functions to record, None for all.
+
+        :raises ValueError: with an error message for invalid arguments
+        """
+        return parse_stats_filter(self.get_argument('include', None),
+                                  self.get_argument('exclude', None),
+                                  self.get_argument('module', None))
+
+    def get_rolling_interval(self):
+        """Return the `rolling` window interval given in the query string, None if absent.
+
+        :raises ValueError: with an error message for an invalid interval
+        """
+        rolling = self.get_argument('rolling', None)
+        if rolling is None:
+            return None
+        try:
+            rolling = float(rolling)
+        except (ValueError, TypeError):
+            raise ValueError("Can't cast `rolling` '%s' to float." % rolling)
+        if rolling <= 0:
+            raise ValueError("`rolling` must be positive.")
+        return rolling
+
+    def write_status(self, status):
+        """Write the profiler `status`, with the session limits if any."""
+        if self.session is not None and self.session.is_limited():
+            status["session"] = self.session.to_dict()
+        self.write(status)
+
+
+class YappiProfilerHandler(ProfilingSessionMixin, JSONHandler):
+
+    cluster = None
+
+    @tornado.gen.coroutine
     def post(self):
         """Start a new profiler."""
-        if is_profiler_running():
-            self.set_status(201)
+        clock_type = self.get_argument('clock', 'cpu')
+        threads = self.get_bool_argument('threads', False)
+        error = ''
+        if clock_type not in ('cpu', 'wall'):
+            error += "Invalid `clock` '%s', must be in ('cpu', 'wall')." % clock_type
+        elif threads and clock_type == 'wall':
+            error += "`threads` is only supported by the 'cpu' clock."
+        try:
+            duration, requests = self.get_session_limits()
+            rolling = self.get_rolling_interval()
+            stats_filter = self.get_collection_filter()
+        except ValueError as e:
+            error += str(e)
+        if error:
+            self.write({'error': error})
+            self.set_status(400)
             self.finish()
             return
 
-        start_profiling()
+        if not is_profiler_running():
+            start_profiling(clock_type, threads, stats_filter)
+        if rolling is not None:
+            self.windows.start(rolling)
+        if duration is not None or requests is not None:
+            self.session.limit(duration, requests)
+        if self.cluster is not None:
+            args = (clock_type, threads)
+            if stats_filter is not None:
+                args += (self.get_argument('include', None), self.get_argument('exclude', None),
+                         self.get_argument('module', None))
+            yield self.cluster.broadcast('start', *args)
         self.set_status(201)
         self.finish()
 
+    @tornado.gen.coroutine
     def delete(self):
         """Stop the profiler."""
         stop_profiling()
+        if self.windows is not None:
+            self.windows.stop()
+        if self.session is not None:
+            self.session.cancel()
+        if self.cluster is not None:
+            yield self.cluster.broadcast('stop')
         self.set_status(204)
         self.finish()
 
+    @tornado.gen.coroutine
     def get(self):
         """Check if the profiler is running."""
         running = is_profiler_running()
-        self.write({"running": running})
+        if self.cluster is None:
+            self.write_status({"running": running})
+        else:
+            peers = yield self.cluster.broadcast('running')
+            self.write_status({"running": running, "workers": len(peers) + 1,
+                               "running_workers": sum(peers) + running})
         self.set_status(200)
         self.finish()
 
 
-class CProfileWrapper(object):
-    """Wrap cProfile profiler so that it is static between request handlers"""
+# Since Python 3.12 cProfile uses sys.monitoring, which sees every thread
+_CPROFILE_PROFILES_ALL_THREADS = sys.version_info >= (3, 12)
+# thread ident -> (thread name, cProfile.Profile) of the threads started during
+# a 'threads' session. A profiler is enabled for the life of its thread, and
+# freeing an enabled profiler unhooks the freeing thread, so they outlive the
+# CProfileSessionManager which enabled them.
+_cprofile_threads = {}
+_cprofile_threads_lock = threading.Lock()
 
-    profiler = None
-    running = False
+DEFAULT_SESSION = 'default'
 
 
-class CProfileStatsDumpHandler(tornado.web.RequestHandler):
+def _entries_pstats(entries):
+    """Return the pstats dictionary of `cProfile.Profile.getstats()` entries, like `snapshot_stats()`."""
+    stats = {}
+    callers_by_code = {}
+    for entry in entries:
+        callers = callers_by_code[id(entry.code)] = {}
+        stats[cProfile.label(entry.code)] = (entry.callcount - entry.reccallcount, entry.callcount,
+                                             entry.inlinetime, entry.totaltime, callers)
+    for entry in entries:
+        func = cProfile.label(entry.code)
+        for call in entry.calls or ():
+            callers = callers_by_code.get(id(call.code))
+            if callers is None:
+                continue
+            value = (call.callcount, call.callcount - call.reccallcount, call.inlinetime,
+                     call.totaltime)
+            if func in callers:
+                value = tuple(a + b for a, b in zip(value, callers[func]))
+            callers[func] = value
+    return stats
 
-    profiler = CProfileWrapper.profiler
-    running = CProfileWrapper.running
 
-    def set_default_headers(self):
-        self.set_header('Content-Type', 'application/json')
+def _subtract_pstats(stats, baseline):
+    """Return the pstats dictionary of what `stats` recorded since `baseline`."""
+    if not baseline:
+        return stats
+    delta = {}
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        base = baseline.get(func)
+        if base is None:
+            delta[func] = (cc, nc, tt, ct, callers)
+        elif nc != base[1]:
+            # cProfile only counts a call when it returns, so nothing else changed
+            base_callers = base[4]
+            delta[func] = (cc - base[0], nc - base[1], tt - base[2], ct - base[3],
+                           dict((caller, _subtract_caller(value, base_callers.get(caller)))
+                                for caller, value in callers.items()
+                                if value != base_callers.get(caller)))
+    return delta
 
-    def post(self):
-        """Dump current profiler statistics into a file."""
-        filename = self.get_argument('filename', 'dump.prof')
-        CProfileWrapper.profiler.dump_stats(filename)
-        self.finish()
 
+def _subtract_caller(value, base):
+    if base is None:
+        return value
+    if isinstance(value, tuple):
+        return tuple(a - b for a, b in zip(value, base))
+    return value - base
 
-class CProfileStatsHandler(tornado.web.RequestHandler):
 
-    profiler = CProfileWrapper.profiler
-    running = CProfileWrapper.running
-    
-    def set_default_headers(self):
-        self.set_header('Content-Type', 'application/json')
+class CProfileSession(object):
+    """A named profiling session of a :class:`CProfileSessionManager`.
 
-    def get(self):
-        """Return current profiler statistics."""
-        CProfileWrapper.profiler.print_stats()
-        s = StringIO.StringIO()
-        sortby = 'cumulative'
-        ps = pstats.Stats(CProfileWrapper.profiler, stream=s).sort_stats(sortby)
-        ps.print_stats()
-        self.set_status(200)
-        self.write(s.getvalue())
-        self.finish()
+    Its statistics are what the shared profilers recorded since the session
+    started or was cleared, frozen when it stops. `limits` is the
+    :class:`ProfilingSession` stopping it after a duration or requests.
+    """
 
-    def delete(self):
-        """Clear profiler statistics."""
-        CProfileWrapper.profiler.create_stats()
-        self.enable()
-        self.set_status(204)
-        self.finish()
+    def __init__(self, session_id, limits):
+        self.id = session_id
+        self.limits = limits
+        self.running = False
+        self.threads = False
+        self.stats_filter = None
+        self.started = None
+        self.stopped = None
+        # The profilers' entries are only copied when the session starts, stops
+        # or is cleared, and turned into pstats dictionaries with its statistics
+        self._baseline = {}  # thread ident -> getstats() entries at start or clear
+        self._baseline_stats = None  # thread ident -> pstats dictionary of _baseline
+        self._final_entries = None  # thread ident -> getstats() entries at stop
+        self._final = None  # thread ident -> pstats dictionary since the baseline, once stopped
+        self._cache = {}  # threads -> merged pstats dictionary of the stopped session
+        self._engines = {}  # (strip_dirs, threads) -> (generation, StatsEngine)
+        self._generation = 0  # changes with the statistics of the stopped session
 
+    def to_dict(self):
+        session = {"id": self.id,
+                   "running": self.running,
+                   "threads": self.threads,
+                   "started": self.started,
+                   "duration": ((self.stopped or time.time()) - self.started) if self.started else 0}
+        if self.limits.is_limited():
+            session["limits"] = self.limits.to_dict()
+        return session
 
-class CProfileHandler(tornado.web.RequestHandler):
 
-    profiler = CProfileWrapper.profiler
-    running = CProfileWrapper.running
+class CProfileSessionManager(object):
+    """Named, concurrent cProfile sessions sharing one collector.
 
-    def set_default_headers(self):
-        self.set_header('Content-Type', 'application/json')
+    cProfile runs a single profiler per thread (per process since Python
+    3.12), so sessions can't each enable their own. The manager enables one
+    when the first session starts and disables it once the last session
+    stops. While a session profiles `threads`, every thread started gets its
+    own profiler, which stays enabled until the thread exits: a thread can
+    only hook itself, so a pool thread unhooked between two sessions could
+    never be profiled again. Each session subtracts the statistics it
+    started from, which excludes the calls made between sessions. Before
+    Python 3.12, threads started before the first such session are not
+    profiled.
+    """
 
-    def post(self):
-        """Start a new profiler."""
-        CProfileWrapper.profiler = cProfile.Profile()
-        CProfileWrapper.profiler.enable()
-        self.running = True
-        self.set_status(201)
-        self.finish()
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sessions = {}
+        self._profiler = None  # cProfile.Profile of the thread the sessions are started in
+        self._main = None  # ident of that thread
+        self._main_name = None
 
-    def delete(self):
-        """Stop the profiler."""
-        CProfileWrapper.profiler.disable()
-        self.running = False
-        self.set_status(204)
-        self.finish()
+    def get(self, session_id=DEFAULT_SESSION):
+        """Return the session `session_id`, None if it was never started."""
+        return self._sessions.get(session_id)
 
-    def get(self):
-        """Check if the profiler is running."""
-        self.write({"running": self.running})
-        self.set_status(200)
-        self.finish()
+    def sessions(self):
+        """Return the description of every session."""
+        return [session.to_dict() for _, session in sorted(self._sessions.items())]
 
+    def is_running(self, session_id=DEFAULT_SESSION):
+        session = self._sessions.get(session_id)
+        return session is not None and session.running
 
-class TornadoProfiler(object):
+    def start(self, session_id=DEFAULT_SESSION, threads=False, stats_filter=None):
+        """Start, or restart, the session `session_id` and return it.
 
-    def __init__(self, prefix="", handler_base_class=object, backend='yappi'):
-        self.prefix = prefix
-        self.handler_base_class = handler_base_class
-        self.backend = backend
+        :param bool threads: also profile the threads started from now on
+        :param StatsFilter|None stats_filter: only report the functions it
+            matches, cProfile can't skip the others
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                limits = ProfilingSession(functools.partial(self.stop, session_id))
+                session = self._sessions[session_id] = CProfileSession(session_id, limits)
+            elif session.running:
+                return session
+            if not any(other.running for other in self._sessions.values()):
+                self._enable()
+            if threads and not _CPROFILE_PROFILES_ALL_THREADS:
+                threading.setprofile(self._profile_new_thread)
+            session.running = True
+            session.threads = threads
+            session.stats_filter = stats_filter
+            session.started = time.time()
+            session.stopped = None
+            session._baseline = self._entries(session)
+            session._baseline_stats = None
+            session._final_entries = session._final = None
+            session._cache = {}
+            session._generation += 1
+            return session
 
-    def get_routes(self):
+    def stop(self, session_id=DEFAULT_SESSION):
+        """Stop the session `session_id`, keeping its statistics."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or not session.running:
+                return
+            session.limits.cancel()
+            session._final_entries = self._entries(session)
+            session._generation += 1
+            session.running = False
+            session.stopped = time.time()
+            running = [other for other in self._sessions.values() if other.running]
+            if not any(other.threads for other in running):
+                threading.setprofile(None)
+            if not running:
+                self._disable()
 
-        if self.backend == 'yappi':
-            class UpdatedProfilerHandler(
-                YappiProfilerHandler, self.handler_base_class):
-                pass
+    def remove(self, session_id):
+        """Forget the stopped session `session_id` and its statistics. Return False if it is running or unknown."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None or session.running:
+                return False
+            del self._sessions[session_id]
+            return True
 
-            class UpdatedProfileStatsHandler(
-                YappiProfileStatsHandler, self.handler_base_class):
-                pass
+    def record_request(self, route_stats, latency):
+        """Count one request against the `requests` limit of every session, see :attr:`RouteProfiler.listeners`."""
+        for session in list(self._sessions.values()):
+            session.limits.record_request(route_stats, latency)
 
-            return [
-                (self.prefix + "/profiler", UpdatedProfilerHandler),
-                (self.prefix + "/profiler/stats", UpdatedProfileStatsHandler)
-            ]
+    def clear(self, session_id=DEFAULT_SESSION):
+        """Discard the statistics of the session `session_id`."""
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return
+            if session.running:
+                session._baseline = self._entries(session)
+                session._baseline_stats = None
+            else:
+                session._final_entries = None
+                session._final = {}
+            session._cache = {}
+            session._generation += 1
 
-        elif self.backend == "cprofile" or self.backend == "cProfile":
-            class UpdatedProfilerHandler(
-                CProfileHandler, self.handler_base_class):
-                pass
+    def get_stats(self, session_id=DEFAULT_SESSION, threads=None):
+        """Return the `pstats.Stats` of a session, merged across threads.
 
-            class UpdatedProfileStatsHandler(
-                CProfileStatsHandler, self.handler_base_class):
-                pass
+        :param tuple|None threads: only include these thread idents
+        :raises NoStatsAvailableError: if the session wasn't started or
+            profiled nothing
+        """
+        session = self._sessions.get(session_id)
+        merged = None
+        if session is not None and not session.running:
+            merged = session._cache.get(threads)
+        if merged is None:
+            holders = [_PStatsHolder(dict(stats))
+                       for stats in self._session_stats(session_id, threads).values()]
+            if not holders:
+                raise NoStatsAvailableError("No cProfile statistics available.")
+            merged = pstats.Stats(*holders).stats
+            if not session.running:
+                session._cache[threads] = merged
+        return pstats.Stats(_PStatsHolder(dict(merged)))
 
-            class UpdatedProfileStatsDumpHandler(
-                CProfileStatsDumpHandler, self.handler_base_class):
-                pass
+    def get_statistics(self, session_id=DEFAULT_SESSION, sort="cum_time", count=20,
+                       strip_dirs=True, threads=None, stats_filter=None):
+        """Return the statistics of a session, see :func:`get_profiler_statistics`.
 
-            return [
-                (self.prefix + "/profiler", UpdatedProfilerHandler),
-                (self.prefix + "/profiler/stats", UpdatedProfileStatsHandler),
-                (self.prefix + "/profiler/stats/dump", UpdatedProfileStatsDumpHandler)
-            ]
+        The rows of a stopped session are only built once, later calls are
+        served from its :class:`StatsEngine`.
 
+        :param tuple|None threads: only include these thread idents
+        :raises NoStatsAvailableError: if the session wasn't started or
+            profiled nothing
+        """
+        session = self._sessions.get(session_id)
+        if session is None:
+            raise NoStatsAvailableError("Session '%s' has not been started." % session_id)
+        generation = session._generation
+        cached = session._engines.get((strip_dirs, threads))
+        if cached is None or session.running or cached[0] != generation:
+            engine = cached[1] if cached is not None else StatsEngine(strip_dirs)
+            # pstats entries are (primitive calls, calls, total time, cum time, callers)
+            engine.update([FuncStat(path, line, func_name, cc, nc, tt, ct)
+                           for stats in self._session_stats(session_id, threads).values()
+                           for (path, line, func_name), (cc, nc, tt, ct, _) in stats.items()])
+            cached = session._engines[(strip_dirs, threads)] = (generation, engine)
+        return cached[1].top(sort, count, stats_filter)
 
-        else:
-            raise ValueError("No such backend.")
+    def get_profiled_time(self, session_id=DEFAULT_SESSION):
+        """Return the seconds spent in a session's functions, excluding callees, and its duration."""
+        session = self._sessions.get(session_id)
+        if session is None:
+            return 0.0, 0.0
+        total_time = sum(value[2] for stats in self._session_stats(session_id).values()
+                         for value in stats.values())
+        return total_time, session.to_dict()["duration"]
+
+    def get_threads(self, session_id=DEFAULT_SESSION):
+        """Return the time spent in every thread profiled by a session, most busy first."""
+        session = self._sessions.get(session_id)
+        if session is None:
+            return []
+        elapsed = session.to_dict()["duration"]
+        threads = []
+        for ident, stats in self._session_stats(session_id).items():
+            total_time = sum(value[2] for value in stats.values())
+            threads.append({"id": ident, "name": self._thread_name(ident),
+                            "total_time": total_time,
+                            "utilization": total_time / elapsed if elapsed else 0})
+        return sorted(threads, key=itemgetter("total_time"), reverse=True)
+
+    def _session_stats(self, session_id, threads=None):
+        """Return {thread ident: pstats dictionary} of a session.
+
+        Builds the pstats dictionaries outside of the lock, callers run it in the executor.
+        """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                raise NoStatsAvailableError("Session '%s' has not been started." % session_id)
+            running = session.running
+            generation = session._generation
+            per_thread = session._final
+            baseline, baseline_stats = session._baseline, session._baseline_stats
+            stats_filter = session.stats_filter
+            if per_thread is None:
+                entries = self._entries(session) if running else session._final_entries
+        if per_thread is None:
+            if baseline_stats is None:
+                baseline_stats = dict((ident, _entries_pstats(thread_entries))
+                                      for ident, thread_entries in baseline.items())
+            per_thread = self._delta(entries, baseline_stats, stats_filter)
+            with self._lock:
+                if session._baseline is baseline:
+                    session._baseline_stats = baseline_stats
+                if not running and session._generation == generation:
+                    session._final = per_thread
+                    session._final_entries = None
+                    session._baseline, session._baseline_stats = {}, None
+        if threads is not None:
+            per_thread = dict((ident, stats) for ident, stats in per_thread.items()
+                              if ident in threads)
+        return dict((ident, stats) for ident, stats in per_thread.items() if stats)
+
+    def _delta(self, entries, baseline, stats_filter):
+        delta = {}
+        for ident, thread_entries in entries.items():
+            stats = _subtract_pstats(_entries_pstats(thread_entries), baseline.get(ident))
+            if stats_filter is not None:
+                stats = dict((func, value) for func, value in stats.items()
+                             if stats_filter.matches(func))
+            delta[ident] = stats
+        return delta
+
+    def _entries(self, session):
+        """Return {thread ident: getstats() entries} of the profilers of the threads `session` profiles.
+
+        Only copies the profilers' entries, the pstats dictionaries are built
+        from them by :meth:`_session_stats` in the executor.
+        """
+        profilers = [(self._main, self._profiler)]
+        if session.threads:
+            profilers.extend((ident, profiler)
+                             for ident, (_, profiler) in list(_cprofile_threads.items())
+                             if ident != self._main)
+        return dict((ident, profiler.getstats()) for ident, profiler in profilers)
+
+    def _thread_name(self, ident):
+        if ident == self._main:
+            return self._main_name
+        profiler = _cprofile_threads.get(ident)
+        return profiler[0] if profiler is not None else str(ident)
+
+    def _enable(self):
+        thread = threading.current_thread()
+        # The statistics of exited threads are in the stopped sessions by now.
+        # Freeing their profilers unhooks the current thread, so this happens
+        # before its profiler is enabled.
+        alive = set(other.ident for other in threading.enumerate())
+        with _cprofile_threads_lock:
+            for ident in [ident for ident in _cprofile_threads if ident not in alive]:
+                del _cprofile_threads[ident]
+        if self._main != thread.ident:
+            self._profiler = cProfile.Profile()
+            self._main = thread.ident
+            self._main_name = thread.name
+        self._profiler.enable()
+
+    def _disable(self):
+        # disable() only unhooks the calling thread, the profilers of the
+        # other threads stay enabled for the next session
+        self._profiler.disable()
+
+    def _profile_new_thread(self, frame, event, arg):
+        """`threading.setprofile` hook enabling a profiler in each new thread.
+
+        Enabling the profiler replaces this hook for the rest of the thread.
+        """
+        thread = threading.current_thread()
+        profiler = cProfile.Profile()
+        with _cprofile_threads_lock:
+            _cprofile_threads[thread.ident] = (thread.name, profiler)
+        profiler.enable()
+
+
+class CProfileSessionMixin(object):
+    """Resolve the cProfile session a request is for, the default one without a path argument."""
+
+    sessions = None
+
+    def get_session(self, session_id):
+        """Return the started session `session_id`, or write a 404 and return None."""
+        session = self.sessions.get(session_id)
+        if session is None:
+            self.write({'error': "Session '%s' has not been started." % session_id})
+            self.set_status(404)
+            self.finish()
+        return session
+
+
+class CProfileStatsDumpHandler(CProfileSessionMixin, StatsStreamMixin, JSONHandler):
+
+    @tornado.gen.coroutine
+    def post(self):
+        """Dump current profiler statistics into a file."""
+        filename = self.get_argument('filename', 'dump.prof')
+        if self.get_session(DEFAULT_SESSION) is None:
+            return
+        yield self.run_in_executor(self.dump_stats, filename)
+        self.finish()
+
+    def dump_stats(self, filename):
+        self.sessions.get_stats().dump_stats(filename)
+
+
+class CProfileStatsHandler(CProfileSessionMixin, ProfileStatsHandler):
+
+    session_id = DEFAULT_SESSION
+
+    @tornado.gen.coroutine
+    def get(self, session_id=DEFAULT_SESSION):
+        if self.get_session(session_id) is None:
+            return
+        self.session_id = session_id
+        yield super(CProfileStatsHandler, self).get()
+
+    def delete(self, session_id=DEFAULT_SESSION):
+        if self.get_session(session_id) is None:
+            return
+        self.session_id = session_id
+        super(CProfileStatsHandler, self).delete()
+
+    def get_filters(self):
+        filters = super(CProfileStatsHandler, self).get_filters()
+        thread = self.get_argument('thread', None)
+        if thread is not None:
+            filters['threads'] = match_threads(self.sessions.get_threads(self.session_id), thread)
+        return filters
+
+    def get_statistics(self, sort, count, strip_dirs, **filters):
+        return self.sessions.get_statistics(self.session_id, sort, count, strip_dirs, **filters)
+
+    def clear_statistics(self):
+        self.sessions.clear(self.session_id)
+
+
+class CProfileHandler(ProfilingSessionMixin, CProfileSessionMixin, JSONHandler):
+
+    def post(self, session_id=DEFAULT_SESSION):
+        """Start a new profiler, stopped after `duration` seconds or `requests` requests if given."""
+        threads = self.get_bool_argument('threads', False)
+        try:
+            duration, requests = self.get_session_limits()
+            stats_filter = self.get_collection_filter()
+        except ValueError as e:
+            self.write({'error': str(e)})
+            self.set_status(400)
+            self.finish()
+            return
+        session = self.sessions.start(session_id, threads, stats_filter)
+        if duration is not None or requests is not None:
+            session.limits.limit(duration, requests)
+        self.set_status(201)
+        self.finish()
+
+    def delete(self, session_id=None):
+        """Stop the profiler, or remove the session `session_id` if it is stopped."""
+        if session_id is None:
+            self.sessions.stop()
+        else:
+            session = self.get_session(session_id)
+            if session is None:
+                return
+            if session.running:
+                self.sessions.stop(session_id)
+            else:
+                self.sessions.remove(session_id)
+        self.set_status(204)
+        self.finish()
+
+    def get(self, session_id=None):
+        """Check if the profiler is running, or describe the session `session_id`."""
+        if session_id is None:
+            status = {"running": self.sessions.is_running()}
+            session = self.sessions.get()
+            if session is not None and session.limits.is_limited():
+                status["session"] = session.limits.to_dict()
+            self.write(status)
+        else:
+            session = self.get_session(session_id)
+            if session is None:
+                return
+            self.write(session.to_dict())
+        self.set_status(200)
+        self.finish()
+
+
+class CProfileSessionsHandler(CProfileSessionMixin, JSONHandler):
+
+    def get(self):
+        """List the cProfile sessions."""
+        self.write({"sessions": self.sessions.sessions()})
+        self.set_status(200)
+        self.finish()
+
+
+FuncStat = namedtuple('FuncStat', 'module lineno name ncall nactualcall tsub ttot')
+
+
+class SamplingProfiler(object):
+    """Statistical profiler that samples the stack of one thread.
+
+    A background thread captures the stack of the profiled thread (the IOLoop
+    thread, by default the thread calling :meth:`start`) every `interval`
+    seconds. Each sample is weighted by the time elapsed since the previous
+    one: the function on top of the stack is charged `total_time`, and every
+    function on the stack is charged `cum_time` and one sample in `num_calls`.
+    Unlike yappi and cProfile nothing runs on function calls, so the overhead
+    is bounded by the sampling rate and is reported by :meth:`overhead`.
+    """
+
+    max_depth = 128
+    max_stacks = 10000
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = None
+        self._target = None
+        self._engines = {}
+        self._call_graphs = {}
+        self._generation = 0
+        self.stats_filter = None
+        self.clear_stats()
+
+    def start(self, thread_id=None, stats_filter=None):
+        """Start sampling `thread_id`, or the current thread if None.
+
+        With a :class:`StatsFilter` only the frames it matches are recorded.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._target = thread_id or threading.current_thread().ident
+            self.stats_filter = stats_filter
+            self._stopping = threading.Event()
+            self._started = time.time()
+            self._thread = threading.Thread(target=self._run, args=(self._stopping,),
+                                            name='tornado-profile-sampler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Stop sampling, keeping the collected statistics."""
+        with self._lock:
+            thread, self._thread = self._thread, None
+            if thread is None:
+                return
+            self._stopping.set()
+            self._elapsed += time.time() - self._started
+        thread.join()
+
+    def is_running(self):
+        """Return True if the profiler is sampling."""
+        return self._thread is not None
+
+    def clear_stats(self):
+        """Discard all collected samples."""
+        with self._lock:
+            self._clear()
+
+    def collect_stats(self):
+        """Return the samples as `FuncStat` records and discard them, without losing any in between."""
+        with self._lock:
+            func_stats = self._func_stats()
+            self._clear()
+        return func_stats
+
+    def overhead(self):
+        """Return the fraction of wall time spent taking samples."""
+        with self._lock:
+            elapsed = self._elapsed
+            if self._thread is not None:
+                elapsed += time.time() - self._started
+            return self._sampling_time / elapsed if elapsed else 0.0
+
+    def get_func_stats(self):
+        """Return the samples as yappi-like `FuncStat` records."""
+        with self._lock:
+            return self._func_stats()
+
+    def get_stacks(self):
+        """Return the sampled stacks as (stack, samples, time) with the root first."""
+        with self._lock:
+            return [(stack, samples, weight) for stack, (samples, weight) in self._stacks.items()]
+
+    def get_call_graph(self, strip_dirs=True):
+        """Return the :class:`CallGraph` of the sampled stacks, rebuilt after new samples."""
+        version = (self._generation, self.samples)
+        cached = self._call_graphs.get(strip_dirs)
+        if cached is None or cached[0] != version:
+            stats = _stacks_to_pstats(self.get_stacks())
+            cached = self._call_graphs[strip_dirs] = (
+                version, CallGraph(_strip_pstats(stats) if strip_dirs else stats))
+        return cached[1]
+
+    def get_statistics(self, sort="cum_time", count=20, strip_dirs=True, stats_filter=None):
+        """Return statistics in the same format as :func:`get_profiler_statistics`."""
+        engine = self._engines.get(strip_dirs)
+        if engine is None:
+            engine = self._engines.setdefault(strip_dirs, StatsEngine(strip_dirs))
+        engine.update(self.get_func_stats())
+        return engine.top(sort, count, stats_filter)
+
+    def _clear(self):
+        self._generation += 1
+        self.samples = 0
+        self._counters = {}  # function -> [samples, self time, cum time]
+        self._stacks = {}  # stack tuple, root first -> [samples, time]
+        self._sampling_time = 0.0
+        self._elapsed = 0.0
+        self._started = time.time()
+
+    def _func_stats(self):
+        return [FuncStat(path, line, func_name, samples, samples, self_time, cum_time)
+                for (path, line, func_name), (samples, self_time, cum_time)
+                in self._counters.items()]
+
+    def _run(self, stopping):
+        last = time.time()
+        while not stopping.wait(self.interval):
+            now = time.time()
+            self._sample(now - last)
+            last = now
+            with self._lock:
+                self._sampling_time += time.time() - now
+
+    def _sample(self, weight):
+        frame = sys._current_frames().get(self._target)
+        stats_filter = self.stats_filter
+        stack = []
+        while frame is not None and len(stack) < self.max_depth:
+            code = frame.f_code
+            if stats_filter is None or stats_filter.matches_code(code):
+                stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+            frame = frame.f_back
+        del frame
+        if not stack:
+            return
+
+        with self._lock:
+            self.samples += 1
+            counters = self._counters
+            for func in set(stack):
+                counter = counters.get(func)
+                if counter is None:
+                    counter = counters[func] = [0, 0.0, 0.0]
+                counter[0] += 1
+                counter[2] += weight
+            counters[stack[0]][1] += weight
+
+            stack.reverse()
+            stack = tuple(stack)
+            counter = self._stacks.get(stack)
+            if counter is not None:
+                counter[0] += 1
+                counter[1] += weight
+            elif len(self._stacks) < self.max_stacks:
+                self._stacks[stack] = [1, weight]
+
+
+WALL_CLOCK_COLUMNS = ('cpu_time', 'wait_time')
+WallFuncStat = namedtuple('WallFuncStat', FuncStat._fields + WALL_CLOCK_COLUMNS)
+
+_wall_clock = getattr(time, 'perf_counter', time.time)
+_cpu_clock = getattr(time, 'thread_time', None) or getattr(time, 'process_time', None) or time.clock
+_GENERATOR_FLAGS = 0x20 | 0x80 | 0x100 | 0x200  # generator, coroutine, iterable and async generator
+_YIELD_VALUE = dis.opmap['YIELD_VALUE']
+_YIELD_FROM = dis.opmap.get('YIELD_FROM')  # Python < 3.11
+
+
+def _is_suspended(frame):
+    """Return True if `frame` is a generator or coroutine returning from a yield."""
+    if not frame.f_code.co_flags & _GENERATOR_FLAGS:
+        return False
+    code = bytearray(frame.f_code.co_code)
+    lasti = frame.f_lasti
+    if code[lasti] in (_YIELD_VALUE, _YIELD_FROM):
+        return True
+    # While suspended in `yield from` / `await`, Python 3.6 - 3.10 point
+    # f_lasti at the instruction before YIELD_FROM
+    return lasti + 2 < len(code) and code[lasti + 2] == _YIELD_FROM
+
+
+class WallClockProfiler(object):
+    """Coroutine aware profiler measuring wall-clock and CPU time of one thread.
+
+    The profiler is installed with `sys.setprofile` in the thread calling
+    :meth:`start`. A generator or coroutine gets a call and a return event each
+    time it is resumed and suspended; the profiler keeps the state of the frame
+    between them and stitches them back into one logical call. `cum_time` is
+    the wall-clock time from the first resume to the final return, including
+    the time spent suspended, `cpu_time` is the CPU time used while the frame
+    was running and `wait_time` is the difference. `total_time` is the
+    wall-clock time the frame was running, excluding the functions it called.
+
+    The call stack is only touched by the profiled thread. The counters of
+    finished calls are guarded by a lock, so other threads can read or
+    collect them.
+    """
+
+    def __init__(self):
+        self._thread_id = None
+        self._lock = threading.Lock()
+        self.stats_filter = None
+        self.clear_stats()
+
+    def start(self, stats_filter=None):
+        """Start profiling the current thread.
+
+        With a :class:`StatsFilter` the functions it doesn't match are not
+        traced, their time is charged to their caller.
+        """
+        if self._thread_id is not None:
+            return
+        self._thread_id = threading.current_thread().ident
+        self.stats_filter = stats_filter
+        self._stack = []
+        sys.setprofile(self._profile)
+
+    def stop(self):
+        """Stop profiling, must be called from the profiled thread."""
+        if self._thread_id is None:
+            return
+        sys.setprofile(None)
+        self._thread_id = None
+        self._stack = []
+        self._frames = {}
+
+    def is_running(self):
+        """Return True if the profiler is running."""
+        return self._thread_id is not None
+
+    def clear_stats(self):
+        """Discard all collected statistics, must be called from the profiled thread while running."""
+        self._stack = []
+        self._frames = {}  # frame -> [first wall, cpu time, self wall time]
+        with self._lock:
+            self._counters = {}  # function -> [calls, self wall time, cum wall time, cpu time]
+
+    def collect_stats(self):
+        """Return the statistics of the finished calls and discard them, from any thread.
+
+        Calls in progress keep their state and are counted once they return.
+        """
+        with self._lock:
+            counters, self._counters = self._counters, {}
+        return self._func_stats(counters)
+
+    def get_func_stats(self):
+        """Return the statistics as `WallFuncStat` records."""
+        with self._lock:
+            counters = dict((func, tuple(counter)) for func, counter in self._counters.items())
+        return self._func_stats(counters)
+
+    def _func_stats(self, counters):
+        return [WallFuncStat(path, line, func_name, calls, calls, total_time, cum_time,
+                             cpu_time, max(cum_time - cpu_time, 0.0))
+                for (path, line, func_name), (calls, total_time, cum_time, cpu_time)
+                in counters.items()]
+
+    def _profile(self, frame, event, arg):
+        if event == 'call':
+            if self.stats_filter is not None and not self.stats_filter.matches_code(frame.f_code):
+                return
+            wall, cpu = _wall_clock(), _cpu_clock()
+            stack = self._stack
+            if stack:
+                parent = stack[-1]
+                self._frames[parent[0]][2] += wall - parent[2]
+            if frame not in self._frames:
+                self._frames[frame] = [wall, 0.0, 0.0]
+            stack.append([frame, cpu, wall])
+        elif event == 'return':
+            stack = self._stack
+            if not stack or stack[-1][0] is not frame:
+                # Returning from a frame entered before the profiler started
+                return
+            wall, cpu = _wall_clock(), _cpu_clock()
+            _, entered_cpu, resumed = stack.pop()
+            state = self._frames[frame]
+            state[1] += cpu - entered_cpu
+            state[2] += wall - resumed
+            if stack:
+                stack[-1][2] = wall
+            if _is_suspended(frame):
+                return
+
+            del self._frames[frame]
+            code = frame.f_code
+            func = (code.co_filename, code.co_firstlineno, code.co_name)
+            with self._lock:
+                counter = self._counters.get(func)
+                if counter is None:
+                    counter = self._counters[func] = [0, 0.0, 0.0, 0.0]
+                counter[0] += 1
+                counter[1] += state[2]
+                counter[2] += wall - state[0]
+                counter[3] += state[1]
+
+
+_wall_clock_profiler = WallClockProfiler()
+
+
+class SamplingProfilerHandler(ProfilingSessionMixin, JSONHandler):
+
+    profiler = None
+
+    def post(self):
+        """Start sampling the IOLoop thread."""
+        try:
+            duration, requests = self.get_session_limits()
+            rolling = self.get_rolling_interval()
+            stats_filter = self.get_collection_filter()
+        except ValueError as e:
+            self.write({'error': str(e)})
+            self.set_status(400)
+            self.finish()
+            return
+        self.profiler.start(stats_filter=stats_filter)
+        if rolling is not None:
+            self.windows.start(rolling)
+        if duration is not None or requests is not None:
+            self.session.limit(duration, requests)
+        self.set_status(201)
+        self.finish()
+
+    def delete(self):
+        """Stop the profiler."""
+        self.profiler.stop()
+        if self.windows is not None:
+            self.windows.stop()
+        if self.session is not None:
+            self.session.cancel()
+        self.set_status(204)
+        self.finish()
+
+    def get(self):
+        """Check if the profiler is running and how much it costs."""
+        self.write_status({"running": self.profiler.is_running(),
+                           "samples": self.profiler.samples,
+                           "overhead": self.profiler.overhead()})
+        self.set_status(200)
+        self.finish()
+
+
+class SamplingProfileStatsHandler(ProfileStatsHandler):
+
+    profiler = None
+
+    def get_statistics(self, sort, count, strip_dirs, **filters):
+        if 'windows' in filters:
+            return self.windows.get_statistics(filters['windows'], sort, count, strip_dirs,
+                                               filters.get('stats_filter'))
+        return self.profiler.get_statistics(sort, count, strip_dirs, filters.get('stats_filter'))
+
+    def clear_statistics(self):
+        self.profiler.clear_stats()
+
+
+class _ThreadLocalVar(threading.local):
+    """Stand-in for `contextvars.ContextVar` on Pythons without it.
+
+    The value is not carried across `yield`, so time spent by other requests
+    while a coroutine handler is suspended is attributed to that handler.
+    """
+
+    value = 0
+
+    def get(self):
+        return self.value
+
+    def set(self, value):
+        self.value = value
+
+
+if contextvars is not None:
+    _current_route = contextvars.ContextVar('tornado_profile_route', default=0)
+else:
+    _current_route = _ThreadLocalVar()
+
+
+class RingBuffer(object):
+    """Preallocated ring of the `size` most recent float values."""
+
+    __slots__ = ('count', '_values')
+
+    def __init__(self, size):
+        self.count = 0
+        self._values = array('d', [0.0]) * size
+
+    def append(self, value):
+        """Add a value, overwriting the oldest one once the ring is full."""
+        self._values[self.count % len(self._values)] = value
+        self.count += 1
+
+    def last(self):
+        """Return the most recent value, None if empty."""
+        return self._values[(self.count - 1) % len(self._values)] if self.count else None
+
+    def values(self):
+        """Return the values in the ring, in no particular order."""
+        return self._values[:min(self.count, len(self._values))].tolist()
+
+    def percentiles(self, *quantiles):
+        """Return the nearest-rank value for each quantile, None if empty."""
+        values = sorted(self.values())
+        if not values:
+            return [None for _ in quantiles]
+        return [values[max(int(math.ceil(q * len(values))) - 1, 0)] for q in quantiles]
+
+
+class Histogram(object):
+    """Preallocated histogram of durations with power of two bucket bounds."""
+
+    __slots__ = ('bounds', 'count', 'sum', '_counts')
+
+    def __init__(self, smallest=0.0005, buckets=16):
+        self.bounds = tuple(smallest * 2 ** i for i in range(buckets))
+        self.count = 0
+        self.sum = 0.0
+        self._counts = array('l', [0]) * (buckets + 1)
+
+    def add(self, duration):
+        """Count one duration in seconds."""
+        self._counts[bisect.bisect_left(self.bounds, duration)] += 1
+        self.count += 1
+        self.sum += duration
+
+    def to_dict(self):
+        """Return the histogram with cumulative bucket counts, like Prometheus."""
+        buckets = []
+        total = 0
+        for bound, count in zip(self.bounds + ("+Inf",), self._counts):
+            total += count
+            buckets.append([bound, total])
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class RouteStats(object):
+    """Request count and most recent latencies of one route and HTTP method."""
+
+    __slots__ = ('route', 'method', 'tag', '_latencies')
+
+    def __init__(self, route, method, tag, size):
+        self.route = route
+        self.method = method
+        self.tag = tag
+        self._latencies = RingBuffer(size)
+
+    @property
+    def count(self):
+        return self._latencies.count
+
+    def add(self, latency):
+        """Record the latency in seconds of one request."""
+        self._latencies.append(latency)
+
+    def percentiles(self, *quantiles):
+        """Return the latency for each quantile over the recent requests."""
+        return self._latencies.percentiles(*quantiles)
+
+
+class RouteProfiler(object):
+    """Attribute the requests of a `tornado.web.Application` to their routes.
+
+    :meth:`instrument` replaces every handler of the application with a
+    subclass that records the request latency and marks the route as current
+    while the handler runs. The yappi backend reads the current route through
+    its tag callback, so profile time can be filtered per route.
+    """
+
+    def __init__(self, latency_samples=1024):
+        self.latency_samples = latency_samples
+        self.listeners = []  # called with (RouteStats, latency) after each request
+        self.tracer = None  # RequestTracer of single requests
+        self._routes = {}  # (route, method) -> RouteStats
+
+    def instrument(self, application):
+        """Wrap the handlers of `application`, return the application."""
+        self._instrument_router(application.default_router)
+        return application
+
+    def get(self, route, method):
+        """Return the RouteStats for `route` and `method`, creating it if needed."""
+        stats = self._routes.get((route, method))
+        if stats is None:
+            stats = RouteStats(route, method, len(self._routes) + 1, self.latency_samples)
+            self._routes[(route, method)] = stats
+        return stats
+
+    def get_tags(self, route, method=None):
+        """Return the yappi tags of `route`, optionally only for `method`."""
+        return tuple(stats.tag for stats in self.routes()
+                     if stats.route == route and method in (None, stats.method))
+
+    def routes(self):
+        """Return the RouteStats of every route which received a request."""
+        return list(self._routes.values())
+
+    def _instrument_router(self, router):
+        for rule in getattr(router, 'rules', ()):
+            target = rule.target
+            if isinstance(target, type) and issubclass(target, tornado.web.RequestHandler):
+                # Leave the profiler's own handlers and wrapped handlers alone
+                if target.__module__ == __name__ or hasattr(target, '_profiled_route'):
+                    continue
+                regex = getattr(rule.matcher, 'regex', None)
+                route = regex.pattern.rstrip('$') if regex else target.__name__
+                rule.target = self._wrap(target, route)
+                if hasattr(rule, 'handler_class'):
+                    rule.handler_class = rule.target
+            else:
+                self._instrument_router(target)
+
+    def _wrap(self, handler_class, route):
+        route_profiler = self
+
+        def prepare(self):
+            self._route_stats = route_profiler.get(route, self.request.method)
+            _current_route.set(self._route_stats.tag)
+            if route_profiler.tracer is not None:
+                self._trace = route_profiler.tracer.begin(self)
+            return super(wrapped, self).prepare()
+
+        def on_finish(self):
+            _current_route.set(0)
+            stats = getattr(self, '_route_stats', None)
+            if stats is not None:
+                latency = self.request.request_time()
+                if getattr(self, '_trace', None) is not None:
+                    route_profiler.tracer.end(self, self._trace, latency)
+                    self._trace = None
+                stats.add(latency)
+                for listener in route_profiler.listeners:
+                    listener(stats, latency)
+            return super(wrapped, self).on_finish()
+
+        wrapped = type(handler_class.__name__, (handler_class,), {
+            '__module__': handler_class.__module__,
+            '_profiled_route': route,
+            'prepare': prepare,
+            'on_finish': on_finish,
+        })
+        return wrapped
+
+
+if contextvars is not None:
+    _current_trace = contextvars.ContextVar('tornado_profile_trace', default=None)
+else:
+    _current_trace = _ThreadLocalVar()
+
+
+class RequestTracer(object):
+    """Profile single requests of an instrumented application, keeping the slow ones.
+
+    A request is traced when it has the `header` or the query `argument`,
+    or at random for a `rate` fraction of the requests. While traced
+    requests are in flight a `sys.setprofile` hook in the IOLoop thread hands
+    the events of each request's context to its own :class:`WallClockProfiler`,
+    so concurrent requests don't mix and untraced ones only pay for a context
+    lookup. Requests slower than `threshold` seconds keep their profile, up
+    to the `size` most recently used.
+
+    Requests aren't traced while yappi, cProfile or the wall clock profiler
+    hold the profile hook of the IOLoop thread. Work done in other threads
+    isn't traced. Without `contextvars` time spent by other requests while a
+    traced one is suspended is charged to it, see :class:`_ThreadLocalVar`.
+    """
+
+    def __init__(self, rate=0.0, threshold=0.5, size=100, header=None, argument=None):
+        self.rate = rate
+        self.threshold = threshold
+        self.size = size
+        self.header = header
+        self.argument = argument
+        self.traced = 0
+        self._active = 0
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self._requests = OrderedDict()  # id -> (description, function statistics)
+
+    def is_enabled(self):
+        return bool(self.rate or self.header or self.argument)
+
+    def begin(self, handler):
+        """Start tracing the request of `handler` if it is sampled, return its profiler or None."""
+        if not self._sampled(handler):
+            return None
+        if _yappi_running() or sys.getprofile() not in (None, self._dispatch):
+            return None
+        profiler = WallClockProfiler()
+        _current_trace.set(profiler)
+        if self._active == 0:
+            sys.setprofile(self._dispatch)
+        self._active += 1
+        self.traced += 1
+        return profiler
+
+    def end(self, handler, profiler, latency):
+        """Stop tracing a request, keeping its profile if it took `threshold` seconds or more."""
+        _current_trace.set(None)
+        self._active -= 1
+        if self._active == 0 and sys.getprofile() == self._dispatch:
+            sys.setprofile(None)
+        if latency < self.threshold:
+            return
+        handler_class = type(handler)
+        description = {"timestamp": time.time(),
+                       "method": handler.request.method,
+                       "uri": handler.request.uri,
+                       "route": getattr(handler_class, '_profiled_route', None),
+                       "handler": "%s.%s" % (handler_class.__module__, handler_class.__name__),
+                       "status": handler.get_status(),
+                       "latency": latency}
+        with self._lock:
+            description["id"] = self._next_id
+            self._next_id += 1
+            self._requests[description["id"]] = (description, profiler.get_func_stats())
+            while len(self._requests) > self.size:
+                self._requests.popitem(last=False)
+
+    def requests(self):
+        """Return the description of the kept requests, the most recent first."""
+        with self._lock:
+            return [description for description, _ in reversed(list(self._requests.values()))]
+
+    def get(self, request_id):
+        """Return (description, function statistics) of a kept request, None if unknown."""
+        with self._lock:
+            request = self._requests.pop(request_id, None)
+            if request is not None:
+                self._requests[request_id] = request
+            return request
+
+    def remove(self, request_id=None):
+        """Forget one kept request, or all of them."""
+        with self._lock:
+            if request_id is None:
+                self._requests.clear()
+            else:
+                self._requests.pop(request_id, None)
+
+    def to_dict(self):
+        return {"rate": self.rate, "threshold": self.threshold, "size": self.size,
+                "traced": self.traced, "requests": self.requests()}
+
+    def _sampled(self, handler):
+        if self.header is not None and handler.request.headers.get(self.header, '').lower() \
+                not in ('', 'false', 'no', '0'):
+            return True
+        if self.argument is not None and str(handler.get_argument(self.argument, '')).lower() \
+                not in ('', 'false', 'no', '0'):
+            return True
+        return bool(self.rate) and random.random() < self.rate
+
+    def _dispatch(self, frame, event, arg):
+        profiler = _current_trace.get()
+        if profiler:
+            profiler._profile(frame, event, arg)
+
+
+class SlowRequestsHandler(JSONHandler):
+
+    tracer = None
+
+    def get(self):
+        """Return the tracing settings and the kept slow requests, the most recent first."""
+        self.write(self.tracer.to_dict())
+        self.set_status(200)
+        self.finish()
+
+    def delete(self):
+        """Forget the kept slow requests."""
+        self.tracer.remove()
+        self.set_status(204)
+        self.finish()
+
+
+class SlowRequestStatsHandler(ProfileStatsHandler):
+
+    tracer = None
+    sorts = ProfileStatsHandler.sorts + WALL_CLOCK_COLUMNS
+
+    @tornado.gen.coroutine
+    def get(self, request_id):
+        """Return a kept slow request with the statistics of the functions it ran."""
+        self.slow_request = self.tracer.get(int(request_id))
+        if self.slow_request is None:
+            self.write({'error': "Unknown slow request %s." % request_id})
+            self.set_status(404)
+            self.finish()
+            return
+        yield super(SlowRequestStatsHandler, self).get()
+
+    def delete(self, request_id):
+        """Forget a kept slow request."""
+        self.tracer.remove(int(request_id))
+        self.set_status(204)
+        self.finish()
+
+    def get_statistics(self, sort, count, strip_dirs, **filters):
+        engine = StatsEngine(strip_dirs, WALL_CLOCK_COLUMNS)
+        engine.update(self.slow_request[1])
+        return engine.top(sort, count, filters.get('stats_filter'))
+
+    def encode_statistics(self, sort, count, strip_dirs, **filters):
+        try:
+            statistics = self.get_statistics(sort, count, strip_dirs, **filters)
+        except NoStatsAvailableError:
+            statistics = []
+        return json_encode(dict(self.slow_request[0], statistics=statistics))
+
+
+class ThreadStatsHandler(StatsStreamMixin, JSONHandler):
+    """Base handler for the time spent in each profiled thread."""
+
+    def get_threads(self):
+        """Return the rows of the profiled threads, most busy first, runs in `executor`."""
+        raise NotImplementedError()
+
+    @tornado.gen.coroutine
+    def get(self):
+        """Return the time and utilization of every profiled thread."""
+        threads = yield self.run_in_executor(self.get_threads)
+        self.write({"threads": threads})
+        self.set_status(200)
+        self.finish()
+
+
+class YappiThreadStatsHandler(ThreadStatsHandler):
+
+    def get_threads(self):
+        return get_thread_statistics()
+
+
+class CProfileThreadStatsHandler(ThreadStatsHandler):
+
+    sessions = None
+
+    def get_threads(self):
+        return self.sessions.get_threads()
+
+
+class RouteStatsHandler(JSONHandler):
+
+    executor = None
+    route_profiler = None
+    backend = None
+
+    @tornado.gen.coroutine
+    def get(self):
+        """Return the request count, latency and top functions of every route."""
+        try:
+            count = self.get_count_argument(5)
+        except ValueError as e:
+            self.write({'error': str(e)})
+            self.set_status(400)
+            self.finish()
+            return
+
+        executor = self.executor or _default_executor()
+        routes = yield tornado.ioloop.IOLoop.current().run_in_executor(
+            executor, self._summarize, count)
+        self.write(routes)
+        self.set_status(200)
+        self.finish()
+
+    def _summarize(self, count):
+        routes = []
+        for stats in sorted(self.route_profiler.routes(), key=attrgetter('route', 'method')):
+            p50, p95, p99 = stats.percentiles(0.5, 0.95, 0.99)
+            top_functions = self.backend.get_route_statistics(stats.tag, count)
+            routes.append({
+                "route": stats.route,
+                "method": stats.method,
+                "count": stats.count,
+                "p50": p50,
+                "p95": p95,
+                "p99": p99,
+                "top_functions": top_functions
+            })
+        return json_encode({'routes': routes})
+
+
+class IOLoopMonitor(object):
+    """Measure the lag and callback durations of an IOLoop.
+
+    A heartbeat scheduled every `interval` seconds records how late it ran,
+    which is how long the loop was blocked. Every callback run by the loop is
+    timed into a histogram, and a watchdog thread captures the stack of the
+    loop thread while a callback runs longer than `threshold` seconds.
+    Everything is kept in fixed-size, preallocated buffers so memory use stays
+    flat however long the process runs.
+    """
+
+    max_depth = 64
+
+    def __init__(self, interval=0.1, threshold=0.1, size=1024, slow_callbacks=32):
+        self.interval = interval
+        self.threshold = threshold
+        self.lag = RingBuffer(size)
+        self.callbacks = Histogram()
+        self.handlers = Histogram()
+        self._slow_callbacks = [None] * slow_callbacks
+        self._slow_count = 0
+        self._io_loop = None
+        self._timeout = None
+        self._watchdog = None
+        self._restore = None
+        self._running_since = None
+
+    def start(self):
+        """Start monitoring the current IOLoop, must be called on its thread."""
+        if self._io_loop is not None:
+            return
+        self._io_loop = tornado.ioloop.IOLoop.current()
+        self._thread_id = threading.current_thread().ident
+        self._restore = self._patch(self._io_loop)
+        self._schedule_beat()
+        self._watchdog = threading.Event()
+        thread = threading.Thread(target=self._watch, args=(self._watchdog,),
+                                  name='tornado-profile-watchdog')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        """Stop monitoring, keeping the collected data."""
+        if self._io_loop is None:
+            return
+        self._watchdog.set()
+        self._io_loop.remove_timeout(self._timeout)
+        self._restore()
+        self._io_loop = self._timeout = self._watchdog = self._restore = None
+
+    def is_running(self):
+        """Return True if the monitor is running."""
+        return self._io_loop is not None
+
+    def record_handler(self, route_stats, latency):
+        """Count the duration of a request, see :attr:`RouteProfiler.listeners`."""
+        self.handlers.add(latency)
+
+    def to_dict(self):
+        """Return the collected data."""
+        p50, p99 = self.lag.percentiles(0.5, 0.99)
+        values = self.lag.values()
+        slow = [self._slow_callbacks[i % len(self._slow_callbacks)]
+                for i in range(max(self._slow_count - len(self._slow_callbacks), 0),
+                               self._slow_count)]
+        return {
+            "running": self.is_running(),
+            "lag": {"count": self.lag.count, "last": self.lag.last(),
+                    "p50": p50, "p99": p99, "max": max(values) if values else None},
+            "callbacks": self.callbacks.to_dict(),
+            "handlers": self.handlers.to_dict(),
+            "slow_callbacks": [dict((key, value) for key, value in callback.items() if key != "start")
+                               for callback in slow]
+        }
+
+    def _schedule_beat(self):
+        expected = self._io_loop.time() + self.interval
+        self._timeout = self._io_loop.call_at(expected, self._beat, expected)
+
+    def _beat(self, expected):
+        self.lag.append(max(self._io_loop.time() - expected, 0.0))
+        self._schedule_beat()
+
+    def _timed(self, run):
+        def timed(*args):
+            if threading.current_thread().ident != self._thread_id:
+                return run(*args)
+            start = self._running_since = _wall_clock()
+            try:
+                return run(*args)
+            finally:
+                self._running_since = None
+                duration = _wall_clock() - start
+                self.callbacks.add(duration)
+                if duration >= self.threshold:
+                    self._finish_slow_callback(start, duration)
+        return timed
+
+    def _patch(self, io_loop):
+        """Time the callbacks run by `io_loop`, return a function undoing it."""
+        if getattr(io_loop, 'asyncio_loop', None) is not None:
+            # Callbacks, timeouts and coroutine steps all run as asyncio Handles
+            import asyncio.events
+            handle_run = asyncio.events.Handle._run
+            timed = self._timed(handle_run)
+            asyncio.events.Handle._run = lambda handle: timed(handle)
+
+            def restore():
+                asyncio.events.Handle._run = handle_run
+        else:
+            io_loop._run_callback = self._timed(io_loop._run_callback)
+
+            def restore():
+                del io_loop._run_callback
+        return restore
+
+    def _watch(self, stopping):
+        captured = None
+        while not stopping.wait(self.threshold / 2.0):
+            start = self._running_since
+            if start is None or start == captured or _wall_clock() - start < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            stack = ["%s:%d in %s" % (filename, line, func_name) for filename, line, func_name, _
+                     in traceback.extract_stack(frame, self.max_depth)]
+            del frame
+            captured = start
+            self._slow_callbacks[self._slow_count % len(self._slow_callbacks)] = {
+                "start": start, "timestamp": time.time(), "duration": None, "stack": stack}
+            self._slow_count += 1
+
+    def _finish_slow_callback(self, start, duration):
+        if self._slow_count:
+            callback = self._slow_callbacks[(self._slow_count - 1) % len(self._slow_callbacks)]
+            if callback["start"] == start:
+                callback["duration"] = duration
+
+
+class IOLoopMonitorHandler(JSONHandler):
+
+    monitor = None
+
+    def post(self):
+        """Start monitoring the IOLoop."""
+        self.monitor.start()
+        self.set_status(201)
+        self.finish()
+
+    def delete(self):
+        """Stop monitoring the IOLoop."""
+        self.monitor.stop()
+        self.set_status(204)
+        self.finish()
+
+    def get(self):
+        """Return the loop lag, callback and handler durations and slow callbacks."""
+        self.write(self.monitor.to_dict())
+        self.set_status(200)
+        self.finish()
+
+
+class ProfilingSession(object):
+    """Stop the profiler after `duration` seconds or `requests` requests.
+
+    The duration is an IOLoop timeout and requests are counted as a
+    :attr:`RouteProfiler.listeners` callback, so a forgotten profile never
+    keeps its overhead on for long.
+    """
+
+    def __init__(self, stop):
+        self.stop = stop
+        self.counting_requests = False  # set once the application is instrumented
+        self.duration = None
+        self.requests = None
+        self.remaining_requests = None
+        self.deadline = None
+        self._io_loop = None
+        self._timeout = None
+        self._callback = None
+
+    def limit(self, duration=None, requests=None, callback=None):
+        """Stop the running profiler after `duration` seconds or `requests` requests.
+
+        `callback` is called once the limit stopped the profiler. Replaces
+        the previous limits.
+        """
+        self.cancel()
+        self.duration = duration
+        self.requests = self.remaining_requests = requests
+        self._callback = callback
+        if duration is not None:
+            self._io_loop = tornado.ioloop.IOLoop.current()
+            self.deadline = time.time() + duration
+            self._timeout = self._io_loop.call_later(duration, self._expire)
+
+    def cancel(self):
+        """Forget the limits without stopping the profiler."""
+        if self._timeout is not None:
+            self._io_loop.remove_timeout(self._timeout)
+        self.duration = self.requests = self.remaining_requests = self.deadline = None
+        self._io_loop = self._timeout = self._callback = None
+
+    def is_limited(self):
+        """Return True if the running profiler will be stopped by a limit."""
+        return self.duration is not None or self.requests is not None
+
+    def record_request(self, route_stats, latency):
+        """Count one request, see :attr:`RouteProfiler.listeners`."""
+        if self.remaining_requests is not None:
+            self.remaining_requests -= 1
+            if self.remaining_requests <= 0:
+                self._expire()
+
+    def to_dict(self):
+        """Return the limits and what is left of them."""
+        return {
+            "duration": self.duration,
+            "remaining_time": max(self.deadline - time.time(), 0.0) if self.deadline else None,
+            "requests": self.requests,
+            "remaining_requests": self.remaining_requests
+        }
+
+    def _expire(self):
+        callback = self._callback
+        self.cancel()
+        self.stop()
+        if callback is not None:
+            callback()
+
+
+TRIGGER_METRICS = ('p99', 'lag')
+
+
+class ProfilingTrigger(object):
+    """Capture a profile once `metric` stayed above `threshold` for `hold` seconds."""
+
+    def __init__(self, trigger_id, metric, threshold, hold=0.0, duration=10.0,
+                 cooldown=60.0, captures=5):
+        self.id = trigger_id
+        self.metric = metric
+        self.threshold = threshold
+        self.hold = hold
+        self.duration = duration
+        self.cooldown = cooldown
+        self.captures = [None] * captures
+        self.capture_count = 0
+        self.above_since = None
+        self.capturing = False
+        self.cooldown_until = 0.0
+
+    def add_capture(self, capture):
+        """Keep `capture`, overwriting the oldest one once full."""
+        self.captures[self.capture_count % len(self.captures)] = capture
+        self.capture_count += 1
+
+    def to_dict(self, now=None):
+        now = time.time() if now is None else now
+        if self.capturing:
+            state = "capturing"
+        elif now < self.cooldown_until:
+            state = "cooldown"
+        elif self.above_since is not None:
+            state = "pending"
+        else:
+            state = "armed"
+        size = len(self.captures)
+        return {
+            "id": self.id,
+            "metric": self.metric,
+            "threshold": self.threshold,
+            "for": self.hold,
+            "duration": self.duration,
+            "cooldown": self.cooldown,
+            "state": state,
+            "captures": [self.captures[i % size] for i in
+                         range(max(self.capture_count - size, 0), self.capture_count)]
+        }
+
+
+class ProfilingTriggers(object):
+    """Start a time-boxed profile when request latency or IOLoop lag degrades.
+
+    Every `interval` seconds each trigger compares its metric with its
+    threshold: 'p99' is the 99th percentile latency of the requests finished
+    since the previous check, 'lag' the latest :class:`IOLoopMonitor` lag.
+    A trigger which held above its threshold long enough starts the profiler
+    for `duration` seconds, unless it is already running, and keeps the top
+    functions of that profile as a capture.
+    """
+
+    def __init__(self, profiler, interval=1.0, latency_samples=1024):
+        self.profiler = profiler
+        self.interval = interval
+        self.latency_samples = latency_samples
+        self.triggers = {}
+        self._next_id = 1
+        self._latencies = RingBuffer(latency_samples)
+        self._periodic = None
+
+    def add(self, metric, threshold, hold=0.0, duration=10.0, cooldown=60.0):
+        """Add and return a :class:`ProfilingTrigger`, must be called on the IOLoop thread."""
+        if metric not in TRIGGER_METRICS:
+            raise ValueError("Invalid `metric` '%s', must be in %s." % (metric, TRIGGER_METRICS))
+        if metric == 'p99' and not self.profiler.session.counting_requests:
+            raise ValueError("'p99' triggers need an application instrumented with "
+                             "TornadoProfiler.instrument().")
+        if metric == 'lag':
+            self.profiler.ioloop_monitor.start()
+        trigger = ProfilingTrigger(self._next_id, metric, threshold, hold, duration, cooldown)
+        self.triggers[trigger.id] = trigger
+        self._next_id += 1
+        if self._periodic is None:
+            self._periodic = tornado.ioloop.PeriodicCallback(self.check, self.interval * 1000)
+            self._periodic.start()
+        return trigger
+
+    def remove(self, trigger_id=None):
+        """Remove one trigger, or all of them if `trigger_id` is None. Return False if unknown."""
+        if trigger_id is None:
+            self.triggers.clear()
+        elif self.triggers.pop(trigger_id, None) is None:
+            return False
+        if not self.triggers and self._periodic is not None:
+            self._periodic.stop()
+            self._periodic = None
+        return True
+
+    def record_request(self, route_stats, latency):
+        """Record one request latency, see :attr:`RouteProfiler.listeners`."""
+        if self.triggers:
+            self._latencies.append(latency)
+
+    def check(self):
+        """Compare the metrics with the thresholds and start captures."""
+        now = time.time()
+        values = {'lag': self.profiler.ioloop_monitor.lag.last(), 'p99': None}
+        if self._latencies.count:
+            values['p99'] = self._latencies.percentiles(0.99)[0]
+            self._latencies = RingBuffer(self.latency_samples)
+
+        for trigger in list(self.triggers.values()):
+            if trigger.capturing:
+                if self.profiler.is_running():
+                    continue
+                trigger.capturing = False  # stopped by hand before the end of the capture
+            value = values[trigger.metric]
+            if value is None or value <= trigger.threshold:
+                trigger.above_since = None
+                continue
+            if trigger.above_since is None:
+                trigger.above_since = now
+            if (now - trigger.above_since < trigger.hold or now < trigger.cooldown_until or
+                    self.profiler.is_running()):
+                continue
+            logger.info("Profiling trigger %d fired, %s at %.3fs", trigger.id, trigger.metric, value)
+            trigger.capturing = True
+            trigger.above_since = None
+            self.profiler.start()
+            self.profiler.session.limit(trigger.duration, callback=functools.partial(
+                self._capture, trigger, now, value))
+
+    @tornado.gen.coroutine
+    def _capture(self, trigger, timestamp, value):
+        executor = self.profiler.executor or _default_executor()
+        try:
+            top_functions = yield tornado.ioloop.IOLoop.current().run_in_executor(
+                executor, self.profiler.get_statistics)
+        except TypeError:
+            top_functions = []
+        trigger.add_capture({"timestamp": timestamp, "value": value,
+                             "duration": trigger.duration, "top_functions": top_functions or []})
+        trigger.capturing = False
+        trigger.cooldown_until = time.time() + trigger.cooldown
+
+
+class ProfilingTriggersHandler(JSONHandler):
+
+    triggers = None
+
+    def post(self, trigger_id=None):
+        """Add a trigger."""
+        metric = self.get_argument('metric', None)
+        error = ''
+        arguments = {}
+        for name, default in (('threshold', None), ('for', 0.0), ('duration', 10.0),
+                              ('cooldown', 60.0)):
+            value = self.get_argument(name, default)
+            if value is None:
+                error += "Missing `%s`." % name
+                continue
+            try:
+                arguments[name] = float(value)
+            except (ValueError, TypeError):
+                error += "Can't cast `%s` '%s' to float." % (name, value)
+                continue
+            if arguments[name] < 0 or (name == 'duration' and arguments[name] == 0):
+                error += "`%s` must be positive." % name
+        if not error:
+            try:
+                trigger = self.triggers.add(metric, arguments['threshold'], arguments['for'],
+                                            arguments['duration'], arguments['cooldown'])
+            except ValueError as e:
+                error = str(e)
+        if error:
+            self.write({'error': error})
+            self.set_status(400)
+            self.finish()
+            return
+        self.write(trigger.to_dict())
+        self.set_status(201)
+        self.finish()
+
+    def delete(self, trigger_id=None):
+        """Remove one trigger, or all of them."""
+        if not self.triggers.remove(None if trigger_id is None else int(trigger_id)):
+            self.write({'error': "No trigger %s." % trigger_id})
+            self.set_status(404)
+            self.finish()
+            return
+        self.set_status(204)
+        self.finish()
+
+    def get(self, trigger_id=None):
+        """Return the triggers, their state and their captures."""
+        now = time.time()
+        self.write({"triggers": [trigger.to_dict(now) for _, trigger in
+                                 sorted(self.triggers.triggers.items())]})
+        self.set_status(200)
+        self.finish()
+
+
+def _metric_label(value):
+    """Escape a Prometheus label value."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class ProfilerMetrics(object):
+    """Render the state and hot spots of a :class:`TornadoProfiler` in Prometheus text format.
+
+    The function counters are those of the top `count` functions, at most
+    `max_functions`, so the `function` label has a bounded cardinality. They
+    are cumulative since the profiler was started or cleared. The rendered
+    text is cached for `ttl` seconds, so frequent scrapes cost little.
+    """
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    sorts = ('cum_time', 'total_time', 'num_calls')
+
+    def __init__(self, profiler, ttl=5.0, max_functions=50):
+        self.profiler = profiler
+        self.ttl = ttl
+        self.max_functions = max_functions
+        self._lock = threading.Lock()
+        self._cache = {}  # (sort, count) -> (expires, text)
+
+    def render(self, sort="cum_time", count=10):
+        """Return the metrics text for the top `count` functions by `sort`, `max_functions` if not positive."""
+        count = min(count, self.max_functions) if count is not None and count > 0 else self.max_functions
+        now = time.time()
+        with self._lock:
+            cached = self._cache.get((sort, count))
+            if cached is not None and cached[0] > now:
+                return cached[1]
+        text = self._render(sort, count)
+        with self._lock:
+            self._cache = dict((key, value) for key, value in self._cache.items()
+                               if value[0] > now)
+            self._cache[(sort, count)] = (now + self.ttl, text)
+        return text
+
+    def _render(self, sort, count):
+        profiler = self.profiler
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append("# HELP tornado_profile_%s %s" % (name, help_text))
+            lines.append("# TYPE tornado_profile_%s %s" % (name, metric_type))
+            for labels, value in samples:
+                labels = ",".join('%s="%s"' % (key, _metric_label(label)) for key, label in labels)
+                lines.append("tornado_profile_%s%s %s" % (
+                    name, "{%s}" % labels if labels else "", repr(float(value))))
+
+        metric("running", "gauge", "Whether the profiler is running.",
+               [((("backend", profiler.backend),), int(profiler.is_running()))])
+        session = profiler.session.to_dict()
+        metric("session_limited", "gauge",
+               "Whether the running profile stops after a duration or a number of requests.",
+               [((), int(profiler.session.is_limited()))])
+        if session["remaining_time"] is not None:
+            metric("session_remaining_seconds", "gauge",
+                   "Seconds until the limited profile stops.", [((), session["remaining_time"])])
+        if session["remaining_requests"] is not None:
+            metric("session_remaining_requests", "gauge",
+                   "Requests until the limited profile stops.",
+                   [((), session["remaining_requests"])])
+        for name, metric_type, help_text, samples in profiler.profiler_backend.get_metrics():
+            metric(name, metric_type, help_text, samples)
+        metric("traced_requests_total", "counter", "Requests profiled one by one.",
+               [((), profiler.tracer.traced)])
+
+        profiled_time = profiler.get_profiled_time()
+        if profiled_time is not None:
+            # Not the profiler's cost, which yappi and cProfile don't measure, but
+            # how busy the profiled code was: above 1 when several threads are profiled
+            profiled_time, elapsed = profiled_time
+            metric("profiled_time_ratio", "gauge",
+                   "Self time of the profiled functions per second of profiled wall time.",
+                   [((), profiled_time / elapsed if elapsed else 0.0)])
+
+        started = _wall_clock()
+        try:
+            statistics = profiler.get_statistics(sort, count)
+        except TypeError:
+            statistics = []  # nothing profiled yet
+        if statistics is None:
+            statistics = []  # not a function profiler
+        else:
+            metric("stats_build_seconds", "gauge",
+                   "Seconds spent building the function statistics of this scrape.",
+                   [((), _wall_clock() - started)])
+        functions = [(("function", "%s:%s(%s)" % (row["path"], row["line"], row["func_name"])),)
+                     for row in statistics]
+        for name, column, help_text in (
+                ("function_calls_total", "num_calls", "Calls of the function."),
+                ("function_self_seconds_total", "total_time",
+                 "Seconds spent in the function, excluding the functions it called."),
+                ("function_cumulative_seconds_total", "cum_time",
+                 "Seconds spent in the function, including the functions it called.")):
+            metric(name, "counter", help_text,
+                   [(labels, row[column]) for labels, row in zip(functions, statistics)])
+        return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(StatsStreamMixin, JSONHandler):
+
+    metrics = None
+
+    @tornado.gen.coroutine
+    def get(self):
+        """Return the profiler metrics in Prometheus text format."""
+        sort = self.get_argument('sort', 'cum_time')
+        error = ''
+        if sort not in self.metrics.sorts:
+            error += "Invalid `sort` '%s', must be in %s." % (sort, self.metrics.sorts)
+        try:
+            count = self.get_count_argument(10)
+        except ValueError as e:
+            error += str(e)
+        if error:
+            self.write({'error': error})
+            self.set_status(400)
+            self.finish()
+            return
+
+        text = yield self.run_in_executor(self.metrics.render, sort, count)
+        self.set_header('Content-Type', self.metrics.content_type)
+        self.set_status(200)
+        self.write(text)
+        self.finish()
+
+
+def parse_window_selection(since=None, window=None):
+    """Return the `(since, first, last)` selection of :meth:`WindowStore.select`.
+
+    :param str since: seconds since the epoch, or seconds ago when negative
+    :param str window: a window id or a `first-last` range of ids
+    :returns: None if neither is given
+    :raises ValueError: with an error message for an invalid selection
+    """
+    if since is None and window is None:
+        return None
+    first = last = None
+    if since is not None:
+        try:
+            since = float(since)
+        except (ValueError, TypeError):
+            raise ValueError("Can't cast `since` '%s' to float." % since)
+        if since < 0:
+            since += time.time()
+    if window is not None:
+        try:
+            first, _, last = window.partition('-')
+            first = int(first)
+            last = int(last) if last else first
+        except ValueError:
+            raise ValueError("Invalid `window` '%s', must be an id or a `first-last` range "
+                             "of ids." % window)
+    return since, first, last
+
+
+class StatsWindow(object):
+    """Function statistics of one rotation interval, stored in arrays."""
+
+    __slots__ = ('id', 'start', 'end', 'functions', 'num_calls', 'total_time', 'cum_time',
+                 'dropped')
+
+    def __init__(self, window_id, start, end, rows, dropped):
+        self.id = window_id
+        self.start = start
+        self.end = end
+        self.functions = tuple(func for func, _ in rows)
+        self.num_calls = array('l', (value[0] for _, value in rows))
+        self.total_time = array('d', (value[1] for _, value in rows))
+        self.cum_time = array('d', (value[2] for _, value in rows))
+        self.dropped = dropped
+
+    def nbytes(self):
+        """Return the size of the arrays and of the function references."""
+        return (sum(len(values) * values.itemsize
+                    for values in (self.num_calls, self.total_time, self.cum_time)) +
+                len(self.functions) * 8)
+
+    def func_stats(self):
+        """Return the rows as `FuncStat` records."""
+        return [FuncStat(func[0], func[1], func[2], num_calls, num_calls, total_time, cum_time)
+                for func, num_calls, total_time, cum_time in
+                zip(self.functions, self.num_calls, self.total_time, self.cum_time)]
+
+    def to_dict(self):
+        return {"id": self.id, "start": self.start, "end": self.end,
+                "rows": len(self.functions), "dropped_rows": self.dropped}
+
+
+class WindowStore(object):
+    """Rolling store of the function statistics of the last `size` intervals.
+
+    While rolling, the statistics collected by the profiler are moved into a
+    new window every `interval` seconds by calling `collect` on the IOLoop
+    thread, which returns and clears them. Each window keeps its `max_rows` functions with the most
+    cumulative time in arrays, and the function keys are shared between
+    windows, so memory is bounded by `size * max_rows` rows. Windows are
+    merged with a :class:`StatsEngine` on request.
+    """
+
+    def __init__(self, collect, size=60, max_rows=5000, executor=None):
+        self.collect = collect
+        self.size = size
+        self.max_rows = max_rows
+        self.executor = executor
+        self.interval = None
+        self._windows = deque(maxlen=size)
+        self._functions = {}  # function -> the same function, shared by the windows
+        self._next_id = 1
+        self._started = None
+        self._periodic = None
+        self._lock = threading.Lock()
+
+    def is_rolling(self):
+        """Return True if windows are being rotated."""
+        return self._periodic is not None
+
+    def start(self, interval):
+        """Rotate a window every `interval` seconds, must be called on the IOLoop thread.
+
+        Statistics collected before are discarded, so the first window starts now.
+        """
+        if self._periodic is not None:
+            self._periodic.stop()
+        else:
+            self.collect()
+            self._started = time.time()
+        self.interval = interval
+        self._periodic = tornado.ioloop.PeriodicCallback(self._rotate, interval * 1000)
+        self._periodic.start()
+
+    def stop(self):
+        """Stop rotating, storing the statistics of the current window."""
+        if self._periodic is None:
+            return
+        self._periodic.stop()
+        self._periodic = self.interval = None
+        self.rotate()
+
+    def rotate(self):
+        """Move the statistics collected since the previous rotation into a new window."""
+        self._store(*self._collect())
+
+    @tornado.gen.coroutine
+    def _rotate(self):
+        # yappi resumes by profiling the thread clearing its statistics, so
+        # collect on the IOLoop thread and only build the window in the executor
+        executor = self.executor or _default_executor()
+        yield tornado.ioloop.IOLoop.current().run_in_executor(
+            executor, self._store, *self._collect())
+
+    def _collect(self):
+        end = time.time()
+        start, self._started = self._started, end
+        return start, end, self.collect()
+
+    def _store(self, start, end, func_stats):
+        with self._lock:
+            self.add(start, end, func_stats)
+
+    def add(self, start, end, func_stats):
+        """Store `func_stats`, yappi-like records, as a window from `start` to `end`."""
+        totals = {}
+        for stat in func_stats:
+            func = (stat.module, stat.lineno, stat.name)
+            value = (stat.ncall, stat.tsub, stat.ttot)
+            if func in totals:
+                value = tuple(a + b for a, b in zip(totals[func], value))
+            totals[func] = value
+        rows = list(totals.items())
+        if len(rows) > self.max_rows:
+            rows = heapq.nlargest(self.max_rows, rows, key=lambda row: row[1][2])
+        functions = self._functions
+        rows = [(functions.setdefault(func, func), value) for func, value in rows]
+        window = StatsWindow(self._next_id, start, end, rows, len(totals) - len(rows))
+        self._next_id += 1
+        if len(self._windows) == self.size:
+            self._windows.popleft()
+            self._windows.append(window)
+            # Forget the functions only referenced by the evicted window
+            self._functions = dict((func, func) for stored in self._windows
+                                   for func in stored.functions)
+        else:
+            self._windows.append(window)
+        return window
+
+    def select(self, since=None, first=None, last=None):
+        """Return the windows ending after `since` with ids from `first` to `last`."""
+        return [window for window in list(self._windows)
+                if (since is None or window.end > since) and
+                (first is None or first <= window.id <= last)]
+
+    def get_statistics(self, selection, sort="cum_time", count=20, strip_dirs=True,
+                       stats_filter=None):
+        """Return the merged statistics of the windows selected by `selection`.
+
+        See :func:`parse_window_selection` and :func:`get_profiler_statistics`.
+        """
+        return self._merge(self.select(*selection), strip_dirs).top(sort, count, stats_filter)
+
+    def diff(self, base, target, sort="cum_time", count=20, strip_dirs=True):
+        """Compare the windows selected by `target` with those selected by `base`.
+
+        Returns the `count` functions whose `sort` value, one of `num_calls`,
+        `total_time` or `cum_time`, grew the most, with their `base_` values
+        and `delta_` differences, and both selections.
+        """
+        selections = {}
+        rows = {}
+        for name, selection in (('base', base), ('target', target)):
+            windows = self.select(*selection)
+            if not windows:
+                raise NoStatsAvailableError("No window selected for `%s`." % name)
+            selections[name] = {"windows": [windows[0].id, windows[-1].id],
+                                "duration": sum(window.end - window.start for window in windows)}
+            try:
+                statistics = self._merge(windows, strip_dirs).top(sort, None)
+            except NoStatsAvailableError:
+                statistics = []
+            rows[name] = dict(((row['path'], row['line'], row['func_name']), row)
+                              for row in statistics)
+
+        columns = ('num_calls', 'total_time', 'cum_time')
+        statistics = []
+        for key in set(rows['base']) | set(rows['target']):
+            base_row = rows['base'].get(key, {})
+            row = dict(rows['target'].get(key) or _make_row(key, 0, 0, 0.0, 0.0))
+            for column in columns:
+                row['base_' + column] = base_row.get(column, 0)
+                row['delta_' + column] = row[column] - row['base_' + column]
+            statistics.append(row)
+        key = itemgetter('delta_' + sort)
+        if count is None:
+            statistics.sort(key=key, reverse=True)
+        else:
+            statistics = heapq.nlargest(count, statistics, key=key)
+        return dict(selections, statistics=statistics)
+
+    def to_dict(self):
+        """Return the rotation state, the stored windows and their memory use."""
+        windows = list(self._windows)
+        return {
+            "rolling": self.is_rolling(),
+            "interval": self.interval,
+            "size": self.size,
+            "max_rows": self.max_rows,
+            "memory": sum(window.nbytes() for window in windows),
+            "windows": [window.to_dict() for window in windows]
+        }
+
+    def _merge(self, windows, strip_dirs):
+        engine = StatsEngine(strip_dirs)
+        engine.update([stat for window in windows for stat in window.func_stats()])
+        return engine
+
+
+class WindowsHandler(JSONHandler):
+
+    windows = None
+
+    def get(self):
+        """Return the rotation state and the stored windows."""
+        self.write(self.windows.to_dict())
+        self.set_status(200)
+        self.finish()
+
+
+class WindowDiffHandler(StatsStreamMixin, JSONHandler):
+
+    windows = None
+    sorts = ('num_calls', 'cum_time', 'total_time')
+
+    @tornado.gen.coroutine
+    def get(self):
+        """Compare two windows, or ranges of windows, by default the last two."""
+        sort = self.get_argument('sort', 'cum_time')
+        strip_dirs = self.get_bool_argument('strip_dirs', True)
+        error = ''
+        if sort not in self.sorts:
+            error += "Invalid `sort` '%s', must be in %s." % (sort, self.sorts)
+        try:
+            count = self.get_count_argument()
+        except ValueError as e:
+            error += str(e)
+        selections = []
+        windows = self.windows.select()
+        for name, default in (('base', -2), ('target', -1)):
+            window = self.get_argument(name, None)
+            if window is None and len(windows) >= -default:
+                window = str(windows[default].id)
+            try:
+                selection = parse_window_selection(window=window)
+            except ValueError as e:
+                error += str(e).replace('`window`', '`%s`' % name)
+                continue
+            if selection is None:
+                error += "Missing `%s`, fewer than two windows are stored." % name
+            selections.append(selection)
+        if error:
+            self.write({'error': error})
+            self.set_status(400)
+            self.finish()
+            return
+
+        try:
+            diff = yield self.run_in_executor(
+                functools.partial(self.windows.diff, selections[0], selections[1], sort, count,
+                                  strip_dirs))
+        except NoStatsAvailableError as e:
+            self.write({'error': str(e)})
+            self.set_status(404)
+            self.finish()
+            return
+        self.write(diff)
+        self.set_status(200)
+        self.finish()
+
+
+TRACEMALLOC_GROUPS = ('lineno', 'filename', 'traceback')
+# Tracebacks are ordered from the oldest frame since Python 3.7
+_TRACEBACK_OLDEST_FIRST = sys.version_info >= (3, 7)
+
+
+def _parse_group_by(group_by):
+    """Return `group_by` if it is a `tracemalloc.Snapshot.statistics` key type.
+
+    :raises ValueError: with an error message otherwise
+    """
+    if group_by not in TRACEMALLOC_GROUPS:
+        raise ValueError("Invalid `group_by` '%s', must be in %s." % (group_by, TRACEMALLOC_GROUPS))
+    return group_by
+
+
+def _allocation_row(stat, strip_dirs):
+    """Return the JSON row for a `tracemalloc.Statistic` or `StatisticDiff`."""
+    frames = list(stat.traceback)
+    if not _TRACEBACK_OLDEST_FIRST:
+        frames.reverse()
+    strip = os.path.basename if strip_dirs else str
+    row = {
+        "path": strip(frames[-1].filename),
+        "line": frames[-1].lineno,
+        "size": stat.size,
+        "count": stat.count,
+        "size_per_alloc": stat.size / float(stat.count) if stat.count else 0,
+        "traceback": ["%s:%d" % (strip(frame.filename), frame.lineno) for frame in frames]
+    }
+    if hasattr(stat, 'size_diff'):
+        row["size_diff"] = stat.size_diff
+        row["count_diff"] = stat.count_diff
+    return row
+
+
+class TracemallocProfiler(object):
+    """Profile memory allocations with `tracemalloc`.
+
+    Statistics group the traces of a snapshot by allocation site, keeping
+    `depth` frames of each traceback. :meth:`snapshot` stores up to
+    `max_snapshots` snapshots to compare with later ones. Taking, grouping and
+    comparing snapshots is slow, so the handlers run it in the executor.
+    """
+
+    def __init__(self, depth=1, max_snapshots=8):
+        if tracemalloc is None:
+            raise ValueError("The tracemalloc backend needs Python 3.4 or later.")
+        self.depth = depth
+        self._snapshots = deque(maxlen=max_snapshots)
+        self._next_id = 1
+        self._final = None  # snapshot taken when stopping
+        self._lock = threading.Lock()
+
+    def start(self, depth=None):
+        """Start tracing, restarting with a new traceback `depth` if it changed."""
+        if depth is not None:
+            self.depth = depth
+        if tracemalloc.is_tracing():
+            if tracemalloc.get_traceback_limit() == self.depth:
+                return
+            tracemalloc.stop()
+        self._final = None
+        tracemalloc.start(self.depth)
+
+    def stop(self):
+        """Stop tracing, keeping a last snapshot for the statistics."""
+        if tracemalloc.is_tracing():
+            self._final = self._take_snapshot()
+            tracemalloc.stop()
+
+    def is_running(self):
+        """Return True if allocations are being traced."""
+        return tracemalloc.is_tracing()
+
+    def clear_stats(self):
+        """Forget the traced allocations and the stored snapshots."""
+        if tracemalloc.is_tracing():
+            tracemalloc.clear_traces()
+        with self._lock:
+            self._snapshots.clear()
+            self._final = None
+
+    def status(self):
+        """Return the tracing state and traced memory in bytes."""
+        current, peak = tracemalloc.get_traced_memory()
+        return {"running": self.is_running(), "depth": self.depth,
+                "traced_memory": current, "peak_memory": peak,
+                "snapshots": len(self._snapshots)}
+
+    def snapshot(self):
+        """Take and store a snapshot, return its description."""
+        if not tracemalloc.is_tracing():
+            raise NoStatsAvailableError("Start the profiler before taking snapshots.")
+        snapshot = self._take_snapshot()
+        size = sum(trace.size for trace in snapshot.traces)
+        with self._lock:
+            entry = (self._next_id, time.time(), snapshot, size)
+            self._snapshots.append(entry)
+            self._next_id += 1
+        return self._describe(entry)
+
+    def snapshots(self):
+        """Return the description of the stored snapshots."""
+        return [self._describe(entry) for entry in list(self._snapshots)]
+
+    def last_snapshot_id(self):
+        """Return the id of the newest stored snapshot, None if there is none."""
+        with self._lock:
+            return self._snapshots[-1][0] if self._snapshots else None
+
+    def get_statistics(self, sort="size", count=20, strip_dirs=True, group_by='lineno',
+                       stats_filter=None):
+        """Return the `count` allocation sites with the largest `sort`, all if None.
+
+        :param str sort: 'size', 'count' or 'size_per_alloc'
+        :param str group_by: 'lineno', 'filename' or 'traceback'
+        :param StatsFilter|None stats_filter: only include the allocation
+            sites whose newest frame it matches, without a function name
+        """
+        snapshot = self._current_snapshot()
+        stats = snapshot.statistics(group_by)
+        if stats_filter is not None:
+            newest = 0 if not _TRACEBACK_OLDEST_FIRST else -1
+            stats = [stat for stat in stats if stats_filter.matches(
+                (stat.traceback[newest].filename, stat.traceback[newest].lineno, ''))]
+        rows = [_allocation_row(stat, strip_dirs) for stat in stats]
+        return self._top(rows, sort, count)
+
+    def compare(self, base, target=None, sort="size_diff", count=20, strip_dirs=True,
+                group_by='lineno'):
+        """Return the allocation sites which changed the most between two snapshots.
+
+        :param int base: id of the older snapshot
+        :param int|None target: id of the newer snapshot, None for the current allocations
+        :param str sort: 'size_diff', 'count_diff', 'size' or 'count'
+        """
+        snapshots = dict((entry[0], entry[2]) for entry in list(self._snapshots))
+        for snapshot_id in (base, target):
+            if snapshot_id is not None and snapshot_id not in snapshots:
+                raise NoStatsAvailableError("No snapshot %d." % snapshot_id)
+        current = snapshots[target] if target is not None else self._current_snapshot()
+        rows = [_allocation_row(stat, strip_dirs)
+                for stat in current.compare_to(snapshots[base], group_by)]
+        return self._top(rows, sort, count)
+
+    def _current_snapshot(self):
+        if tracemalloc.is_tracing():
+            return self._take_snapshot()
+        if self._final is None:
+            raise NoStatsAvailableError("No allocations traced.")
+        return self._final
+
+    def _take_snapshot(self):
+        # Leave out the allocations of tracemalloc itself
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<unknown>")))
+
+    def _top(self, rows, sort, count):
+        if count is None:
+            return sorted(rows, key=itemgetter(sort), reverse=True)
+        return heapq.nlargest(count, rows, key=itemgetter(sort))
+
+    def _describe(self, entry):
+        snapshot_id, timestamp, snapshot, size = entry
+        return {"id": snapshot_id, "timestamp": timestamp, "depth": snapshot.traceback_limit,
+                "size": size}
+
+
+class TracemallocProfilerHandler(ProfilingSessionMixin, StatsStreamMixin, JSONHandler):
+
+    profiler = None
+
+    def post(self):
+        """Start tracing allocations, with `depth` frames per traceback."""
+        depth = self.get_argument('depth', None)
+        error = ''
+        if depth is not None:
+            try:
+                depth = int(depth)
+            except (ValueError, TypeError):
+                error += "Can't cast `depth` '%s' to int." % depth
+            else:
+                if depth <= 0:
+                    error += "`depth` must be positive."
+        try:
+            duration, requests = self.get_session_limits()
+        except ValueError as e:
+            error += str(e)
+        if error:
+            self.write({'error': error})
+            self.set_status(400)
+            self.finish()
+            return
+        self.profiler.start(depth)
+        if duration is not None or requests is not None:
+            self.session.limit(duration, requests)
+        self.set_status(201)
+        self.finish()
+
+    @tornado.gen.coroutine
+    def delete(self):
+        """Stop tracing allocations."""
+        yield self.run_in_executor(self.profiler.stop)
+        if self.session is not None:
+            self.session.cancel()
+        self.set_status(204)
+        self.finish()
+
+    def get(self):
+        """Check if allocations are traced and how much memory they use."""
+        self.write_status(self.profiler.status())
+        self.set_status(200)
+        self.finish()
+
+
+class TracemallocStatsHandler(ProfileStatsHandler):
+
+    profiler = None
+    sorts = ('size', 'count', 'size_per_alloc')
+    default_sort = 'size'
+
+    def get_filters(self):
+        filters = super(TracemallocStatsHandler, self).get_filters()
+        if filters.get('stats_filter') and filters['stats_filter'].min_cum_time is not None:
+            raise ValueError("`min_cum_time` is not supported by the tracemalloc backend.")
+        filters['group_by'] = _parse_group_by(self.get_argument('group_by', 'lineno'))
+        return filters
+
+    def get_statistics(self, sort, count, strip_dirs, **filters):
+        return self.profiler.get_statistics(sort, count, strip_dirs, **filters)
+
+    def clear_statistics(self):
+        self.profiler.clear_stats()
+
+
+class TracemallocSnapshotsHandler(StatsStreamMixin, JSONHandler):
+
+    profiler = None
+
+    @tornado.gen.coroutine
+    def post(self):
+        """Take and store a snapshot of the traced allocations."""
+        try:
+            snapshot = yield self.run_in_executor(self.profiler.snapshot)
+        except NoStatsAvailableError as e:
+            self.write({'error': str(e)})
+            self.set_status(404)
+            self.finish()
+            return
+        self.write(snapshot)
+        self.set_status(201)
+        self.finish()
+
+    def get(self):
+        """Return the stored snapshots."""
+        self.write({"snapshots": self.profiler.snapshots()})
+        self.set_status(200)
+        self.finish()
+
+
+class TracemallocDiffHandler(StatsStreamMixin, JSONHandler):
+
+    profiler = None
+    sorts = ('size_diff', 'count_diff', 'size', 'count')
+
+    @tornado.gen.coroutine
+    def get(self):
+        """Compare two snapshots, by default the last one with the current allocations."""
+        sort = self.get_argument('sort', 'size_diff')
+        strip_dirs = self.get_bool_argument('strip_dirs', True)
+        error = ''
+        if sort not in self.sorts:
+            error += "Invalid `sort` '%s', must be in %s." % (sort, self.sorts)
+        try:
+            count = self.get_count_argument()
+        except ValueError as e:
+            error += str(e)
+        try:
+            group_by = _parse_group_by(self.get_argument('group_by', 'lineno'))
+        except ValueError as e:
+            error += str(e)
+        ids = {}
+        for name, default in (('base', self.profiler.last_snapshot_id()), ('target', None)):
+            value = self.get_argument(name, default)
+            try:
+                ids[name] = None if value is None else int(value)
+            except (ValueError, TypeError):
+                error += "Can't cast `%s` '%s' to int." % (name, value)
+        if not error and ids['base'] is None:
+            error += "Missing `base`, no snapshot is stored."
+        if error:
+            self.write({'error': error})
+            self.set_status(400)
+            self.finish()
+            return
+
+        try:
+            statistics = yield self.run_in_executor(functools.partial(
+                self.profiler.compare, ids['base'], ids['target'], sort, count, strip_dirs,
+                group_by))
+        except NoStatsAvailableError as e:
+            self.write({'error': str(e)})
+            self.set_status(404)
+            self.finish()
+            return
+        self.write({"base": ids['base'], "target": ids['target'], "statistics": statistics})
+        self.set_status(200)
+        self.finish()
+
+
+EXPORT_FORMATS = ('pstats', 'collapsed', 'pprof')
+
+
+def _pstats_to_stacks(stats, max_depth=64, min_time=1e-6, max_stacks=100000):
+    """Return (stack, calls, time) records reconstructed from a pstats dictionary.
+
+    Deterministic profilers only record caller/callee edges, so the time of a
+    function is split between its callers in proportion to the cumulative
+    time of each edge, walking down from the functions without callers.
+    Paths cheaper than `min_time` seconds or deeper than `max_depth` are cut.
+    """
+    callees = {}
+    for func, (cc, nc, tt, ct, callers) in stats.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge))
+
+    stacks = []
+    roots = [func for func, stat in stats.items()
+             if not any(caller in stats for caller in stat[4])] or list(stats)
+    pending = [((func,), 1.0) for func in roots]
+    while pending and len(stacks) < max_stacks:
+        stack, share = pending.pop()
+        func = stack[-1]
+        cc, nc, tt, ct, callers = stats[func]
+        if tt * share >= min_time:
+            stacks.append((stack, nc * share, tt * share))
+        if len(stack) >= max_depth:
+            continue
+        for callee, edge in callees.get(func, ()):
+            callee_ct = stats[callee][3]
+            if callee in stack or not callee_ct:
+                continue
+            # The share of the callee's time spent below this path
+            callee_share = share * edge[3] / callee_ct
+            if callee_share * callee_ct >= min_time:
+                pending.append((stack + (callee,), min(callee_share, 1.0)))
+    return stacks
+
+
+def _stacks_to_pstats(stacks):
+    """Return a pstats dictionary built from (stack, calls, time) records."""
+    stats = {}
+    for stack, calls, weight in stacks:
+        for func in set(stack):
+            stat = stats.get(func)
+            if stat is None:
+                stat = stats[func] = [0, 0, 0.0, 0.0, {}]
+            stat[0] += calls
+            stat[1] += calls
+            stat[3] += weight
+        stats[stack[-1]][2] += weight
+        for caller, callee in set(zip(stack, stack[1:])):
+            edge = stats[callee][4].get(caller, (0, 0, 0.0, 0.0))
+            leaf = weight if callee == stack[-1] else 0.0
+            stats[callee][4][caller] = (edge[0] + calls, edge[1] + calls,
+                                        edge[2] + leaf, edge[3] + weight)
+    return dict((func, tuple(stat)) for func, stat in stats.items())
+
+
+def _frame_label(func):
+    path, line, func_name = func
+    return ("%s (%s:%d)" % (func_name, path, line)).replace(';', ':')
+
+
+def encode_collapsed(stacks):
+    """Return stacks in the collapsed format of flamegraph.pl, weighted in microseconds."""
+    lines = []
+    for stack, calls, weight in stacks:
+        microseconds = int(round(weight * 1e6))
+        if microseconds:
+            lines.append("%s %d\n" % (';'.join(_frame_label(func) for func in stack), microseconds))
+    return ''.join(lines).encode('utf-8')
+
+
+def _varint(value):
+    data = bytearray()
+    while value > 0x7f:
+        data.append((value & 0x7f) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def _field(number, value):
+    """Encode a protobuf field, `value` is an int or length-delimited bytes."""
+    if isinstance(value, bytes):
+        return _varint(number << 3 | 2) + _varint(len(value)) + value
+    return _varint(number << 3) + _varint(value)
+
+
+def encode_pprof(stacks, sample_types, period_type=None, period=0):
+    """Return stacks as an uncompressed protobuf `perftools.profiles.Profile`.
+
+    :param list stacks: (stack, calls, time) records, see :func:`_pstats_to_stacks`
+    :param list sample_types: (type, unit) of the calls and time values
+    """
+    strings = {'': 0}
+
+    def string(value):
+        return strings.setdefault(value, len(strings))
+
+    functions = {}
+    samples = []
+    for stack, calls, weight in stacks:
+        location_ids = [functions.setdefault(func, len(functions) + 1) for func in reversed(stack)]
+        values = (int(round(calls)), int(round(weight * 1e9)))
+        samples.append(_field(2, _field(1, b''.join(_varint(i) for i in location_ids)) +
+                              _field(2, b''.join(_varint(v) for v in values))))
+
+    profile = [_field(1, _field(1, string(type_)) + _field(2, string(unit)))
+               for type_, unit in sample_types]
+    profile.extend(samples)
+    for (path, line, func_name), function_id in sorted(functions.items(), key=itemgetter(1)):
+        profile.append(_field(4, _field(1, function_id) +
+                              _field(4, _field(1, function_id) + _field(2, max(line, 0)))))
+        name = string(func_name)
+        profile.append(_field(5, _field(1, function_id) + _field(2, name) + _field(3, name) +
+                              _field(4, string(path)) + _field(5, max(line, 0))))
+    profile.append(_field(9, int(time.time() * 1e9)))
+    if period_type is not None:
+        profile.append(_field(11, _field(1, string(period_type[0])) + _field(2, string(period_type[1]))))
+        profile.append(_field(12, period))
+    # The string table is written last, once every string has been interned
+    profile.extend(_field(6, value.encode('utf-8'))
+                   for value, _ in sorted(strings.items(), key=itemgetter(1)))
+    return b''.join(profile)
+
+
+def _gzip(data):
+    out = io.BytesIO()
+    with gzip.GzipFile(fileobj=out, mode='wb') as compressed:
+        compressed.write(data)
+    return out.getvalue()
+
+
+class ProfileExportHandler(StatsStreamMixin, JSONHandler):
+    """Base handler exporting a profile as a gzip compressed file.
+
+    Subclasses implement :meth:`get_export_data`, which runs in `executor`.
+    """
+
+    chunk_size = 65536
+    sample_types = (('calls', 'count'), ('cpu', 'nanoseconds'))
+    period_type = None
+    period = 0
+
+    def get_export_data(self):
+        """Return the profile as (pstats dictionary, stacks or None)."""
+        raise NotImplementedError()
+
+    def export(self, export_format):
+        """Return the gzip compressed profile in `export_format`."""
+        stats, stacks = self.get_export_data()
+        if not stats:
+            raise NoStatsAvailableError("No profiler statistics available.")
+        if export_format == 'pstats':
+            return _gzip(marshal.dumps(stats))
+        if stacks is None:
+            stacks = _pstats_to_stacks(stats)
+        if export_format == 'collapsed':
+            return _gzip(encode_collapsed(stacks))
+        return _gzip(encode_pprof(stacks, self.sample_types, self.period_type, self.period))
+
+    @tornado.gen.coroutine
+    def get(self):
+        """Download the profile as pstats, collapsed stacks or pprof."""
+        export_format = self.get_argument('format', 'pstats')
+        if export_format not in EXPORT_FORMATS:
+            self.write({'error': "Invalid `format` '%s', must be in %s." % (export_format, EXPORT_FORMATS)})
+            self.set_status(400)
+            self.finish()
+            return
+
+        try:
+            data = yield self.run_in_executor(self.export, export_format)
+        except TypeError:
+            logger.exception('Error while exporting profiler statistics')
+            self.write({'error': 'No stats available. Start and stop the profiler before trying to retrieve stats.'})
+            self.set_status(404)
+            self.finish()
+            return
+
+        filename = {'pstats': 'profile.pstats.gz', 'collapsed': 'profile.collapsed.gz',
+                    'pprof': 'profile.pb.gz'}[export_format]
+        self.set_header('Content-Type', 'application/gzip')
+        self.set_header('Content-Disposition', 'attachment; filename="%s"' % filename)
+        for i in range(0, len(data), self.chunk_size):
+            self.write(data[i:i + self.chunk_size])
+            yield self.flush()
+        self.finish()
+
+
+class YappiCallersMixin(object):
+    """Reject requests needing callers while the 'wall' clock profile is current."""
+
+    def prepare(self):
+        super(YappiCallersMixin, self).prepare()
+        try:
+            _check_callers_recorded()
+        except WallClockError as e:
+            self.write({'error': str(e)})
+            self.set_status(400)
+            self.finish()
+
+
+class YappiProfileExportHandler(YappiCallersMixin, ProfileExportHandler):
+
+    def get_export_data(self):
+        return get_profiler_pstats(), None
+
+
+class CProfileExportHandler(ProfileExportHandler):
+
+    sessions = None
+    sample_types = (('calls', 'count'), ('wall', 'nanoseconds'))
+
+    def get_export_data(self):
+        return self.sessions.get_stats().stats, None
+
+
+class SamplingProfileExportHandler(ProfileExportHandler):
+
+    profiler = None
+    sample_types = (('samples', 'count'), ('wall', 'nanoseconds'))
+    period_type = ('wall', 'nanoseconds')
+
+    @property
+    def period(self):
+        return int(self.profiler.interval * 1e9)
+
+    def get_export_data(self):
+        stacks = self.profiler.get_stacks()
+        return _stacks_to_pstats(stacks), stacks
+
+
+class _PStatsHolder(object):
+    """Profiler-like object pstats.Stats can load a pstats dictionary from."""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def _strip_pstats(stats):
+    """Return a pstats dictionary with the directories stripped, see `pstats.Stats.strip_dirs`."""
+    if not stats:
+        return {}
+    return pstats.Stats(_PStatsHolder(dict(stats))).strip_dirs().stats
+
+
+class CallGraph(object):
+    """Caller/callee index of a pstats dictionary.
+
+    Functions are numbered once when the graph is built; :meth:`subgraph`
+    then walks the indexed edges around the functions matching a query.
+    """
+
+    def __init__(self, stats):
+        self.functions = list(stats)
+        self._stats = stats
+        ids = dict((func, i) for i, func in enumerate(self.functions))
+        self._callers = [[] for _ in self.functions]
+        self._callees = [[] for _ in self.functions]
+        self._names = {}
+        for callee, (cc, nc, tt, ct, callers) in stats.items():
+            j = ids[callee]
+            for caller, edge in callers.items():
+                i = ids.get(caller)
+                if i is None:
+                    continue
+                edge = (i, j) + tuple(edge[:4])
+                self._callers[j].append(edge)
+                self._callees[i].append(edge)
+            path, line, func_name = callee
+            for name in (func_name, "%s:%d" % (path, line), pstats.func_std_string(callee)):
+                self._names.setdefault(name, []).append(j)
+
+    def find(self, query):
+        """Return the ids of the functions named `query`.
+
+        `query` is a function name, `path:line` or `path:line(function name)`.
+        """
+        return sorted(self._names.get(query, ()))
+
+    def subgraph(self, ids, depth=2):
+        """Return the functions and edges within `depth` calls of the functions `ids`."""
+        seen = set(ids)
+        edges = set()
+        for neighbours, index in ((self._callers, 0), (self._callees, 1)):
+            frontier = list(ids)
+            visited = set(ids)
+            for _ in range(depth):
+                following = []
+                for i in frontier:
+                    for edge in neighbours[i]:
+                        edges.add(edge)
+                        neighbour = edge[index]
+                        if neighbour not in visited:
+                            visited.add(neighbour)
+                            following.append(neighbour)
+                frontier = following
+            seen |= visited
+
+        functions = []
+        for i in sorted(seen):
+            func = self.functions[i]
+            row = _make_row(func, *self._stats[func][:4])
+            row["id"] = i
+            functions.append(row)
+        return {
+            "functions": functions,
+            "edges": [{"caller": caller, "callee": callee, "primitive_calls": cc,
+                       "num_calls": nc, "total_time": tt, "cum_time": ct}
+                      for caller, callee, cc, nc, tt, ct in sorted(edges)]
+        }
+
+
+class CallGraphHandler(StatsStreamMixin, JSONHandler):
+    """Base handler for the call graph around a function.
+
+    Subclasses implement :meth:`get_call_graph`, which runs in `executor`.
+    """
+
+    def get_call_graph(self, strip_dirs):
+        """Return the :class:`CallGraph` of the current statistics."""
+        raise NotImplementedError()
+
+    def encode_subgraph(self, func, depth, strip_dirs):
+        graph = self.get_call_graph(strip_dirs)
+        ids = graph.find(func)
+        if not ids:
+            return None
+        subgraph = graph.subgraph(ids, depth)
+        subgraph["matches"] = ids
+        return json_encode(subgraph)
+
+    @tornado.gen.coroutine
+    def get(self):
+        """Return the callers and callees of `func`, `depth` calls away."""
+        func = self.get_argument('func', None)
+        depth = self.get_argument('depth', 2)
+        strip_dirs = self.get_bool_argument('strip_dirs', True)
+        error = ''
+        if not func:
+            error += "Missing `func`."
+        try:
+            depth = int(depth)
+        except (ValueError, TypeError):
+            error += "Can't cast `depth` '%s' to int." % depth
+        if error:
+            self.write({'error': error})
+            self.set_status(400)
+            self.finish()
+            return
+
+        try:
+            subgraph = yield self.run_in_executor(self.encode_subgraph, func, depth, strip_dirs)
+        except TypeError:
+            logger.exception('Error while building the call graph')
+            self.write({'error': 'No stats available. Start and stop the profiler before trying to retrieve stats.'})
+            self.set_status(404)
+            self.finish()
+            return
+
+        if subgraph is None:
+            self.write({'error': "No function matching `func` '%s'." % func})
+            self.set_status(404)
+        else:
+            self.write(subgraph)
+            self.set_status(200)
+        self.finish()
+
+
+class YappiCallGraphHandler(YappiCallersMixin, CallGraphHandler):
+
+    def get_call_graph(self, strip_dirs):
+        return get_call_graph(strip_dirs)
+
+
+class CProfileCallGraphHandler(CallGraphHandler):
+
+    sessions = None
+
+    def get_call_graph(self, strip_dirs):
+        stats = self.sessions.get_stats()
+        if strip_dirs:
+            stats.strip_dirs()
+        return CallGraph(stats.stats)
+
+
+class SamplingCallGraphHandler(CallGraphHandler):
+
+    profiler = None
+
+    def get_call_graph(self, strip_dirs):
+        return self.profiler.get_call_graph(strip_dirs)
+
+
+@tornado.gen.coroutine
+def _read_message(stream):
+    """Read one length prefixed, marshalled message from `stream`."""
+    header = yield stream.read_bytes(4)
+    data = yield stream.read_bytes(struct.unpack('!I', header)[0])
+    raise tornado.gen.Return(marshal.loads(data))
+
+
+def _write_message(stream, message):
+    """Write `message` to `stream`, see :func:`_read_message`."""
+    data = marshal.dumps(message)
+    return stream.write(struct.pack('!I', len(data)) + data)
+
+
+class _ClusterServer(tornado.tcpserver.TCPServer):
+    """Answer the commands sent by the sibling workers of a :class:`ProfilerCluster`."""
+
+    def __init__(self, cluster):
+        super(_ClusterServer, self).__init__()
+        self.cluster = cluster
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        try:
+            command, args = yield _read_message(stream)
+            if command == 'stats':
+                executor = self.cluster.executor or _default_executor()
+                response = yield tornado.ioloop.IOLoop.current().run_in_executor(
+                    executor, self.cluster.handle, command, *args)
+            else:
+                response = self.cluster.handle(command, *args)
+            yield _write_message(stream, response)
+        except tornado.iostream.StreamClosedError:
+            pass
+        except Exception:
+            logger.exception('Error while handling a profiler cluster command')
+        finally:
+            stream.close()
+
+
+class ProfilerCluster(object):
+    """Coordinate the yappi profiler of the worker processes of one host.
+
+    Every worker started by `tornado.process.fork_processes` listens on a unix
+    socket named `<parent pid>-<pid>.sock` in `directory`. The worker serving
+    a profiler request forwards start, stop and clear to its siblings and
+    merges their function statistics into its own, so one request profiles
+    the whole host. Statistics travel as marshalled tuples and are summed by
+    a :class:`StatsEngine`. Routes are sent by name and resolved with the
+    `route_profiler` of each worker, whose yappi tags are numbered in the
+    order that worker first served them.
+
+    Call :meth:`listen` in every worker once it has been forked.
+    """
+
+    def __init__(self, directory, executor=None, timeout=5.0, route_profiler=None):
+        self.directory = directory
+        self.executor = executor
+        self.timeout = timeout
+        self.route_profiler = route_profiler
+        self._server = None
+        self._pid = None
+        self._engines = {}
+        self._engines_lock = threading.Lock()
+
+    @property
+    def path(self):
+        """The unix socket of this worker."""
+        return os.path.join(self.directory, "%d-%d.sock" % (os.getppid(), os.getpid()))
+
+    def listen(self):
+        """Start answering the siblings of this worker; a no-op if already listening."""
+        if self._pid == os.getpid():
+            return
+        # A server inherited from the parent process belongs to the parent
+        self._server = _ClusterServer(self)
+        self._server.add_socket(tornado.netutil.bind_unix_socket(self.path))
+        self._pid = os.getpid()
+
+    def close(self):
+        """Stop listening and remove the socket of this worker."""
+        if self._pid != os.getpid():
+            return
+        self._server.stop()
+        self._server = self._pid = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def peers(self):
+        """Return the sockets of the sibling workers."""
+        path = self.path
+        pattern = os.path.join(self.directory, "%d-*.sock" % os.getppid())
+        return [peer for peer in sorted(glob.glob(pattern)) if peer != path]
+
+    def handle(self, command, *args):
+        """Run `command` for a sibling and return the response."""
+        if command == 'start':
+            if not is_profiler_running():
+                start_profiling(args[0], args[1], parse_stats_filter(*args[2:]))
+        elif command == 'stop':
+            stop_profiling()
+        elif command == 'clear':
+            clear_stats()
+        elif command == 'running':
+            return is_profiler_running()
+        elif command == 'stats':
+            tags = None
+            if args:
+                route, method = args
+                # A worker which never served the route has no time for it
+                tags = ()
+                if self.route_profiler is not None:
+                    tags = self.route_profiler.get_tags(route, method)
+            columns, func_stats = _get_func_stats(tags)
+            fields = attrgetter(*(FuncStat._fields + columns))
+            return columns, [fields(stat) for stat in func_stats]
+        else:
+            raise ValueError("Unknown command '%s'." % command)
+        return True
+
+    @tornado.gen.coroutine
+    def broadcast(self, command, *args):
+        """Send `command` to every sibling and return the responses of those that answered."""
+        self.listen()
+        responses = yield [self._send(peer, command, args) for peer in self.peers()]
+        raise tornado.gen.Return([response for response in responses if response is not None])
+
+    @tornado.gen.coroutine
+    def _send(self, peer, command, args):
+        stream = tornado.iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        try:
+            yield tornado.gen.with_timeout(timedelta(seconds=self.timeout), stream.connect(peer))
+            yield _write_message(stream, (command, args))
+            response = yield tornado.gen.with_timeout(
+                timedelta(seconds=self.timeout), _read_message(stream))
+        except (tornado.iostream.StreamClosedError, tornado.util.TimeoutError):
+            error = stream.error
+            if isinstance(error, (IOError, OSError)) and error.errno in (errno.ECONNREFUSED, errno.ENOENT):
+                # The worker exited, forget about it
+                try:
+                    os.remove(peer)
+                except OSError:
+                    pass
+            else:
+                logger.warning("Profiler cluster worker %s did not answer '%s'", peer, command)
+            raise tornado.gen.Return(None)
+        finally:
+            stream.close()
+        raise tornado.gen.Return(response)
+
+    def get_statistics(self, peer_stats, sort="cum_time", count=20, strip_dirs=True, tags=None,
+                       stats_filter=None):
+        """Return the statistics of this worker merged with the `stats` responses of its siblings.
+
+        See :func:`get_profiler_statistics`. Siblings profiling with another
+        clock are left out.
+        """
+        columns, func_stats = _get_func_stats(tags)
+        func_stats = list(func_stats)
+        record = WallFuncStat if columns else FuncStat
+        for peer_columns, rows in peer_stats:
+            if tuple(peer_columns) == columns:
+                func_stats.extend(record(*row) for row in rows)
+        key = (strip_dirs, None if columns else tags, columns)
+        with self._engines_lock:
+            engine = self._engines.get(key)
+            if engine is None:
+                engine = self._engines[key] = StatsEngine(strip_dirs, columns)
+        engine.update(func_stats)
+        return engine.top(sort, count, stats_filter)
+
+
+_backends = {}  # name -> ProfilerBackend subclass
+
+
+def register_backend(name, backend_class):
+    """Make `TornadoProfiler(backend=name)` profile with `backend_class`.
+
+    `backend_class` is a :class:`ProfilerBackend` subclass, instantiated with
+    the :class:`TornadoProfiler`. It should import the profiler it uses when
+    instantiated, so that unused backends are never imported and a missing
+    profiler fails when the :class:`TornadoProfiler` is built.
+    """
+    _backends[name] = backend_class
+
+
+class ProfilerBackend(object):
+    """The profiler behind the routes of a :class:`TornadoProfiler`.
+
+    :meth:`get_routes` returns the backend's `/profiler`, `/profiler/stats`,
+    ... routes; the routes shared by every backend are added to them. The
+    other methods are called by the shared routes, the triggers and the
+    rolling windows, and default to a backend that profiles nothing.
+    """
+
+    clustered = False  # whether `cluster_dir` is supported
+
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    def get_routes(self):
+        return []
+
+    def instrument(self, application):
+        """Called by :meth:`TornadoProfiler.instrument`."""
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def is_running(self):
+        return False
+
+    def collect(self):
+        """Return the function statistics of a rolling window and clear them.
+
+        Called on the IOLoop thread, see :class:`WindowStore`.
+        """
+        return []
+
+    def get_profiled_time(self):
+        """Return the profiled and elapsed seconds, None if not measured."""
+        return None
+
+    def get_statistics(self, sort="cum_time", count=20):
+        """Return the top function statistics, None if the backend has none."""
+        return None
+
+    def get_route_statistics(self, tag, count):
+        """Return the top function statistics of the route with `tag`."""
+        return []
+
+    def get_metrics(self):
+        """Return the `(name, type, help, samples)` of the backend's own metrics."""
+        return []
+
+
+def _rolling_routes(profiler):
+    return [
+        (profiler.prefix + "/profiler/windows",
+         profiler._handler(WindowsHandler, windows=profiler.windows)),
+        (profiler.prefix + "/profiler/stats/diff",
+         profiler._handler(WindowDiffHandler, windows=profiler.windows,
+                           executor=profiler.executor))
+    ]
+
+
+class YappiBackend(ProfilerBackend):
+
+    clustered = True
+
+    def __init__(self, profiler):
+        super(YappiBackend, self).__init__(profiler)
+        try:
+            yappi._load()
+        except ImportError:
+            raise ImportError("The yappi backend needs yappi, install tornado-profile[yappi] "
+                              "or pick another backend.")
+
+    def get_routes(self):
+        profiler = self.profiler
+        return [
+            (profiler.prefix + "/profiler",
+             profiler._handler(YappiProfilerHandler, cluster=profiler.cluster,
+                               session=profiler.session, windows=profiler.windows)),
+            (profiler.prefix + "/profiler/stats",
+             profiler._handler(YappiProfileStatsHandler, route_profiler=profiler.route_profiler,
+                               cluster=profiler.cluster, windows=profiler.windows,
+                               executor=profiler.executor)),
+            (profiler.prefix + "/profiler/stats/export",
+             profiler._handler(YappiProfileExportHandler, executor=profiler.executor)),
+            (profiler.prefix + "/profiler/callgraph",
+             profiler._handler(YappiCallGraphHandler, executor=profiler.executor)),
+            (profiler.prefix + "/profiler/threads",
+             profiler._handler(YappiThreadStatsHandler, executor=profiler.executor))
+        ] + _rolling_routes(profiler)
+
+    def instrument(self, application):
+        yappi.set_tag_callback(_current_route.get)
+
+    def start(self):
+        if not is_profiler_running():
+            start_profiling()
+        if self.profiler.cluster is not None:
+            self.profiler.cluster.broadcast('start', _clock_type, False)
+
+    def stop(self):
+        stop_profiling()
+        if self.profiler.cluster is not None:
+            self.profiler.cluster.broadcast('stop')
+
+    def is_running(self):
+        return is_profiler_running()
+
+    def collect(self):
+        # The wall clock profiler hands over the counters of finished calls,
+        # clearing it would drop the call stack of the calls in progress
+        if _clock_type == 'wall':
+            return _wall_clock_profiler.collect_stats()
+        func_stats = list(_get_func_stats()[1])
+        clear_stats()
+        return func_stats
+
+    def get_profiled_time(self):
+        return get_profiled_time()
+
+    def get_statistics(self, sort="cum_time", count=20):
+        return get_profiler_statistics(sort, count)
+
+    def get_route_statistics(self, tag, count):
+        try:
+            return get_profiler_statistics('cum_time', count, True, tags=(tag,))
+        except NoStatsAvailableError:
+            return []
+
+
+class CProfileBackend(ProfilerBackend):
+
+    def __init__(self, profiler):
+        super(CProfileBackend, self).__init__(profiler)
+        self.sessions = profiler.cprofile_sessions = CProfileSessionManager()
+        profiler.route_profiler.listeners.append(self.sessions.record_request)
+
+    def get_routes(self):
+        profiler = self.profiler
+        sessions = self.sessions
+        return [
+            (profiler.prefix + "/profiler",
+             profiler._handler(CProfileHandler, sessions=sessions, session=profiler.session)),
+            (profiler.prefix + "/profiler/stats",
+             profiler._handler(CProfileStatsHandler, sessions=sessions,
+                               executor=profiler.executor)),
+            (profiler.prefix + "/profiler/stats/dump",
+             profiler._handler(CProfileStatsDumpHandler, sessions=sessions,
+                               executor=profiler.executor)),
+            (profiler.prefix + "/profiler/stats/export",
+             profiler._handler(CProfileExportHandler, sessions=sessions,
+                               executor=profiler.executor)),
+            (profiler.prefix + "/profiler/callgraph",
+             profiler._handler(CProfileCallGraphHandler, sessions=sessions,
+                               executor=profiler.executor)),
+            (profiler.prefix + "/profiler/threads",
+             profiler._handler(CProfileThreadStatsHandler, sessions=sessions,
+                               executor=profiler.executor)),
+            (profiler.prefix + "/profiler/sessions",
+             profiler._handler(CProfileSessionsHandler, sessions=sessions)),
+            (profiler.prefix + "/profiler/sessions/([^/]+)",
+             profiler._handler(CProfileHandler, sessions=sessions, session=profiler.session)),
+            (profiler.prefix + "/profiler/sessions/([^/]+)/stats",
+             profiler._handler(CProfileStatsHandler, sessions=sessions,
+                               executor=profiler.executor))
+        ]
+
+    def start(self):
+        self.sessions.start()
+
+    def stop(self):
+        self.sessions.stop()
+
+    def is_running(self):
+        return self.sessions.is_running()
+
+    def get_profiled_time(self):
+        return self.sessions.get_profiled_time()
+
+    def get_statistics(self, sort="cum_time", count=20):
+        return self.sessions.get_statistics(DEFAULT_SESSION, sort, count)
+
+
+class SamplingBackend(ProfilerBackend):
+
+    def __init__(self, profiler):
+        super(SamplingBackend, self).__init__(profiler)
+        self.sampler = profiler.sampling_profiler = SamplingProfiler(profiler.sample_interval)
+
+    def get_routes(self):
+        profiler = self.profiler
+        return [
+            (profiler.prefix + "/profiler",
+             profiler._handler(SamplingProfilerHandler, profiler=self.sampler,
+                               session=profiler.session, windows=profiler.windows)),
+            (profiler.prefix + "/profiler/stats",
+             profiler._handler(SamplingProfileStatsHandler, profiler=self.sampler,
+                               windows=profiler.windows, executor=profiler.executor)),
+            (profiler.prefix + "/profiler/stats/export",
+             profiler._handler(SamplingProfileExportHandler, profiler=self.sampler,
+                               executor=profiler.executor)),
+            (profiler.prefix + "/profiler/callgraph",
+             profiler._handler(SamplingCallGraphHandler, profiler=self.sampler,
+                               executor=profiler.executor))
+        ] + _rolling_routes(profiler)
+
+    def start(self):
+        self.sampler.start()
+
+    def stop(self):
+        self.sampler.stop()
+
+    def is_running(self):
+        return self.sampler.is_running()
+
+    def collect(self):
+        return self.sampler.collect_stats()
+
+    def get_statistics(self, sort="cum_time", count=20):
+        return self.sampler.get_statistics(sort, count)
+
+    def get_metrics(self):
+        return [
+            ("samples_total", "counter", "Stack samples taken.", [((), self.sampler.samples)]),
+            ("overhead_ratio", "gauge", "Fraction of wall time spent sampling.",
+             [((), self.sampler.overhead())])
+        ]
+
+
+class TracemallocBackend(ProfilerBackend):
+
+    def __init__(self, profiler):
+        super(TracemallocBackend, self).__init__(profiler)
+        self.memory_profiler = TracemallocProfiler(profiler.traceback_depth)
+        profiler.tracemalloc_profiler = self.memory_profiler
+
+    def get_routes(self):
+        profiler = self.profiler
+        return [
+            (profiler.prefix + "/profiler",
+             profiler._handler(TracemallocProfilerHandler, profiler=self.memory_profiler,
+                               session=profiler.session, executor=profiler.executor)),
+            (profiler.prefix + "/profiler/stats",
+             profiler._handler(TracemallocStatsHandler, profiler=self.memory_profiler,
+                               executor=profiler.executor)),
+            (profiler.prefix + "/profiler/stats/diff",
+             profiler._handler(TracemallocDiffHandler, profiler=self.memory_profiler,
+                               executor=profiler.executor)),
+            (profiler.prefix + "/profiler/snapshots",
+             profiler._handler(TracemallocSnapshotsHandler, profiler=self.memory_profiler,
+                               executor=profiler.executor))
+        ]
+
+    def start(self):
+        self.memory_profiler.start()
+
+    def stop(self):
+        self.memory_profiler.stop()
+
+    def is_running(self):
+        return self.memory_profiler.is_running()
+
+    def get_metrics(self):
+        status = self.memory_profiler.status()
+        return [
+            ("traced_memory_bytes", "gauge", "Memory of the traced allocations.",
+             [((), status["traced_memory"])]),
+            ("peak_traced_memory_bytes", "gauge", "Peak memory of the traced allocations.",
+             [((), status["peak_memory"])])
+        ]
+
+
+register_backend('yappi', YappiBackend)
+register_backend('cprofile', CProfileBackend)
+register_backend('cProfile', CProfileBackend)
+register_backend('sampling', SamplingBackend)
+register_backend('tracemalloc', TracemallocBackend)
+
+
+class TornadoProfiler(object):
+
+    def __init__(self, prefix="", handler_base_class=object, backend='yappi',
+                 executor=None, sample_interval=0.005, lag_interval=0.1,
+                 slow_callback_threshold=0.1, cluster_dir=None, windows=60,
+                 window_rows=5000, traceback_depth=1, trace_rate=0.0, trace_header=None,
+                 trace_argument=None, slow_request_threshold=0.5, slow_requests=100,
+                 metrics_ttl=5.0):
+        """
+        :param str prefix: prefix prepended to every profiler route
+        :param type handler_base_class: extra base class mixed into every handler
+        :param str backend: 'yappi', 'cprofile', 'sampling' or 'tracemalloc'
+        :param executor: `concurrent.futures.Executor` used to build statistics
+            off the IOLoop thread. It must share memory with the profiled
+            process, so use a thread pool. Defaults to a single worker thread.
+        :param float sample_interval: seconds between two samples of the
+            'sampling' backend
+        :param float lag_interval: seconds between two IOLoop lag measurements
+        :param float slow_callback_threshold: IOLoop callbacks running longer
+            than this many seconds have their stack captured
+        :param str cluster_dir: directory for the sockets of a
+            :class:`ProfilerCluster`, so the profiler routes of any worker
+            process control and report every worker. yappi backend only.
+        :param int windows: number of windows kept by `POST /profiler?rolling=`
+        :param int window_rows: maximum number of functions kept per window
+        :param int traceback_depth: frames kept per allocation by the
+            'tracemalloc' backend, unless `POST /profiler?depth=` is given
+        :param float trace_rate: fraction of the requests of an instrumented
+            application profiled one by one, see :class:`RequestTracer`
+        :param str trace_header: also profile the requests with this header
+        :param str trace_argument: also profile the requests with this query argument
+        :param float slow_request_threshold: keep the profile of the traced
+            requests taking at least this many seconds, at `/profiler/slow`
+        :param int slow_requests: number of slow request profiles kept
+        :param float metrics_ttl: seconds `/profiler/metrics` is cached for
+        """
+        self.prefix = prefix
+        self.handler_base_class = handler_base_class
+        self.backend = backend
+        self.executor = executor
+        self.sample_interval = sample_interval
+        self.sampling_profiler = None
+        self.tracemalloc_profiler = None
+        self.cprofile_sessions = None
+        self.traceback_depth = traceback_depth
+        backend_class = _backends.get(backend)
+        if backend_class is None:
+            raise ValueError("No such backend.")
+        if cluster_dir is not None and not backend_class.clustered:
+            raise ValueError("`cluster_dir` is not supported by the %s backend." % backend)
+        self.route_profiler = RouteProfiler()
+        self.ioloop_monitor = IOLoopMonitor(lag_interval, slow_callback_threshold)
+        self.route_profiler.listeners.append(self.ioloop_monitor.record_handler)
+        self.tracer = RequestTracer(trace_rate, slow_request_threshold, slow_requests,
+                                    trace_header, trace_argument)
+        self.session = ProfilingSession(self.stop)
+        self.route_profiler.listeners.append(self.session.record_request)
+        self.triggers = ProfilingTriggers(self)
+        self.route_profiler.listeners.append(self.triggers.record_request)
+        self.windows = WindowStore(self.collect, windows, window_rows, executor)
+        self.metrics = ProfilerMetrics(self, metrics_ttl)
+        self.cluster = None
+        if cluster_dir is not None:
+            self.cluster = ProfilerCluster(cluster_dir, executor,
+                                           route_profiler=self.route_profiler)
+        self.profiler_backend = backend_class(self)
+
+    def get_routes(self):
+
+        routes = [
+            (self.prefix + "/profiler/routes",
+             self._handler(RouteStatsHandler, route_profiler=self.route_profiler,
+                           backend=self.profiler_backend, executor=self.executor)),
+            (self.prefix + "/profiler/ioloop",
+             self._handler(IOLoopMonitorHandler, monitor=self.ioloop_monitor)),
+            (self.prefix + "/profiler/slow", self._handler(SlowRequestsHandler, tracer=self.tracer)),
+            (self.prefix + r"/profiler/triggers(?:/([0-9]+))?",
+             self._handler(ProfilingTriggersHandler, triggers=self.triggers)),
+            (self.prefix + "/profiler/metrics",
+             self._handler(MetricsHandler, metrics=self.metrics, executor=self.executor)),
+            (self.prefix + "/profiler/slow/([0-9]+)",
+             self._handler(SlowRequestStatsHandler, tracer=self.tracer, executor=self.executor))
+        ]
+
+        return self.profiler_backend.get_routes() + routes
+
+    def instrument(self, application):
+        """Attribute the requests of `application` to its routes.
+
+        Enables `/profiler/routes`, `/profiler/slow` when requests are traced
+        and, with the yappi backend, the `route` filter of `/profiler/stats`.
+        Call it once the application's routes, including the profiler's, are
+        in place. Returns the application.
+        """
+        self.route_profiler.instrument(application)
+        if self.tracer.is_enabled():
+            self.route_profiler.tracer = self.tracer
+        self.session.counting_requests = True
+        self.profiler_backend.instrument(application)
+        return application
+
+    def start(self):
+        """Start the profiler of the backend, on every worker with `cluster_dir`."""
+        self.profiler_backend.start()
+
+    def stop(self):
+        """Stop the profiler of the backend, on every worker with `cluster_dir`."""
+        self.windows.stop()
+        self.profiler_backend.stop()
+
+    def is_running(self):
+        """Return True if the profiler of the backend is running."""
+        return self.profiler_backend.is_running()
+
+    def collect(self):
+        """Return the function statistics of the backend and clear them, on the IOLoop thread."""
+        return self.profiler_backend.collect()
+
+    def get_profiled_time(self):
+        """Return the profiled and elapsed seconds of the backend, None if it doesn't measure them."""
+        return self.profiler_backend.get_profiled_time()
+
+    def get_statistics(self, sort="cum_time", count=20):
+        """Return the top function statistics of the backend, None if it has none."""
+        return self.profiler_backend.get_statistics(sort, count)
+
+    def _handler(self, handler_class, **attributes):
+        """Return `handler_class` mixed with `handler_base_class` and `attributes`."""
+        return type(handler_class.__name__, (handler_class, self.handler_base_class), attributes)
 
 
 def main(port=8888):